@@ -2,14 +2,26 @@ from flask import Blueprint, render_template, abort, flash, redirect, url_for, r
 from flask_login import login_required, current_user
 import os
 
-from models import User, Course, Category, LibraryMaterial, PlatformSetting, Enrollment, CertificateRequest, Certificate, LibraryPurchase, ChatRoom, ChatRoomMember, MutedUser, ReportedMessage, AdminLog, GroupRequest
+from models import User, Course, Category, LibraryMaterial, PlatformSetting, Enrollment, CertificateRequest, Certificate, LibraryPurchase, ChatRoom, ChatRoomMember, MutedUser, ReportedMessage, AdminLog, GroupRequest, ChatMessage
 from extensions import db
-from pdf_generator import generate_certificate_pdf
+from sqlalchemy.orm import joinedload
+from certificate_renderer import queue_certificates
 from utils import save_chat_room_cover_image
+import room_auth
+import catalog_search
+import chat_search
+import exam_intake
+import metrics_rollup
+import data_export
+import keyset
+import upload_store
 import secrets
+import uuid
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
+ADMIN_PAGE_SIZE = 50 # Rows per page of the management lists
+
 @admin_bp.before_request
 @login_required
 def before_request():
@@ -21,35 +33,61 @@ from datetime import datetime, timedelta
 
 @admin_bp.route('/dashboard')
 def dashboard():
-    # Time window for "recent" activity
-    seven_days_ago = datetime.utcnow() - timedelta(days=7)
-
-    # Perform analytics queries
-    user_count = User.query.count()
-    course_count = Course.query.count()
-    enrollment_count = Enrollment.query.filter_by(status='approved').count()
-    new_users_count = User.query.filter(User.created_at >= seven_days_ago).count()
+    # Counts come from the daily rollup rather than the base tables; `flask rollup-metrics`
+    # keeps it current, and the dashboard says when it hasn't run today
+    rolled_up_on = metrics_rollup.rolled_up_on()
+    totals = metrics_rollup.totals()
+    trends = metrics_rollup.trends(days=90)
+    user_roles = sorted(totals['users_total'].items())
 
-    user_roles = db.session.query(User.role, db.func.count(User.role)).group_by(User.role).all()
+    busiest = metrics_rollup.top_dimensions('chat_messages', days=90)
+    room_names = dict(db.session.query(ChatRoom.id, ChatRoom.name)
+                      .filter(ChatRoom.id.in_([int(room_id) for room_id, _ in busiest if room_id.isdigit()])))
 
     # Prepare data for charts
     analytics_data = {
-        'user_count': user_count,
-        'course_count': course_count,
-        'enrollment_count': enrollment_count,
-        'new_users_last_7_days': new_users_count,
+        'user_count': sum(totals['users_total'].values()),
+        'course_count': sum(totals['courses_total'].values()),
+        'enrollment_count': totals['enrollments_total'].get('approved', 0),
+        'new_users_last_7_days': sum(trends['series']['signups'][-7:]),
         'user_roles_labels': [role for role, count in user_roles],
-        'user_roles_values': [count for role, count in user_roles]
+        'user_roles_values': [count for role, count in user_roles],
+        'trend_labels': trends['labels'],
+        'trend_series': trends['series'],
+        'busiest_rooms': [(room_names.get(int(room_id), 'Deleted room') if room_id.isdigit() else room_id, count)
+                          for room_id, count in busiest],
+        'exam_grading_queue': exam_intake.queue_depth(),
+        'rolled_up_on': rolled_up_on,
+        'rollup_stale': rolled_up_on is None or rolled_up_on < datetime.utcnow().date()
     }
 
     general_room = ChatRoom.query.filter_by(name='General').first()
     chat_status = 'Locked' if general_room and general_room.is_locked else 'Unlocked'
     return render_template('admin/dashboard.html', analytics=analytics_data, chat_status=chat_status)
 
+@admin_bp.route('/metrics/exam-grading-queue')
+def exam_grading_queue():
+    return jsonify(exam_intake.queue_depth())
+
+@admin_bp.route('/export/<name>.<file_format>')
+def export(name, file_format):
+    if name not in data_export.EXPORTS or file_format not in data_export.FORMATS:
+        abort(404)
+    try:
+        kwargs = data_export.filters(name, request.args)
+    except ValueError:
+        abort(400)
+    return data_export.response(name, file_format, **kwargs)
+
 @admin_bp.route('/chat')
 def manage_chat():
-    all_rooms = ChatRoom.query.order_by(ChatRoom.name).all()
-    return render_template('admin/manage_chat.html', rooms=all_rooms)
+    page = keyset.paginate(ChatRoom.query, [ChatRoom.name, ChatRoom.id], after=request.args.get('after', type=int),
+                           before=request.args.get('before', type=int), per_page=ADMIN_PAGE_SIZE)
+    # Member counts for the whole page in one query
+    member_counts = dict(db.session.query(ChatRoomMember.chat_room_id, db.func.count(ChatRoomMember.id))
+                         .filter(ChatRoomMember.chat_room_id.in_([room.id for room in page.items]))
+                         .group_by(ChatRoomMember.chat_room_id).all())
+    return render_template('admin/manage_chat.html', rooms=page.items, page=page, member_counts=member_counts)
 
 @admin_bp.route('/group-requests')
 def manage_group_requests():
@@ -96,6 +134,7 @@ def reject_group_request(request_id):
     rejection_reason = request.form.get('rejection_reason')
 
     group_request.status = 'rejected'
+    upload_store.release(group_request.cover_image)
     if rejection_reason:
         group_request.rejection_reason = rejection_reason
 
@@ -164,6 +203,7 @@ def edit_chat_room(room_id):
         if cover_image_file:
             cover_image_path = save_chat_room_cover_image(cover_image_file)
             if cover_image_path:
+                upload_store.release(room.cover_image)
                 room.cover_image = cover_image_path
             else:
                 flash('Invalid image file for cover image. Allowed types: png, jpg, jpeg.', 'danger')
@@ -183,6 +223,12 @@ def delete_chat_room(room_id):
         flash(f'Cannot delete a "{room.room_type}" type room via this method.', 'danger')
         return redirect(url_for('admin.manage_chat'))
 
+    upload_store.release(room.cover_image)
+    shared_files = db.session.query(ChatMessage.file_path)\
+        .filter(ChatMessage.room_id == room.id, ChatMessage.file_path.isnot(None))
+    for file_path, in shared_files:
+        upload_store.release(file_path)
+    chat_search.remove_room(room.id)
     db.session.delete(room)
     db.session.commit()
     flash(f'Room "{room.name}" has been deleted.', 'success')
@@ -213,6 +259,7 @@ def manage_chat_members(room_id):
                 db.session.delete(member)
 
         db.session.commit()
+        room_auth.invalidate(room_id=room.id)
         flash('Room members updated successfully.', 'success')
         return redirect(url_for('admin.manage_chat_members', room_id=room.id))
 
@@ -266,6 +313,7 @@ def toggle_course_chat_lock(room_id):
 @admin_bp.route('/users')
 def manage_users():
     role_filter = request.args.get('role_filter', 'all')
+    sort = request.args.get('sort', 'name')
 
     query = User.query
 
@@ -278,16 +326,20 @@ def manage_users():
     elif role_filter == 'pending':
         query = query.filter_by(role='instructor', approved=False)
 
-    users_to_display = query.order_by(User.name).all()
+    sort_columns, descending = ([User.created_at, User.id], True) if sort == 'newest' else ([User.name, User.id], False)
+    page = keyset.paginate(query, sort_columns, after=request.args.get('after', type=int),
+                           before=request.args.get('before', type=int), per_page=ADMIN_PAGE_SIZE, descending=descending)
 
     # We still need this for the count in the sidebar
-    pending_instructors = User.query.filter_by(role='instructor', approved=False).all()
+    pending_instructors_count = User.query.filter_by(role='instructor', approved=False).count()
 
     return render_template(
         'admin/manage_users.html',
-        users_to_display=users_to_display,
-        pending_instructors=pending_instructors,
-        current_filter=role_filter
+        users_to_display=page.items,
+        page=page,
+        pending_instructors_count=pending_instructors_count,
+        current_filter=role_filter,
+        current_sort=sort
     )
 
 @admin_bp.route('/user/<int:user_id>/approve', methods=['POST'])
@@ -314,14 +366,21 @@ def toggle_ban(user_id):
 
 @admin_bp.route('/courses')
 def manage_courses():
-    pending_courses = Course.query.filter_by(approved=False).all()
-    all_courses = Course.query.order_by(Course.id.desc()).all()
-    return render_template('admin/manage_courses.html', pending_courses=pending_courses, all_courses=all_courses)
+    status = request.args.get('status', 'all')
+    query = Course.query.options(joinedload(Course.instructor))
+    if status in ('approved', 'pending'):
+        query = query.filter(Course.approved.is_(status == 'approved'))
+    page = keyset.paginate(query, [Course.id], after=request.args.get('after', type=int),
+                           before=request.args.get('before', type=int), per_page=ADMIN_PAGE_SIZE, descending=True)
+    pending_count = Course.query.filter_by(approved=False).count()
+    return render_template('admin/manage_courses.html', all_courses=page.items, page=page,
+                           pending_count=pending_count, current_status=status)
 
 @admin_bp.route('/course/<int:course_id>/approve', methods=['POST'])
 def approve_course(course_id):
     course = Course.query.get_or_404(course_id)
     course.approved = True
+    catalog_search.sync(course)
     db.session.commit()
     flash(f'Course "{course.title}" has been approved.', 'success')
     return redirect(url_for('admin.manage_courses'))
@@ -350,6 +409,9 @@ def delete_course(course_id):
     )
     db.session.add(log_entry)
 
+    catalog_search.remove(course)
+    if course.chat_room:
+        chat_search.remove_room(course.chat_room.id)
     db.session.delete(course)
     db.session.commit()
     flash(f'Course "{course.title}" has been deleted.', 'success')
@@ -388,15 +450,24 @@ def delete_category(category_id):
 
 @admin_bp.route('/library')
 def manage_library():
-    pending_materials = LibraryMaterial.query.filter_by(approved=False).all()
-    all_materials = LibraryMaterial.query.order_by(LibraryMaterial.id.desc()).all()
-    return render_template('admin/manage_library.html', pending_materials=pending_materials, all_materials=all_materials)
+    status = request.args.get('status', '')
+    query = LibraryMaterial.query.options(joinedload(LibraryMaterial.uploader))
+    if status == 'approved':
+        query = query.filter(LibraryMaterial.approved.is_(True))
+    elif status == 'pending':
+        query = query.filter(LibraryMaterial.approved.is_(False), LibraryMaterial.rejection_reason.is_(None))
+    elif status == 'rejected':
+        query = query.filter(LibraryMaterial.approved.is_(False), LibraryMaterial.rejection_reason.isnot(None))
+    page = keyset.paginate(query, [LibraryMaterial.id], after=request.args.get('after', type=int),
+                           before=request.args.get('before', type=int), per_page=ADMIN_PAGE_SIZE, descending=True)
+    return render_template('admin/manage_library.html', all_materials=page.items, page=page, current_status=status)
 
 @admin_bp.route('/library/<int:material_id>/approve', methods=['POST'])
 def approve_library_material(material_id):
     material = LibraryMaterial.query.get_or_404(material_id)
     material.approved = True
     material.rejection_reason = None # Clear any previous rejection reason
+    catalog_search.sync(material)
     db.session.commit()
     flash(f'Material "{material.title}" has been approved.', 'success')
     return redirect(url_for('admin.manage_library'))
@@ -411,6 +482,7 @@ def reject_library_material(material_id):
 
     material.approved = False
     material.rejection_reason = reason
+    catalog_search.sync(material)
     db.session.commit()
     flash(f'Material "{material.title}" has been rejected.', 'success')
     return redirect(url_for('admin.manage_library'))
@@ -452,6 +524,7 @@ def approve_payment(enrollment_id):
     enrollment = Enrollment.query.get_or_404(enrollment_id)
     enrollment.status = 'approved'
     db.session.commit()
+    room_auth.invalidate(user_id=enrollment.user_id)
     flash(f'Payment for {enrollment.student.name} for course "{enrollment.course.title}" has been approved.', 'success')
     return redirect(url_for('admin.pending_payments'))
 
@@ -466,11 +539,14 @@ def reject_payment(enrollment_id):
     enrollment.status = 'rejected'
     enrollment.rejection_reason = reason
     db.session.commit()
+    room_auth.invalidate(user_id=enrollment.user_id)
     flash(f'Payment for {enrollment.student.name} has been rejected.', 'success')
     return redirect(url_for('admin.pending_payments'))
 
 @admin_bp.route('/payment-proof/<path:filename>')
 def payment_proof(filename):
+    if upload_store.is_stored(filename):
+        return upload_store.send(filename)
     # Handle legacy paths that might still include the directory
     if filename.startswith('payment_proofs/'):
         filename = filename.split('/')[-1]
@@ -481,6 +557,8 @@ def payment_proof(filename):
 @admin_bp.route('/library/<int:material_id>/delete', methods=['POST'])
 def delete_library_material(material_id):
     material = LibraryMaterial.query.get_or_404(material_id)
+    catalog_search.remove(material)
+    upload_store.release(material.file_path)
     db.session.delete(material)
     db.session.commit()
     flash(f'Material "{material.title}" has been deleted.', 'success')
@@ -491,32 +569,53 @@ def manage_certificate_requests():
     pending_requests = CertificateRequest.query.filter_by(status='pending').order_by(CertificateRequest.requested_at).all()
     approved_requests = CertificateRequest.query.filter_by(status='approved').order_by(CertificateRequest.reviewed_at.desc()).limit(20).all()
     rejected_requests = CertificateRequest.query.filter_by(status='rejected').order_by(CertificateRequest.reviewed_at.desc()).limit(20).all()
+    failed_certificates = Certificate.query.filter_by(status='failed').order_by(Certificate.issued_at.desc()).all()
     return render_template('admin/manage_certificate_requests.html',
                            pending_requests=pending_requests,
                            approved_requests=approved_requests,
-                           rejected_requests=rejected_requests)
+                           rejected_requests=rejected_requests,
+                           failed_certificates=failed_certificates)
 
-@admin_bp.route('/certificate-request/<int:request_id>/approve', methods=['POST'])
-def approve_certificate_request(request_id):
-    req = CertificateRequest.query.get_or_404(request_id)
+def _approve_certificate_request(req):
     req.status = 'approved'
     req.reviewed_at = datetime.utcnow()
 
-    import uuid
     new_certificate = Certificate(
         user_id=req.user_id,
         course_id=req.course_id,
         certificate_uid=str(uuid.uuid4()),
         issued_at=datetime.utcnow(),
-        file_path='' # Initialize with empty string to satisfy NOT NULL constraint
+        file_path='' # Set by the renderer once the PDF exists
     )
+    db.session.add(new_certificate)
+    return new_certificate
+
+@admin_bp.route('/certificate-request/<int:request_id>/approve', methods=['POST'])
+def approve_certificate_request(request_id):
+    req = CertificateRequest.query.get_or_404(request_id)
+    new_certificate = _approve_certificate_request(req)
 
-    # Generate the PDF and update the certificate's file_path
-    new_certificate = generate_certificate_pdf(new_certificate, req.user, req.course, current_app)
+    # The PDF is rendered in the background; the student gets the link once it is ready
+    queue_certificates([new_certificate])
+    flash(f'Certificate request for {req.user.name} has been approved and the certificate is being generated.', 'success')
+    return redirect(url_for('admin.manage_certificate_requests'))
 
-    db.session.add(new_certificate)
-    db.session.commit()
-    flash(f'Certificate request for {req.user.name} has been approved and the certificate has been generated.', 'success')
+@admin_bp.route('/certificate-requests/approve-all', methods=['POST'])
+def approve_all_certificate_requests():
+    pending_requests = CertificateRequest.query.filter_by(status='pending').all()
+    new_certificates = [_approve_certificate_request(req) for req in pending_requests]
+    queue_certificates(new_certificates)
+    flash(f'{len(new_certificates)} certificate requests have been approved and the certificates are being generated.', 'success')
+    return redirect(url_for('admin.manage_certificate_requests'))
+
+@admin_bp.route('/certificate/<int:certificate_id>/retry', methods=['POST'])
+def retry_certificate_render(certificate_id):
+    certificate = Certificate.query.get_or_404(certificate_id)
+    if certificate.status != 'failed':
+        flash('Only failed certificates can be retried.', 'warning')
+    else:
+        queue_certificates([certificate])
+        flash(f'Certificate for {certificate.user.name} has been queued for rendering again.', 'success')
     return redirect(url_for('admin.manage_certificate_requests'))
 
 @admin_bp.route('/certificate-request/<int:request_id>/reject', methods=['POST'])
@@ -596,5 +695,11 @@ def reported_messages():
     if current_user.role != 'admin':
         abort(403)
 
-    reports = ReportedMessage.query.order_by(ReportedMessage.timestamp.desc()).all()
-    return render_template('admin/reported_messages.html', reports=reports)
+    query = ReportedMessage.query.options(
+        joinedload(ReportedMessage.reporter),
+        joinedload(ReportedMessage.message).joinedload(ChatMessage.author),
+        joinedload(ReportedMessage.message).joinedload(ChatMessage.room)
+    )
+    page = keyset.paginate(query, [ReportedMessage.timestamp, ReportedMessage.id], after=request.args.get('after', type=int),
+                           before=request.args.get('before', type=int), per_page=ADMIN_PAGE_SIZE, descending=True)
+    return render_template('admin/reported_messages.html', reports=page.items, page=page)
@@ -1,34 +1,9 @@
 from flask import Flask
 from extensions import db, login_manager, socketio
-from models import User, ChatRoom, ChatMessage
+from models import User, ChatRoom, ChatMessage, Course, Comment, Certificate, ExamSubmission, FinalExam
 import os
 import click
 from datetime import datetime, timedelta
-from bs4 import BeautifulSoup
-from markupsafe import Markup
-from flask_migrate import Migrate
-
-def secure_embeds_filter(html_content):
-    if not html_content:
-        return ""
-
-    soup = BeautifulSoup(html_content, 'html.parser')
-    for embed_div in soup.find_all('div', class_='secure-embed'):
-        data_type = embed_div.get('data-type')
-        data_id = embed_div.get('data-id')
-
-        iframe = None
-        if data_type == 'youtube' and data_id:
-            iframe_src = f"https://www.youtube-nocookie.com/embed/{data_id}"
-            iframe = soup.new_tag('iframe', src=iframe_src, width="560", height="315", frameborder="0", allowfullscreen=True)
-        elif data_type == 'gdrive' and data_id:
-            iframe_src = f"https://drive.google.com/file/d/{data_id}/preview"
-            iframe = soup.new_tag('iframe', src=iframe_src, width="100%", height="480")
-
-        if iframe:
-            embed_div.replace_with(iframe)
-
-    return Markup(str(soup))
 
 def create_app(config_object=None):
     app = Flask(__name__)
@@ -41,7 +16,26 @@ def create_app(config_object=None):
             SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(app.instance_path, 'app.db'),
             SQLALCHEMY_TRACK_MODIFICATIONS = False,
             SECRET_KEY = 'dev', # Change for production
-            MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50 MB
+            MAX_CONTENT_LENGTH = 50 * 1024 * 1024,  # 50 MB
+            CHAT_UNREAD_COUNTERS = False,  # Maintain ChatUnreadCounter rows from chat events
+            CHAT_WRITE_BEHIND = False,  # Broadcast chat messages first and persist them in batches
+            CHAT_WRITE_BEHIND_FLUSH_SIZE = 100,  # Messages per batched insert
+            CHAT_WRITE_BEHIND_FLUSH_INTERVAL = 0.5,  # Seconds between background flushes
+            CHAT_WRITE_BEHIND_MAX_BUFFER = 5000,  # Senders flush synchronously once this many are queued
+            CHAT_AUTH_CACHE_TTL = 60,  # Seconds a room authorization decision is cached per process
+            CERTIFICATE_RENDER_WORKERS = 0,  # Certificate PDF worker processes; 0 means one per CPU
+            CERTIFICATE_RENDER_MAX_ATTEMPTS = 3,  # Renders are retried until this many attempts fail
+            EXAM_SUBMISSION_INTAKE = False,  # Acknowledge exam submissions at once and grade them in the background
+            EXAM_GRADING_WORKERS = 4,  # Background grading threads per process
+            EXAM_ANALYTICS_REFRESH_DELAY = 60,  # Seconds between refreshes of newly graded exams' analytics; 0 leaves it to the CLI
+            UPLOAD_STORE_BACKEND = 'local',  # Where upload_store keeps uploaded blobs; see upload_store.BACKENDS
+            IMAGE_VARIANT_WORKERS = 2,  # Background threads rendering uploaded images' variants; 0 renders them inline
+            IMAGE_VARIANT_WIDTHS = (160, 320, 640, 1280),  # Widths in pixels each uploaded image is rendered at
+            DOWNLOAD_URL_TTL = 900,  # Seconds a signed library download link, resumes included, stays valid
+            DOWNLOAD_OFFLOAD = None,  # 'x-sendfile' or 'x-accel-redirect' to have the front server send downloads
+            DOWNLOAD_ACCEL_PREFIX = '/protected-static/',  # nginx internal location aliasing the static folder, for X-Accel-Redirect
+            DOWNLOAD_COUNT_FLUSH_INTERVAL = 30,  # Seconds download counts are batched in memory before being written; 0 writes each at once
+            SECURE_EMBEDS_CACHE_SIZE = 512  # Rendered lesson notes each process keeps; 0 renders them on every view
         )
 
     # Ensure the instance folder exists
@@ -54,6 +48,7 @@ def create_app(config_object=None):
     db.init_app(app)
     login_manager.init_app(app)
     socketio.init_app(app)
+    from flask_migrate import Migrate
     migrate = Migrate(app, db)
     login_manager.login_view = 'main.login'
 
@@ -74,9 +69,18 @@ def create_app(config_object=None):
     # Register chat events
     from chat_events import register_chat_events
     register_chat_events(socketio)
+    if app.config.get('CHAT_WRITE_BEHIND', False):
+        # Created here, on the main thread, so it can flush on SIGTERM
+        from message_writer import MessageWriter
+        app.extensions['message_writer'] = MessageWriter(app)
 
     # Register custom Jinja filters
-    app.jinja_env.filters['secure_embeds'] = secure_embeds_filter
+    from lesson_html import secure_embeds
+    app.jinja_env.filters['secure_embeds'] = secure_embeds
+    from upload_store import url as upload_url
+    app.jinja_env.filters['upload_url'] = upload_url
+    from image_variants import sources as image_sources
+    app.jinja_env.filters['image_sources'] = image_sources
 
     @app.cli.command("init-db")
     def init_db():
@@ -97,11 +101,191 @@ def create_app(config_object=None):
         """Deletes old chat messages from the database."""
         cutoff_date = datetime.utcnow() - timedelta(days=days)
 
+        from upload_store import release
+        old_files = db.session.query(ChatMessage.file_path)\
+            .filter(ChatMessage.timestamp < cutoff_date, ChatMessage.file_path.isnot(None))
+        for file_path, in old_files:
+            release(file_path)
         num_deleted = db.session.query(ChatMessage).filter(ChatMessage.timestamp < cutoff_date).delete()
+        from chat_search import prune
+        prune()
         db.session.commit()
 
         print(f"Deleted {num_deleted} messages older than {days} days.")
 
+    @app.cli.command("rebuild-unread-counters")
+    def rebuild_unread_counters():
+        """Recomputes the stored per-user chat unread counters."""
+        from unread_counts import rebuild_counters
+        num_counters = rebuild_counters()
+        print(f"Rebuilt {num_counters} unread counters.")
+
+    @app.cli.command("rebuild-chat-search")
+    @click.option("--chunk-size", default=1000, type=int, help="Messages indexed per transaction.")
+    def rebuild_chat_search(chunk_size):
+        """Reindexes all chat messages for full-text search."""
+        from chat_search import rebuild_index
+        num_indexed = rebuild_index(chunk_size)
+        print(f"Indexed {num_indexed} chat messages.")
+
+    @app.cli.command("rebuild-catalog-search")
+    def rebuild_catalog_search():
+        """Reindexes approved courses and library materials for catalog search."""
+        from catalog_search import rebuild_index
+        num_indexed = rebuild_index()
+        print(f"Indexed {num_indexed} catalog items.")
+
+    @app.cli.command("render-certificates")
+    def render_certificates():
+        """Renders certificates that are queued, were interrupted mid-render, or failed."""
+        from certificate_renderer import get_renderer, queue_certificates
+        certificates = Certificate.query.filter(Certificate.status.in_(['queued', 'rendering', 'failed'])).all()
+        queue_certificates(certificates)
+        renderer = get_renderer()
+        renderer.wait()
+        renderer.shutdown()
+        num_failed = Certificate.query.filter_by(status='failed').count()
+        print(f"Rendered {len(certificates) - num_failed} certificates, {num_failed} failed.")
+
+    @app.cli.command("render-course-certificates")
+    @click.argument("course_id", type=int)
+    @click.option("--rerender", is_flag=True, help="Also re-render certificates that are already ready.")
+    def render_course_certificates(course_id, rerender):
+        """Renders all of a course's certificates in one batch across the worker pool."""
+        from certificate_renderer import render_course_certificates, get_renderer
+        course = Course.query.get(course_id)
+        if course is None:
+            print(f"Course {course_id} not found.")
+            return
+        rendered, failed = render_course_certificates(course, rerender=rerender)
+        get_renderer().shutdown()
+        print(f"Rendered {rendered} certificates for '{course.title}', {failed} failed.")
+
+    @app.cli.command("benchmark-certificates")
+    @click.option("--count", default=50, type=int, help="Number of sample certificates to render.")
+    def benchmark_certificates(count):
+        """Measures certificate rendering throughput with and without the cached layout."""
+        from certificate_renderer import benchmark, get_renderer
+        timings = benchmark(count)
+        get_renderer().shutdown()
+        for name, seconds in timings.items():
+            print(f"{name:>9}: {seconds:7.2f}s  {count / seconds:8.1f} certificates/s")
+
+    @app.cli.command("benchmark-lesson-html")
+    @click.option("--views", default=200, type=int, help="Renders of each sample lesson.")
+    def benchmark_lesson_html(views):
+        """Measures rendering lesson notes of several sizes with and without the secure_embeds cache."""
+        from lesson_html import benchmark
+        for paragraphs, (size, uncached, cached) in benchmark(views=views).items():
+            print(f"{paragraphs:>5} paragraphs ({size / 1024:7.1f} KB): "
+                  f"parsed {uncached * 1000:8.3f} ms/view, cached {cached * 1000:8.3f} ms/view")
+
+    @app.cli.command("grade-exam-submissions")
+    def grade_exam_submissions():
+        """Grades exam submissions still waiting in the intake queue."""
+        from exam_intake import grade_queued
+        waiting = [submission_id for submission_id, in db.session.query(ExamSubmission.id)
+                   .filter(ExamSubmission.status == 'submitted').order_by(ExamSubmission.submitted_at)]
+        graded = sum(1 for submission_id in waiting if grade_queued(submission_id))
+        print(f"Graded {graded} of {len(waiting)} waiting exam submissions.")
+
+    @app.cli.command("load-test-exam-submissions")
+    @click.option("--count", default=2000, type=int, help="Number of simultaneous submissions.")
+    @click.option("--concurrency", default=200, type=int, help="Requests in flight at once.")
+    @click.option("--questions", default=20, type=int, help="Questions on the generated exam.")
+    @click.option("--database-uri", default=None, help="Scratch database to use instead of a temporary SQLite file. Its tables are dropped afterwards.")
+    def load_test_exam_submissions(count, concurrency, questions, database_uri):
+        """Simulates a deadline burst of exam submissions against a scratch database."""
+        from exam_intake import load_test
+        results = load_test(count, concurrency, questions, database_uri)
+        for name, value in results.items():
+            print(f"{name:>20}: {value:.1f}" if isinstance(value, float) else f"{name:>20}: {value}")
+
+    @app.cli.command("refresh-exam-analytics")
+    @click.option("--all", "refresh_all", is_flag=True, help="Refresh every exam, not only those graded since their last refresh.")
+    def refresh_exam_analytics(refresh_all):
+        """Recomputes item difficulty, discrimination and score histograms of exams."""
+        from exam_analytics import refresh, refresh_stale
+        if refresh_all:
+            exams = FinalExam.query.all()
+            for exam in exams:
+                refresh(exam)
+            print(f"Refreshed analytics of {len(exams)} exams.")
+        else:
+            print(f"Refreshed analytics of {refresh_stale()} stale exams.")
+
+    @app.cli.command("rollup-metrics")
+    @click.option("--days", default=2, type=int, help="Recount this many days, today included. Use 90 to backfill the dashboard trends.")
+    def rollup_metrics(days):
+        """Rolls up the admin dashboard's daily metrics from the base tables."""
+        from metrics_rollup import rollup
+        num_rows = rollup(days)
+        print(f"Stored {num_rows} daily metrics for the last {days} days.")
+
+    @app.cli.command("export")
+    @click.argument("name", type=click.Choice(["users", "enrollments", "gradebook", "chat-transcript", "library-sales"]))
+    @click.option("--format", "export_format", default="csv", type=click.Choice(["csv", "jsonl"]))
+    @click.option("--output", type=click.File("w"), default="-", help="File to write to; standard output by default.")
+    @click.option("--course-id", type=int, help="Only this course's enrollments or gradebook.")
+    @click.option("--room-id", type=int, help="Only this chat room's transcript.")
+    @click.option("--status", help="Only enrollments or library purchases with this status.")
+    def export(name, export_format, output, course_id, room_id, status):
+        """Streams users, enrollments, gradebooks, chat transcripts or library sales as CSV or JSON Lines."""
+        from data_export import EXPORTS, filters, stream
+        options = {'course_id': course_id, 'room_id': room_id, 'status': status}
+        columns, rows = EXPORTS[name](**filters(name, options))
+        for chunk in stream(columns, rows, export_format):
+            output.write(chunk)
+
+    @app.cli.command("prune-uploads")
+    @click.option("--grace-hours", default=1, type=int, help="Keep blobs unreferenced for less than this many hours.")
+    def prune_uploads(grace_hours):
+        """Deletes stored upload blobs that no record references any more."""
+        from upload_store import prune
+        num_pruned = prune(timedelta(hours=grace_hours))
+        print(f"Deleted {num_pruned} unreferenced uploads.")
+
+    @app.cli.command("render-image-variants")
+    @click.option("--retry", is_flag=True, help="Also retry images that failed or whose worker stopped.")
+    def render_image_variants(retry):
+        """Renders the variants of uploaded images still waiting for them."""
+        from image_variants import render_queued
+        num_rendered = render_queued(retry=retry)
+        print(f"Rendered variants of {num_rendered} images.")
+
+    @app.cli.command("backfill-course-ratings")
+    def backfill_course_ratings():
+        """Recomputes every course's stored rating aggregate from its comments."""
+        totals = db.session.query(
+            Comment.course_id, db.func.sum(Comment.rating), db.func.count(Comment.rating)
+        ).filter(Comment.rating.isnot(None)).group_by(Comment.course_id).all()
+
+        Course.query.update({Course.rating_sum: 0, Course.rating_count: 0, Course.rating_avg: 0})
+        if totals:
+            db.session.execute(db.update(Course), [
+                {'id': course_id, 'rating_sum': rating_sum, 'rating_count': rating_count, 'rating_avg': rating_sum / rating_count}
+                for course_id, rating_sum, rating_count in totals
+            ])
+        db.session.commit()
+
+        print(f"Backfilled ratings for {len(totals)} courses.")
+
+    @app.cli.command("profile-startup")
+    @click.option("--limit", default=15, show_default=True, help="Packages and modules to list.")
+    def profile_startup(limit):
+        """Reports how long a fresh process takes to import and build the app, and what it imports."""
+        from startup_profile import profile
+        report = profile(limit)
+        print(f"Import: {report['import']:.3f}s, create_app(): {report['create_app']:.3f}s")
+        print("Slowest packages (own import time of all their modules):")
+        for package, seconds in report['packages']:
+            print(f"  {seconds:8.3f}s  {package}")
+        print("Slowest modules (including what they import):")
+        for module, seconds in report['modules']:
+            print(f"  {seconds:8.3f}s  {module}")
+        if report['deferred']:
+            print(f"Loaded at startup though only needed on first use: {', '.join(report['deferred'])}")
+
     @app.cli.command("create-admin")
     @click.option("--name", required=True, help="The name of the admin user.")
     @click.option("--email", required=True, help="The email address of the admin user.")
@@ -125,8 +309,7 @@ def create_app(config_object=None):
 
     return app
 
-# Create a default app instance for discoverability by Flask CLI
-app = create_app()
-
+# `flask` finds the create_app factory itself, so importing this module builds no app
 if __name__ == '__main__':
+    app = create_app()
     socketio.run(app, debug=True, allow_unsafe_werkzeug=True)
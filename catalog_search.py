@@ -0,0 +1,128 @@
+import re
+from sqlalchemy import DDL, Float, Integer, event, or_, text
+from extensions import db
+from models import Course, LibraryMaterial, Category, User
+
+# One FTS5 table per catalog, rowid = item id, all with the same searchable fields.
+# bm25 weights rank title matches above category and instructor, and those above description.
+FIELDS = ('title', 'description', 'category', 'instructor')
+WEIGHTS = (10.0, 1.0, 3.0, 3.0)
+
+CATALOGS = {
+    Course: {'table': 'course_fts', 'owner': Course.instructor_id},
+    LibraryMaterial: {'table': 'library_fts', 'owner': LibraryMaterial.uploader_id},
+}
+
+for _model, _catalog in CATALOGS.items():
+    event.listen(_model.__table__, 'after_create', DDL(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {_catalog['table']} USING fts5({', '.join(FIELDS)}, tokenize='porter unicode61')"
+    ).execute_if(dialect='sqlite'))
+    event.listen(_model.__table__, 'before_drop', DDL(
+        f"DROP TABLE IF EXISTS {_catalog['table']}"
+    ).execute_if(dialect='sqlite'))
+
+
+def _enabled():
+    """The FTS index only exists on SQLite; other databases fall back to ILIKE filtering."""
+    return db.engine.dialect.name == 'sqlite'
+
+
+def _fts_query(term):
+    """All words must match, the last one as a prefix. Words are quoted so FTS5 operators are taken literally."""
+    words = re.findall(r'\w+', term)
+    if not words:
+        return None
+    terms = ['"%s"' % word for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _documents(model, ids=None):
+    """Rows of (id, title, description, category, instructor) for approved items."""
+    catalog = CATALOGS[model]
+    query = db.session.query(model.id, model.title, model.description, Category.name, User.name)\
+        .join(Category, Category.id == model.category_id)\
+        .join(User, User.id == catalog['owner'])\
+        .filter(model.approved.is_(True))
+    if ids is not None:
+        query = query.filter(model.id.in_(ids))
+    return query.order_by(model.id)
+
+
+def _insert(model, rows):
+    if rows:
+        db.session.execute(text(
+            f"INSERT INTO {CATALOGS[model]['table']} (rowid, {', '.join(FIELDS)}) "
+            f"VALUES (:id, {', '.join(':' + field for field in FIELDS)})"
+        ), [dict(zip(('id',) + FIELDS, row)) for row in rows])
+
+
+def remove(item):
+    """Drops a course or library material from the index. Caller commits."""
+    if not _enabled():
+        return
+    db.session.execute(text(f"DELETE FROM {CATALOGS[type(item)]['table']} WHERE rowid = :id"), {'id': item.id})
+
+
+def sync(item):
+    """
+    Reindexes a course or library material after it is approved, rejected or edited.
+    Only approved items are kept in the index. Caller commits.
+    """
+    if not _enabled():
+        return
+    db.session.flush()
+    remove(item)
+    _insert(type(item), _documents(type(item), [item.id]).all())
+
+
+def rebuild_index(chunk_size=1000):
+    """Reindexes every approved course and library material. Returns the number of items indexed."""
+    if not _enabled():
+        return 0
+    indexed = 0
+    for model, catalog in CATALOGS.items():
+        db.session.execute(text(f"DELETE FROM {catalog['table']}"))
+        last_id = 0
+        while True:
+            rows = _documents(model).filter(model.id > last_id).limit(chunk_size).all()
+            if not rows:
+                break
+            _insert(model, rows)
+            indexed += len(rows)
+            last_id = rows[-1][0]
+    db.session.commit()
+    return indexed
+
+
+def search(query, model, term, rank=True):
+    """
+    Restricts `query` (over `model`) to items matching `term`. With `rank`, results are
+    ordered best match first; otherwise the caller's ordering is left alone.
+    """
+    if not _enabled():
+        catalog = CATALOGS[model]
+        pattern = f'%{term}%'
+        return query.join(Category, Category.id == model.category_id)\
+            .join(User, User.id == catalog['owner'])\
+            .filter(or_(
+                model.title.ilike(pattern),
+                model.description.ilike(pattern),
+                Category.name.ilike(pattern),
+                User.name.ilike(pattern)
+            ))
+
+    match = _fts_query(term)
+    if match is None:
+        return query
+    table = CATALOGS[model]['table']
+    hits = text(
+        f"SELECT rowid AS item_id, bm25({table}, {', '.join(map(str, WEIGHTS))}) AS score "
+        f"FROM {table} WHERE {table} MATCH :match"
+    ).bindparams(match=match).columns(item_id=Integer, score=Float).subquery()
+
+    query = query.join(hits, hits.c.item_id == model.id)
+    if rank:
+        # bm25 scores are negative; lower is a better match
+        query = query.order_by(hits.c.score, model.id)
+    return query
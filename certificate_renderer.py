@@ -0,0 +1,243 @@
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+from flask import current_app
+from extensions import db
+from models import Certificate
+from pdf_generator import (certificate_relative_path, certificate_stylesheet, load_layout,
+                           render_certificate_html, write_certificate_pdf, write_certificate_pdfs)
+
+_renderers_lock = threading.Lock()
+
+
+class CertificateRenderer:
+    """
+    Background queue that renders certificate PDFs in a process pool.
+
+    Certificates move through Certificate.status: 'queued' while waiting, 'rendering' once
+    handed to a worker process, then 'ready' or, after CERTIFICATE_RENDER_MAX_ATTEMPTS
+    failures, 'failed'. At most one job per worker is in flight so the status stays accurate.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.workers = app.config.get('CERTIFICATE_RENDER_WORKERS') or os.cpu_count() or 1
+        self.max_attempts = app.config.get('CERTIFICATE_RENDER_MAX_ATTEMPTS', 3)
+
+        self._queue = queue.Queue()
+        self._slots = threading.Semaphore(self.workers)
+        self._pool = None
+        self._dispatcher = None
+        self._lock = threading.Lock()
+
+    def submit(self, certificate_ids):
+        """Queues certificates (already committed with status 'queued') for rendering."""
+        for certificate_id in certificate_ids:
+            self._queue.put(certificate_id)
+        self._ensure_started()
+
+    def wait(self):
+        """Blocks until every queued certificate, including retries, is ready or failed."""
+        self._queue.join()
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+
+    def render_jobs(self, jobs):
+        """
+        Writes a list of (rendered_html, file_path) across the pool, one chunk per worker so
+        each process reuses its parsed layout. Returns an error message or None per job.
+        """
+        if not jobs:
+            return []
+        self._ensure_started()
+        stylesheet = certificate_stylesheet(self.app)
+        chunk_size = -(-len(jobs) // self.workers)
+        futures = [self._pool.submit(write_certificate_pdfs, jobs[i:i + chunk_size], stylesheet)
+                   for i in range(0, len(jobs), chunk_size)]
+        return [error for future in futures for error in future.result()]
+
+    def render_batch(self, certificates):
+        """
+        Renders certificates right away and records the outcome on each.
+        Returns the number that rendered successfully.
+        """
+        jobs = [
+            (render_certificate_html(certificate, certificate.user, certificate.course, self.app),
+             os.path.join(self.app.static_folder, certificate_relative_path(certificate)))
+            for certificate in certificates
+        ]
+        errors = self.render_jobs(jobs)
+
+        ready = [{'id': certificate.id, 'status': 'ready', 'render_error': None,
+                  'file_path': certificate_relative_path(certificate)}
+                 for certificate, error in zip(certificates, errors) if error is None]
+        failed = [{'id': certificate.id, 'status': 'failed', 'render_error': error,
+                   'render_attempts': certificate.render_attempts + 1}
+                  for certificate, error in zip(certificates, errors) if error is not None]
+        for updates in (ready, failed):
+            if updates:
+                db.session.execute(db.update(Certificate), updates)
+        db.session.commit()
+        return len(ready)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pool is None:
+                # Spawned workers do not inherit the server's threads or open connections.
+                # Each worker parses the stylesheet and loads fonts once, when it starts.
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=load_layout,
+                    initargs=(certificate_stylesheet(self.app),)
+                )
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name='certificate-renderer', daemon=True)
+                self._dispatcher.start()
+
+    def _dispatch(self):
+        while True:
+            certificate_id = self._queue.get()
+            self._slots.acquire()
+            try:
+                self._start(certificate_id)
+            except Exception as e:
+                self._slots.release()
+                self._finish(certificate_id, e)
+
+    def _start(self, certificate_id):
+        with self.app.app_context():
+            certificate = Certificate.query.get(certificate_id)
+            if certificate is None or certificate.status == 'ready':
+                self._slots.release()
+                self._queue.task_done()
+                return
+            certificate.status = 'rendering'
+            rendered_html = render_certificate_html(certificate, certificate.user, certificate.course, self.app)
+            file_path = os.path.join(self.app.static_folder, certificate_relative_path(certificate))
+            db.session.commit()
+
+        future = self._pool.submit(write_certificate_pdf, rendered_html, file_path, certificate_stylesheet(self.app))
+        future.add_done_callback(lambda done: self._on_done(certificate_id, done))
+
+    def _on_done(self, certificate_id, future):
+        self._slots.release()
+        self._finish(certificate_id, future.exception())
+
+    def _finish(self, certificate_id, error):
+        try:
+            with self.app.app_context():
+                certificate = Certificate.query.get(certificate_id)
+                if certificate is None:
+                    return
+                retry = False
+                if error is None:
+                    certificate.status = 'ready'
+                    certificate.file_path = certificate_relative_path(certificate)
+                    certificate.render_error = None
+                else:
+                    certificate.render_attempts += 1
+                    certificate.render_error = str(error)
+                    if certificate.render_attempts < self.max_attempts:
+                        certificate.status = 'queued'
+                        retry = True
+                    else:
+                        certificate.status = 'failed'
+                db.session.commit()
+            # Only once committed, or a worker could finish the retry before this write lands
+            if retry:
+                self._queue.put(certificate_id)
+        except Exception as e:
+            print(f"Error updating certificate {certificate_id}: {e}")
+        finally:
+            self._queue.task_done()
+
+
+def get_renderer():
+    """Returns the current app's CertificateRenderer, creating it on first use."""
+    with _renderers_lock:
+        renderer = current_app.extensions.get('certificate_renderer')
+        if renderer is None:
+            renderer = CertificateRenderer(current_app._get_current_object())
+            current_app.extensions['certificate_renderer'] = renderer
+    return renderer
+
+
+def queue_certificates(certificates):
+    """
+    Marks certificates as queued and hands them to the renderer. Commits, since the
+    renderer loads them from the database.
+    """
+    for certificate in certificates:
+        certificate.status = 'queued'
+        certificate.render_attempts = 0
+        certificate.render_error = None
+    db.session.commit()
+    get_renderer().submit([certificate.id for certificate in certificates])
+
+
+def render_course_certificates(course, rerender=False):
+    """
+    Renders a course's certificates in one call, spread across the worker pool. By default
+    only certificates that are not ready yet are rendered. Returns (rendered, failed).
+    """
+    query = Certificate.query.filter_by(course_id=course.id)
+    if not rerender:
+        query = query.filter(Certificate.status != 'ready')
+    certificates = query.order_by(Certificate.id).all()
+    rendered = get_renderer().render_batch(certificates)
+    return rendered, len(certificates) - rendered
+
+
+def benchmark(count=50):
+    """
+    Renders `count` sample certificates into a temporary folder three ways and returns the
+    seconds each took: 'uncached' parses the stylesheet and fonts for every document,
+    'cached' reuses one parsed layout in this process, 'pool' spreads the batch across
+    the worker pool.
+    """
+    from weasyprint import HTML, CSS
+
+    app = current_app._get_current_object()
+    stylesheet = certificate_stylesheet(app)
+    student = SimpleNamespace(name='Benchmark Student')
+    course = SimpleNamespace(title='Benchmark Course')
+    output_dir = tempfile.mkdtemp(prefix='certificate-benchmark-')
+    try:
+        jobs = []
+        for i in range(count):
+            certificate = SimpleNamespace(certificate_uid=str(uuid.uuid4()), issued_at=datetime.utcnow())
+            jobs.append((render_certificate_html(certificate, student, course, app),
+                         os.path.join(output_dir, f'{i}.pdf')))
+
+        timings = {}
+        started = time.perf_counter()
+        for rendered_html, file_path in jobs:
+            HTML(string=rendered_html).write_pdf(file_path, stylesheets=[CSS(string=stylesheet)])
+        timings['uncached'] = time.perf_counter() - started
+
+        load_layout(stylesheet)
+        started = time.perf_counter()
+        write_certificate_pdfs(jobs, stylesheet)
+        timings['cached'] = time.perf_counter() - started
+
+        renderer = get_renderer()
+        renderer.render_jobs(jobs[:renderer.workers])  # Start and warm up the workers
+        started = time.perf_counter()
+        renderer.render_jobs(jobs)
+        timings['pool'] = time.perf_counter() - started
+        return timings
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
@@ -4,22 +4,21 @@ from extensions import db
 from datetime import datetime
 from models import ChatRoom, ChatRoomMember, ChatMessage, User, Course, MutedUser, ReportedMessage, MessageReaction, UserLastRead, Poll, PollOption, PollVote
 from utils import filter_profanity
+import unread_counts
+import message_writer
+import room_auth
+import chat_search
+import upload_store
+import image_variants
 
 def register_chat_events(socketio):
 
-    def is_user_authorized_for_room(user, room):
-        if user.role == 'admin':
-            return True
-        if room.room_type == 'public':
-            return True
-
-        # Check for course-based access for course rooms
-        if room.room_type == 'course' and room.course_room:
-            if user.id == room.course_room.instructor_id or user.is_enrolled(room.course_room):
-                return True
-
-        # Check for explicit membership
-        return ChatRoomMember.query.filter_by(user_id=user.id, chat_room_id=room.id).count() > 0
+    def get_message(message_id):
+        # A message may still be queued in the write-behind buffer
+        message = ChatMessage.query.get(message_id)
+        if message is None and message_writer.flush_pending():
+            message = ChatMessage.query.get(message_id)
+        return message
 
 
     @socketio.on('join')
@@ -29,7 +28,7 @@ def register_chat_events(socketio):
 
         room_id = data.get('room_id')
         room = ChatRoom.query.get(room_id)
-        if not room or not is_user_authorized_for_room(current_user, room):
+        if not room or not room_auth.is_user_authorized_for_room(current_user, room):
             return
 
         join_room(room_id)
@@ -41,6 +40,7 @@ def register_chat_events(socketio):
         else:
             last_read = UserLastRead(user_id=current_user.id, room_id=room_id, last_read_timestamp=datetime.utcnow())
             db.session.add(last_read)
+        unread_counts.reset_counter(current_user.id, room_id)
         db.session.commit()
 
     @socketio.on('leave')
@@ -60,15 +60,15 @@ def register_chat_events(socketio):
 
             room_id = data.get('room_id')
             content = data.get('content')
-            file_path = data.get('file_path')
+            file_token = data.get('file_token')
             file_name = data.get('file_name')
             replied_to_id = data.get('replied_to_id')
 
-            if not room_id or (not content and not file_path):
+            if not room_id or (not content and not file_token):
                 return
 
             room = ChatRoom.query.get(room_id)
-            if not room or not is_user_authorized_for_room(current_user, room):
+            if not room or not room_auth.is_user_authorized_for_room(current_user, room):
                 return
 
             # Mute check
@@ -89,41 +89,68 @@ def register_chat_events(socketio):
                     emit('error', {'msg': 'This chat room is currently locked.'})
                     return
 
-            filtered_content = filter_profanity(content)
-
-            new_message = ChatMessage(
-                room_id=room.id,
-                user_id=current_user.id,
-                content=filtered_content,
-                file_path=file_path,
-                file_name=file_name,
-                replied_to_id=replied_to_id
-            )
-            db.session.add(new_message)
+            file_path = None
+            if file_token:
+                # Only a file the sender uploaded, and each message holds its own reference
+                file_path = upload_store.acquire(file_token, current_user.id)
+                if file_path is None:
+                    emit('error', {'msg': 'The shared file has expired. Please upload it again.'})
+                    return
 
-            # Update the room's last message timestamp
-            room.last_message_timestamp = new_message.timestamp
+            filtered_content = filter_profanity(content)
 
-            db.session.commit()
+            writer = message_writer.get_writer()
+            if writer:
+                # Broadcast right away; the writer persists the message in the background
+                new_message = writer.enqueue(
+                    room_id=room.id,
+                    user_id=current_user.id,
+                    content=filtered_content,
+                    file_path=file_path,
+                    file_name=file_name,
+                    replied_to_id=replied_to_id
+                )
+                if file_path:
+                    db.session.commit()
+            else:
+                new_message = ChatMessage(
+                    room_id=room.id,
+                    user_id=current_user.id,
+                    content=filtered_content,
+                    file_path=file_path,
+                    file_name=file_name,
+                    replied_to_id=replied_to_id,
+                    timestamp=datetime.utcnow()
+                )
+                db.session.add(new_message)
+                db.session.flush()
+                chat_search.index_message(new_message)
+
+                # Update the room's last message timestamp
+                room.last_message_timestamp = new_message.timestamp
+                unread_counts.record_new_message(room.id, current_user.id)
+
+                db.session.commit()
 
             replied_to_data = None
-            if new_message.replied_to:
+            replied_to = get_message(new_message.replied_to_id) if new_message.replied_to_id else None
+            if replied_to:
                 replied_to_data = {
-                    'user_name': new_message.replied_to.author.name,
-                    'content': new_message.replied_to.content
+                    'user_name': replied_to.author.name,
+                    'content': replied_to.content
                 }
 
             msg_data = {
                 'user_name': current_user.name,
                 'user_id': current_user.id,
-                'user_profile_pic': current_user.profile_pic or 'default.jpg',
+                'user_profile_pic': image_variants.fitting_path(current_user.profile_pic or 'default.jpg', image_variants.AVATAR_WIDTH),
                 'content': new_message.content,
                 'file_path': new_message.file_path,
                 'file_name': new_message.file_name,
                 'timestamp': new_message.timestamp.isoformat() + "Z",
                 'room_id': room.id,
                 'message_id': new_message.id,
-                'is_pinned': new_message.is_pinned,
+                'is_pinned': bool(new_message.is_pinned),
                 'reactions': [], # New messages have no reactions
                 'replied_to': replied_to_data
             }
@@ -139,7 +166,7 @@ def register_chat_events(socketio):
             return
 
         message_id = data.get('message_id')
-        message = ChatMessage.query.get(message_id)
+        message = get_message(message_id)
 
         if not message:
             return
@@ -155,6 +182,9 @@ def register_chat_events(socketio):
         if not (is_admin or is_instructor_of_course or is_author):
             return
 
+        unread_counts.record_deleted_message(message)
+        chat_search.remove_message(message.id)
+        upload_store.release(message.file_path)
         db.session.delete(message)
         db.session.commit()
 
@@ -166,7 +196,7 @@ def register_chat_events(socketio):
             return
 
         message_id = data.get('message_id')
-        message = ChatMessage.query.get(message_id)
+        message = get_message(message_id)
 
         if not message:
             return
@@ -185,7 +215,7 @@ def register_chat_events(socketio):
             return
 
         message_id = data.get('message_id')
-        message = ChatMessage.query.get(message_id)
+        message = get_message(message_id)
 
         if not message:
             return
@@ -235,9 +265,11 @@ def register_chat_events(socketio):
         ).first()
 
         if member_to_remove:
+            removed_user_id = member_to_remove.user_id
             db.session.delete(member_to_remove)
             db.session.commit()
-            emit('member_removed', {'user_id': user_id, 'room_id': room_id}, to=message.room_id)
+            room_auth.invalidate(user_id=removed_user_id, room_id=room.id)
+            emit('member_removed', {'user_id': user_id, 'room_id': room_id}, to=room.id)
 
 
     @socketio.on('react_to_message')
@@ -251,7 +283,7 @@ def register_chat_events(socketio):
         if not message_id or not reaction_emoji:
             return
 
-        message = ChatMessage.query.get(message_id)
+        message = get_message(message_id)
         if not message:
             return
 
@@ -290,12 +322,13 @@ def register_chat_events(socketio):
         message_id = data.get('message_id')
         new_content = data.get('content')
 
-        message = ChatMessage.query.get(message_id)
+        message = get_message(message_id)
         if not message or message.user_id != current_user.id:
             return
 
         message.content = new_content
         message.is_edited = True
+        chat_search.reindex_message(message)
         db.session.commit()
 
         emit('message_edited', {
@@ -314,16 +347,21 @@ def register_chat_events(socketio):
         options = data.get('options')
 
         room = ChatRoom.query.get(room_id)
-        if not room or not is_user_authorized_for_room(current_user, room) or not question or not options or len(options) < 2:
+        if not room or not room_auth.is_user_authorized_for_room(current_user, room) or not question or not options or len(options) < 2:
             return
 
         # Create a chat message to represent the poll
+        writer = message_writer.get_writer()
         poll_message = ChatMessage(
+            id=writer.allocate_id() if writer else None,
             room_id=room.id,
             user_id=current_user.id,
             content=f"Poll: {question}" # Simple text representation
         )
         db.session.add(poll_message)
+        db.session.flush()
+        chat_search.index_message(poll_message)
+        unread_counts.record_new_message(room.id, current_user.id)
         db.session.commit() # Commit to get message ID
 
         new_poll = Poll(
@@ -347,7 +385,7 @@ def register_chat_events(socketio):
             'room_id': room.id,
             'user_id': current_user.id,
             'user_name': current_user.name,
-            'user_profile_pic': current_user.profile_pic or 'default.jpg',
+            'user_profile_pic': image_variants.fitting_path(current_user.profile_pic or 'default.jpg', image_variants.AVATAR_WIDTH),
             'question': new_poll.question,
             'options': [{'id': opt.id, 'text': opt.text, 'votes': 0} for opt in new_poll.options],
             'timestamp': poll_message.timestamp.isoformat() + "Z",
@@ -368,7 +406,7 @@ def register_chat_events(socketio):
         poll = option.poll
         room = poll.room
 
-        if not is_user_authorized_for_room(current_user, room):
+        if not room_auth.is_user_authorized_for_room(current_user, room):
             return
 
         # Check if user has already voted
@@ -0,0 +1,175 @@
+import re
+from markupsafe import escape
+from sqlalchemy import DDL, event, func, text
+from sqlalchemy.orm import joinedload
+from extensions import db
+from models import ChatMessage
+
+# SQLite keeps message text in an FTS5 table whose rowid is the ChatMessage id. Postgres
+# matches against an expression GIN index on chat_message itself, so it needs no syncing.
+FTS_TABLE = 'chat_message_fts'
+PG_CONFIG = 'english'
+PG_INDEX = 'ix_chat_message_content_tsv'
+
+# Placeholders for match boundaries; the snippet is HTML-escaped before they become <mark> tags
+_MARK_START = '\x02'
+_MARK_END = '\x03'
+
+event.listen(ChatMessage.__table__, 'after_create', DDL(
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(content, tokenize='porter unicode61')"
+).execute_if(dialect='sqlite'))
+event.listen(ChatMessage.__table__, 'before_drop', DDL(
+    f"DROP TABLE IF EXISTS {FTS_TABLE}"
+).execute_if(dialect='sqlite'))
+event.listen(ChatMessage.__table__, 'after_create', DDL(
+    f"CREATE INDEX IF NOT EXISTS {PG_INDEX} ON chat_message "
+    f"USING gin (to_tsvector('{PG_CONFIG}', coalesce(content, '')))"
+).execute_if(dialect='postgresql'))
+
+
+def _dialect():
+    return db.engine.dialect.name
+
+
+def _fts_query(query):
+    """
+    Turns free text into an FTS5 query: every word must match, the last one as a prefix
+    so results update while typing. Words are quoted so FTS5 operators are taken literally.
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    terms = ['"%s"' % word for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _highlight(snippet):
+    return str(escape(snippet)).replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+def index_messages(rows):
+    """
+    Adds messages to the search index. `rows` are dicts with 'id' and 'content', as used for
+    bulk inserts. Caller commits.
+    """
+    if _dialect() != 'sqlite':
+        return
+    rows = [{'id': row['id'], 'content': row['content']} for row in rows if row.get('content')]
+    if rows:
+        db.session.execute(text(f"INSERT INTO {FTS_TABLE} (rowid, content) VALUES (:id, :content)"), rows)
+
+
+def index_message(message):
+    """Adds a single flushed ChatMessage to the search index. Caller commits."""
+    index_messages([{'id': message.id, 'content': message.content}])
+
+
+def remove_message(message_id):
+    """Drops a message from the search index. Caller commits."""
+    if _dialect() != 'sqlite':
+        return
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), {'id': message_id})
+
+
+def remove_room(room_id):
+    """
+    Drops a room's messages from the search index; call it before deleting the room, as
+    SQLite reuses the ids of deleted messages. Caller commits.
+    """
+    if _dialect() != 'sqlite':
+        return
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid IN (SELECT id FROM chat_message WHERE room_id = :room_id)"),
+                       {'room_id': room_id})
+
+
+def reindex_message(message):
+    """Replaces the indexed text of an edited message. Caller commits."""
+    remove_message(message.id)
+    index_message(message)
+
+
+def prune():
+    """Drops index entries whose message no longer exists, e.g. after a bulk delete. Caller commits."""
+    if _dialect() != 'sqlite':
+        return
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid NOT IN (SELECT id FROM chat_message)"))
+
+
+def rebuild_index(chunk_size=1000):
+    """
+    Reindexes all chat history in chunks of `chunk_size` messages, committing after each.
+    Returns the number of messages indexed.
+    """
+    if _dialect() == 'postgresql':
+        db.session.execute(text(f"REINDEX INDEX {PG_INDEX}"))
+        db.session.commit()
+        return ChatMessage.query.filter(ChatMessage.content.isnot(None)).count()
+    if _dialect() != 'sqlite':
+        return 0
+
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    db.session.commit()
+
+    indexed = 0
+    last_id = 0
+    while True:
+        chunk = db.session.query(ChatMessage.id, ChatMessage.content)\
+            .filter(ChatMessage.id > last_id)\
+            .order_by(ChatMessage.id)\
+            .limit(chunk_size).all()
+        if not chunk:
+            return indexed
+        index_messages([{'id': message_id, 'content': content} for message_id, content in chunk])
+        db.session.commit()
+        indexed += sum(1 for _, content in chunk if content)
+        last_id = chunk[-1].id
+
+
+def _search_sqlite(room_id, query, limit, offset):
+    match = _fts_query(query)
+    if match is None:
+        return []
+    rows = db.session.execute(text(
+        f"SELECT {FTS_TABLE}.rowid, snippet({FTS_TABLE}, 0, :start, :end, '…', 32) "
+        f"FROM {FTS_TABLE} JOIN chat_message ON chat_message.id = {FTS_TABLE}.rowid "
+        f"WHERE {FTS_TABLE} MATCH :match AND chat_message.room_id = :room_id "
+        f"ORDER BY {FTS_TABLE}.rank LIMIT :limit OFFSET :offset"
+    ), {'start': _MARK_START, 'end': _MARK_END, 'match': match, 'room_id': room_id, 'limit': limit, 'offset': offset})
+    return rows.all()
+
+
+def _search_postgresql(room_id, query, limit, offset):
+    vector = func.to_tsvector(PG_CONFIG, func.coalesce(ChatMessage.content, ''))
+    ts_query = func.websearch_to_tsquery(PG_CONFIG, query)
+    headline = func.ts_headline(
+        PG_CONFIG, ChatMessage.content, ts_query,
+        f'StartSel={_MARK_START}, StopSel={_MARK_END}, MaxWords=32, MinWords=8'
+    )
+    return db.session.query(ChatMessage.id, headline).filter(
+        ChatMessage.room_id == room_id,
+        vector.op('@@')(ts_query)
+    ).order_by(func.ts_rank(vector, ts_query).desc(), ChatMessage.id.desc()).limit(limit).offset(offset).all()
+
+
+def _search_fallback(room_id, query, limit, offset):
+    return db.session.query(ChatMessage.id, ChatMessage.content).filter(
+        ChatMessage.room_id == room_id,
+        ChatMessage.content.ilike(f'%{query}%')
+    ).order_by(ChatMessage.timestamp.desc()).limit(limit).offset(offset).all()
+
+
+def search_messages(room_id, query, limit=20, offset=0):
+    """
+    Searches a room's messages, best matches first.
+    Returns a list of (ChatMessage, highlighted_html) with matched terms wrapped in <mark>.
+    """
+    search = {'sqlite': _search_sqlite, 'postgresql': _search_postgresql}.get(_dialect(), _search_fallback)
+    hits = search(room_id, query, limit, offset)
+    if not hits:
+        return []
+
+    messages = ChatMessage.query.options(joinedload(ChatMessage.author))\
+        .filter(ChatMessage.id.in_([message_id for message_id, _ in hits])).all()
+    messages = {message.id: message for message in messages}
+    return [(messages[message_id], _highlight(snippet or '')) for message_id, snippet in hits if message_id in messages]
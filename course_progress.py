@@ -0,0 +1,143 @@
+from sqlalchemy import func
+from sqlalchemy.orm import contains_eager
+from extensions import db
+from models import Quiz, Assignment, FinalExam, Module, QuizSubmission, AssignmentSubmission, ExamSubmission
+
+PASSING_GRADES = {'a', 'b', 'c', 'pass'}
+
+
+def _latest_submissions(model, owner_column, item_column, user_ids, item_ids, pick=func.max):
+    """
+    Loads one submission per (user, item) pair in a single grouped query.
+    `pick` chooses which row wins when a user has several: max id is the latest attempt.
+    """
+    if not user_ids or not item_ids:
+        return {}
+
+    chosen_ids = db.session.query(pick(model.id)).filter(
+        owner_column.in_(user_ids),
+        item_column.in_(item_ids)
+    ).group_by(owner_column, item_column)
+
+    submissions = model.query.filter(model.id.in_(chosen_ids)).all()
+    return {(getattr(s, owner_column.key), getattr(s, item_column.key)): s for s in submissions}
+
+
+def _build_progress(user_id, course, quizzes, assignments, exam, quiz_subs, assignment_subs, exam_subs):
+    progress = {
+        'quizzes': [],
+        'assignments': [],
+        'final_exam': None,
+        'all_prerequisites_met': True,
+        'can_request_certificate': False,
+        'reasons': []
+    }
+
+    # Check quizzes
+    for quiz in quizzes:
+        latest_submission = quiz_subs.get((user_id, quiz.id))
+        passed = latest_submission and latest_submission.score >= quiz.pass_mark
+        if not passed:
+            progress['all_prerequisites_met'] = False
+            progress['reasons'].append(f"Quiz not passed: {quiz.module.title}")
+        progress['quizzes'].append({'quiz': quiz, 'submission': latest_submission, 'passed': passed})
+
+    # Check assignments
+    for assignment in assignments:
+        submission = assignment_subs.get((user_id, assignment.id))
+        approved = submission and submission.grade and submission.grade.lower() in PASSING_GRADES
+        if not approved:
+            progress['all_prerequisites_met'] = False
+            progress['reasons'].append(f"Assignment not approved: {assignment.title}")
+        progress['assignments'].append({'assignment': assignment, 'submission': submission, 'approved': approved})
+
+    # Check final exam status
+    if course.final_exam_enabled and exam:
+        exam_submission = exam_subs.get((user_id, exam.id))
+        exam_passed = exam_submission and exam_submission.score is not None and exam_submission.score >= exam.pass_mark
+        progress['final_exam'] = {'exam': exam, 'submission': exam_submission, 'passed': exam_passed}
+
+        if progress['all_prerequisites_met'] and exam_passed:
+            progress['can_request_certificate'] = True
+        elif not exam_passed:
+            progress['reasons'].append("Final exam not passed.")
+
+    # If final exam is not enabled, certificate eligibility depends only on prerequisites
+    elif not course.final_exam_enabled:
+        if progress['all_prerequisites_met']:
+            progress['can_request_certificate'] = True
+
+    # Percentage of quizzes passed and assignments approved
+    total_items = len(progress['quizzes']) + len(progress['assignments'])
+    if total_items > 0:
+        completed_items = sum(1 for q in progress['quizzes'] if q['passed'])
+        completed_items += sum(1 for a in progress['assignments'] if a['approved'])
+        progress['percentage'] = (completed_items / total_items) * 100
+    else:
+        progress['percentage'] = 0
+
+    return progress
+
+
+def _load_progress(pairs):
+    """
+    Computes progress for every (user_id, course) pair using a fixed number of queries:
+    quizzes, assignments and final exams for all courses, then the relevant quiz,
+    assignment and exam submissions for all users.
+    Returns {(user_id, course_id): progress}.
+    """
+    if not pairs:
+        return {}
+
+    courses = {course.id: course for _, course in pairs}
+    course_ids = list(courses)
+    user_ids = list({user_id for user_id, _ in pairs})
+
+    quizzes = Quiz.query.join(Quiz.module).options(contains_eager(Quiz.module))\
+        .filter(Module.course_id.in_(course_ids)).order_by(Module.order, Quiz.id).all()
+    assignments = Assignment.query.join(Assignment.module).options(contains_eager(Assignment.module))\
+        .filter(Module.course_id.in_(course_ids)).order_by(Module.order, Assignment.id).all()
+    exams = {exam.course_id: exam for exam in FinalExam.query.filter(FinalExam.course_id.in_(course_ids)).all()}
+
+    quizzes_by_course = {course_id: [] for course_id in course_ids}
+    for quiz in quizzes:
+        quizzes_by_course[quiz.module.course_id].append(quiz)
+    assignments_by_course = {course_id: [] for course_id in course_ids}
+    for assignment in assignments:
+        assignments_by_course[assignment.module.course_id].append(assignment)
+
+    quiz_subs = _latest_submissions(QuizSubmission, QuizSubmission.student_id, QuizSubmission.quiz_id,
+                                    user_ids, [q.id for q in quizzes])
+    # Assignments have a single submission per student that is updated on resubmission
+    assignment_subs = _latest_submissions(AssignmentSubmission, AssignmentSubmission.student_id, AssignmentSubmission.assignment_id,
+                                          user_ids, [a.id for a in assignments], pick=func.min)
+    exam_subs = _latest_submissions(ExamSubmission, ExamSubmission.student_id, ExamSubmission.final_exam_id,
+                                    user_ids, [e.id for e in exams.values()])
+
+    return {
+        (user_id, course.id): _build_progress(
+            user_id, course,
+            quizzes_by_course[course.id], assignments_by_course[course.id], exams.get(course.id),
+            quiz_subs, assignment_subs, exam_subs
+        )
+        for user_id, course in pairs
+    }
+
+
+def get_course_progress(user, course):
+    """
+    Checks a user's progress in a given course and determines eligibility for the final exam and certificate.
+    """
+    return _load_progress([(user.id, course)])[(user.id, course.id)]
+
+
+def get_progress_for_courses(user, courses):
+    """Progress of one user across several courses, keyed by course id."""
+    progress = _load_progress([(user.id, course) for course in courses])
+    return {course_id: data for (_, course_id), data in progress.items()}
+
+
+def get_progress_for_students(course, students):
+    """Progress of a whole class roster in one course, keyed by user id."""
+    progress = _load_progress([(student.id, course) for student in students])
+    return {user_id: data for (user_id, _), data in progress.items()}
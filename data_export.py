@@ -0,0 +1,162 @@
+import csv
+import inspect
+import io
+import json
+from datetime import date, datetime
+from itertools import chain
+from flask import Response, stream_with_context
+from sqlalchemy import literal, null
+from extensions import db
+from models import User, Course, Enrollment, Module, Quiz, QuizSubmission, Assignment, AssignmentSubmission, FinalExam, ExamSubmission, ChatRoom, ChatMessage, LibraryMaterial, LibraryPurchase
+
+FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+BATCH_SIZE = 1000 # Rows fetched per round trip and written per chunk
+# Spreadsheets run a cell starting with one of these as a formula
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _rows(query):
+    """Streams a query's rows in batches; on databases with server-side cursors only one batch is held at a time."""
+    return query.yield_per(BATCH_SIZE)
+
+
+def users():
+    columns = ('id', 'name', 'email', 'role', 'approved', 'is_banned', 'created_at')
+    query = db.session.query(*(getattr(User, column) for column in columns)).order_by(User.id)
+    return columns, _rows(query)
+
+
+def enrollments(course_id=None, status=None):
+    columns = ('id', 'course_id', 'course_title', 'student_id', 'student_name', 'student_email', 'status', 'timestamp')
+    query = db.session.query(Enrollment.id, Course.id, Course.title, User.id, User.name, User.email, Enrollment.status, Enrollment.timestamp)\
+        .join(Course, Course.id == Enrollment.course_id)\
+        .join(User, User.id == Enrollment.user_id)
+    if course_id is not None:
+        query = query.filter(Enrollment.course_id == course_id)
+    if status is not None:
+        query = query.filter(Enrollment.status == status)
+    return columns, _rows(query.order_by(Enrollment.id))
+
+
+def gradebook(course_id=None):
+    """
+    One row per graded item per student: quiz scores, assignment grades and exam scores,
+    for one course or every course. Each kind of item is streamed by its own query.
+    """
+    columns = ('course_id', 'course_title', 'student_id', 'student_name', 'student_email',
+               'item_type', 'item_id', 'item_title', 'score', 'submitted_at')
+
+    def for_course(query):
+        if course_id is not None:
+            query = query.filter(Course.id == course_id)
+        return _rows(query.order_by(Course.id, User.id))
+
+    quizzes = for_course(db.session.query(
+        Course.id, Course.title, User.id, User.name, User.email,
+        literal('quiz'), Quiz.id, Module.title, QuizSubmission.score, null()
+    ).select_from(QuizSubmission).join(User, User.id == QuizSubmission.student_id)
+        .join(Quiz, Quiz.id == QuizSubmission.quiz_id)
+        .join(Module, Module.id == Quiz.module_id).join(Course, Course.id == Module.course_id))
+    assignments = for_course(db.session.query(
+        Course.id, Course.title, User.id, User.name, User.email,
+        literal('assignment'), Assignment.id, Assignment.title, AssignmentSubmission.grade, AssignmentSubmission.submitted_at
+    ).select_from(AssignmentSubmission).join(User, User.id == AssignmentSubmission.student_id)
+        .join(Assignment, Assignment.id == AssignmentSubmission.assignment_id)
+        .join(Module, Module.id == Assignment.module_id).join(Course, Course.id == Module.course_id))
+    exams = for_course(db.session.query(
+        Course.id, Course.title, User.id, User.name, User.email,
+        literal('exam'), FinalExam.id, FinalExam.title, ExamSubmission.score, ExamSubmission.submitted_at
+    ).select_from(ExamSubmission).join(User, User.id == ExamSubmission.student_id)
+        .join(FinalExam, FinalExam.id == ExamSubmission.final_exam_id)
+        .join(Course, Course.id == FinalExam.course_id)
+        .filter(ExamSubmission.status.in_(['pending_review', 'released'])))
+    return columns, chain(quizzes, assignments, exams)
+
+
+def chat_transcript(room_id=None):
+    columns = ('id', 'room_id', 'room_name', 'user_id', 'user_name', 'timestamp', 'content', 'file_name')
+    query = db.session.query(ChatMessage.id, ChatRoom.id, ChatRoom.name, User.id, User.name,
+                             ChatMessage.timestamp, ChatMessage.content, ChatMessage.file_name)\
+        .join(ChatRoom, ChatRoom.id == ChatMessage.room_id)\
+        .join(User, User.id == ChatMessage.user_id)
+    if room_id is not None:
+        # Walks ix_chat_message_room_timestamp_id
+        query = query.filter(ChatMessage.room_id == room_id).order_by(ChatMessage.timestamp, ChatMessage.id)
+    else:
+        query = query.order_by(ChatMessage.id)
+    return columns, _rows(query)
+
+
+def library_sales(status='approved'):
+    columns = ('id', 'material_id', 'material_title', 'price_naira', 'buyer_id', 'buyer_name', 'buyer_email', 'status', 'timestamp')
+    query = db.session.query(LibraryPurchase.id, LibraryMaterial.id, LibraryMaterial.title, LibraryMaterial.price_naira,
+                             User.id, User.name, User.email, LibraryPurchase.status, LibraryPurchase.timestamp)\
+        .join(LibraryMaterial, LibraryMaterial.id == LibraryPurchase.material_id)\
+        .join(User, User.id == LibraryPurchase.user_id)
+    if status is not None:
+        query = query.filter(LibraryPurchase.status == status)
+    return columns, _rows(query.order_by(LibraryPurchase.id))
+
+
+EXPORTS = {
+    'users': users,
+    'enrollments': enrollments,
+    'gradebook': gradebook,
+    'chat-transcript': chat_transcript,
+    'library-sales': library_sales,
+}
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _csv_cell(value):
+    """Quotes text that a spreadsheet would run as a formula, like a user named '=HYPERLINK(...)'."""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def stream(columns, rows, file_format='csv'):
+    """
+    Encodes rows as CSV (with a header) or JSON Lines, yielding a chunk of text every
+    BATCH_SIZE rows so neither the rows nor the output accumulate. CSV text cells that
+    would start a formula are prefixed with an apostrophe.
+    """
+    buffer = io.StringIO()
+    if file_format == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        write = lambda row: writer.writerow([_csv_cell(value) for value in row])
+    else:
+        write = lambda row: buffer.write(json.dumps(dict(zip(columns, row)), default=_json_default) + '\n')
+
+    for n, row in enumerate(rows, 1):
+        write(row)
+        if n % BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def filters(name, args):
+    """
+    The keyword filters an export accepts, read from a mapping such as request.args;
+    *_id filters are converted to int. Raises ValueError for malformed ids.
+    """
+    parameters = inspect.signature(EXPORTS[name]).parameters
+    return {key: int(args[key]) if key.endswith('_id') else args[key]
+            for key in parameters if args.get(key) not in (None, '')}
+
+
+def response(name, file_format, **kwargs):
+    """A streamed download of an export; the queries run as the client reads it."""
+    columns, rows = EXPORTS[name](**kwargs)
+    filename = f"{name}-{datetime.utcnow():%Y%m%d}.{file_format}"
+    return Response(stream_with_context(stream(columns, rows, file_format)), mimetype=FORMATS[file_format],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
@@ -0,0 +1,99 @@
+import atexit
+import threading
+from collections import Counter
+from flask import current_app
+from sqlalchemy import bindparam, update
+from extensions import db, socketio
+from models import LibraryMaterial
+import metrics_rollup
+
+_counters_lock = threading.Lock()
+_materials = LibraryMaterial.__table__
+_increment = update(_materials).where(_materials.c.id == bindparam('material_id'))\
+    .values(download_count=_materials.c.download_count + bindparam('amount'))
+
+
+class DownloadCounter:
+    """
+    Library download counts kept in memory and written every DOWNLOAD_COUNT_FLUSH_INTERVAL
+    seconds, all materials in one executemany, so a popular file's downloads don't queue
+    on its row lock. Counts not yet written when the process is killed are lost; a clean
+    exit writes them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config.get('DOWNLOAD_COUNT_FLUSH_INTERVAL', 30)
+
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._task = None
+        self._running = False
+
+        atexit.register(self.stop)
+
+    def add(self, material_id):
+        with self._lock:
+            self._pending[material_id] += 1
+            if self._task is None:
+                self._running = True
+                self._task = socketio.start_background_task(self._run)
+
+    def flush(self):
+        """Writes the pending counts and the day's 'downloads' metric. Returns the number of downloads written."""
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        if not pending:
+            return 0
+        try:
+            with self.app.app_context():
+                write(pending)
+        except Exception:
+            with self._lock:
+                self._pending.update(pending)
+            raise
+        return sum(pending.values())
+
+    def stop(self):
+        self._running = False
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error writing download counts: {e}")
+
+    def _run(self):
+        while self._running:
+            socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error writing download counts: {e}")
+
+
+def get_counter():
+    """Returns the current app's DownloadCounter, or None when each download is written at once."""
+    if current_app.config.get('DOWNLOAD_COUNT_FLUSH_INTERVAL', 30) <= 0:
+        return None
+    with _counters_lock:
+        counter = current_app.extensions.get('download_counter')
+        if counter is None:
+            counter = DownloadCounter(current_app._get_current_object())
+            current_app.extensions['download_counter'] = counter
+    return counter
+
+
+def write(counts):
+    """Adds {material_id: downloads} to the materials' counts and today's metric. Commits."""
+    db.session.execute(_increment, [{'material_id': material_id, 'amount': amount}
+                                    for material_id, amount in counts.items()])
+    metrics_rollup.record('downloads', amount=sum(counts.values()))
+    db.session.commit()
+
+
+def record(material):
+    """Counts one download of a library material, batched unless the flush interval is 0."""
+    counter = get_counter()
+    if counter is None:
+        write({material.id: 1})
+    else:
+        counter.add(material.id)
@@ -0,0 +1,211 @@
+import atexit
+import math
+import threading
+from collections import Counter
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import and_, case, func, insert, or_, update
+from extensions import db, socketio
+from models import FinalExam, ExamSubmission, Question, Answer, ExamAnalytics, ExamQuestionAnalytics
+import exam_grading
+
+GRADED_STATUSES = ('pending_review', 'released')
+HISTOGRAM_BANDS = 10
+
+_refreshers_lock = threading.Lock()
+
+
+class AnalyticsRefresher:
+    """
+    Refreshes the analytics of exams whose submissions were graded, at most once every
+    EXAM_ANALYTICS_REFRESH_DELAY seconds per process, so a deadline burst of gradings
+    costs one refresh per exam rather than one per submission.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.delay = app.config.get('EXAM_ANALYTICS_REFRESH_DELAY', 60)
+
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._task = None
+        self._running = False
+
+        atexit.register(self.stop)
+
+    def schedule(self, exam_id):
+        with self._lock:
+            self._pending.add(exam_id)
+            if self._task is None:
+                self._running = True
+                self._task = socketio.start_background_task(self._run)
+
+    def refresh_pending(self):
+        """Refreshes every scheduled exam. Returns the number refreshed."""
+        with self._lock:
+            exam_ids = sorted(self._pending)
+            self._pending.clear()
+        with self.app.app_context():
+            for exam_id in exam_ids:
+                exam = db.session.get(FinalExam, exam_id)
+                if exam is not None:
+                    refresh(exam)
+        return len(exam_ids)
+
+    def stop(self):
+        self._running = False
+
+    def _run(self):
+        while self._running:
+            socketio.sleep(self.delay)
+            try:
+                self.refresh_pending()
+            except Exception as e:
+                print(f"Error refreshing exam analytics: {e}")
+
+
+def get_refresher():
+    """Returns the current app's AnalyticsRefresher, or None when refreshes only run from the CLI."""
+    if current_app.config.get('EXAM_ANALYTICS_REFRESH_DELAY', 60) <= 0:
+        return None
+    with _refreshers_lock:
+        refresher = current_app.extensions.get('exam_analytics_refresher')
+        if refresher is None:
+            refresher = AnalyticsRefresher(current_app._get_current_object())
+            current_app.extensions['exam_analytics_refresher'] = refresher
+    return refresher
+
+
+def mark_stale(exam_id):
+    """
+    Notes that an exam has newly graded submissions and schedules a refresh. Only the first
+    grading after a refresh writes, so bursts don't contend on the exam row. Caller commits.
+    """
+    db.session.execute(
+        update(FinalExam).where(FinalExam.id == exam_id, FinalExam.analytics_stale.is_(False)).values(analytics_stale=True)
+    )
+    refresher = get_refresher()
+    if refresher is not None:
+        refresher.schedule(exam_id)
+
+
+def _graded(exam_id):
+    return and_(ExamSubmission.final_exam_id == exam_id,
+                ExamSubmission.status.in_(GRADED_STATUSES),
+                ExamSubmission.score.isnot(None))
+
+
+def _band(score):
+    """0-based histogram band of a 0-100 score, as SQL; 100 falls into the top band."""
+    return case(*[(score < (band + 1) * 100 / HISTOGRAM_BANDS, band) for band in range(HISTOGRAM_BANDS - 1)],
+                else_=HISTOGRAM_BANDS - 1)
+
+
+def _point_biserial(n, n_correct, score_sum, score_sq_sum, correct_score_sum):
+    """Correlation between answering correctly and the exam score, from aggregate sums."""
+    if n < 2 or n_correct in (0, n):
+        return None
+    variance = score_sq_sum / n - (score_sum / n) ** 2
+    if variance <= 0:
+        return None
+    mean_correct = correct_score_sum / n_correct
+    mean_incorrect = (score_sum - correct_score_sum) / (n - n_correct)
+    p = n_correct / n
+    return (mean_correct - mean_incorrect) / math.sqrt(variance) * math.sqrt(p * (1 - p))
+
+
+def _choice_counts(exam_id):
+    """{question_id: {choice: responses}} from grouped queries over answers."""
+    counts = {}
+    graded = _graded(exam_id)
+    single = db.session.query(Answer.question_id, Answer.selected_choice_id, func.count())\
+        .join(ExamSubmission, ExamSubmission.id == Answer.exam_submission_id)\
+        .filter(graded, Answer.selected_choice_id.isnot(None))\
+        .group_by(Answer.question_id, Answer.selected_choice_id)
+    true_false = db.session.query(Answer.question_id, Answer.true_false_answer, func.count())\
+        .join(ExamSubmission, ExamSubmission.id == Answer.exam_submission_id)\
+        .filter(graded, Answer.true_false_answer.isnot(None))\
+        .group_by(Answer.question_id, Answer.true_false_answer)
+    for question_id, choice, count in list(single) + list(true_false):
+        counts.setdefault(question_id, {})[str(choice)] = count
+
+    # Multiple-answer selections are JSON lists, which SQL can't group portably
+    multiple = db.session.query(Answer.question_id, Answer.selected_choices)\
+        .join(ExamSubmission, ExamSubmission.id == Answer.exam_submission_id)\
+        .join(Question, Question.id == Answer.question_id)\
+        .filter(graded, Question.question_type == 'multiple_choice_multiple')
+    tallies = {}
+    for question_id, selected in multiple:
+        tallies.setdefault(question_id, Counter()).update(str(choice_id) for choice_id in selected or [])
+    for question_id, tally in tallies.items():
+        counts[question_id] = dict(tally)
+    return counts
+
+
+def refresh(exam):
+    """
+    Recomputes an exam's analytics with grouped SQL over its graded submissions and stores
+    them in ExamAnalytics and ExamQuestionAnalytics. Commits.
+    """
+    # Cleared first, so submissions graded while this runs mark the exam stale again
+    exam.analytics_stale = False
+    db.session.commit()
+
+    graded = _graded(exam.id)
+    count, score_sum, score_sq_sum, passed = db.session.query(
+        func.count(ExamSubmission.id),
+        func.coalesce(func.sum(ExamSubmission.score), 0),
+        func.coalesce(func.sum(ExamSubmission.score * ExamSubmission.score), 0),
+        func.coalesce(func.sum(case((ExamSubmission.score >= exam.pass_mark, 1), else_=0)), 0)
+    ).filter(graded).one()
+
+    histogram = [0] * HISTOGRAM_BANDS
+    band = _band(ExamSubmission.score)
+    for band_index, band_count in db.session.query(band, func.count()).filter(graded).group_by(band):
+        histogram[band_index] = band_count
+
+    analytics = exam.analytics or ExamAnalytics(exam_id=exam.id)
+    analytics.submissions = count
+    analytics.mean_score = score_sum / count if count else None
+    analytics.score_stddev = math.sqrt(max(score_sq_sum / count - (score_sum / count) ** 2, 0)) if count else None
+    analytics.pass_rate = passed / count * 100 if count else None
+    analytics.score_histogram = histogram
+    analytics.refreshed_at = datetime.utcnow()
+    db.session.add(analytics)
+
+    # Unanswered auto-graded questions count as wrong; manual ones only once marked
+    correct = Answer.marks_awarded >= Question.marks
+    items = db.session.query(
+        Answer.question_id,
+        func.count(),
+        func.sum(case((correct, 1), else_=0)),
+        func.avg(func.coalesce(Answer.marks_awarded, 0)),
+        func.sum(ExamSubmission.score),
+        func.sum(ExamSubmission.score * ExamSubmission.score),
+        func.sum(case((correct, ExamSubmission.score), else_=0))
+    ).join(ExamSubmission, ExamSubmission.id == Answer.exam_submission_id)\
+        .join(Question, Question.id == Answer.question_id)\
+        .filter(graded, or_(Question.question_type.in_(exam_grading.AUTO_GRADED_TYPES), Answer.marks_awarded.isnot(None)))\
+        .group_by(Answer.question_id).all()
+
+    choice_counts = _choice_counts(exam.id)
+    db.session.query(ExamQuestionAnalytics).filter_by(exam_id=exam.id).delete()
+    rows = [
+        {'exam_id': exam.id, 'question_id': question_id, 'responses': n,
+         'percent_correct': n_correct / n * 100, 'mean_marks': mean_marks,
+         'discrimination': _point_biserial(n, n_correct, s, ss, s_correct),
+         'choice_counts': choice_counts.get(question_id)}
+        for question_id, n, n_correct, mean_marks, s, ss, s_correct in items
+    ]
+    if rows:
+        db.session.execute(insert(ExamQuestionAnalytics.__table__), rows)
+    db.session.commit()
+    return analytics
+
+
+def refresh_stale():
+    """Refreshes every exam marked stale. Returns the number refreshed."""
+    exams = FinalExam.query.filter(FinalExam.analytics_stale.is_(True)).all()
+    for exam in exams:
+        refresh(exam)
+    return len(exams)
@@ -0,0 +1,36 @@
+from sqlalchemy.exc import IntegrityError
+from extensions import db
+from models import ExamSubmission
+import exam_grading
+
+
+def write(answers):
+    """
+    Upserts {(submission_id, question_id): fields} for submissions still in progress, and
+    commits. Answers for submissions that were submitted or locked meanwhile are dropped.
+    Returns the number written.
+    """
+    submission_ids = {submission_id for submission_id, _ in answers}
+    open_ids = {submission_id for submission_id, in db.session.query(ExamSubmission.id).filter(
+        ExamSubmission.id.in_(submission_ids), ExamSubmission.status == 'in_progress')}
+    answers = {key: fields for key, fields in answers.items() if key[0] in open_ids}
+    for attempt in range(2):
+        try:
+            exam_grading.save_answers(answers)
+            db.session.commit()
+            return len(answers)
+        except IntegrityError:
+            # Another process inserted one of these answers first; retry as an update
+            db.session.rollback()
+            if attempt:
+                raise
+
+
+def save(submission, form):
+    """
+    Saves the answers present in `form` for an in-progress submission. The exam page only
+    sends the questions changed since its last autosave, every few seconds, so repeated
+    changes to an answer are coalesced in the browser. Returns the number of answers saved.
+    """
+    answers = exam_grading.parse_answers(exam_grading.get_answer_key(submission.final_exam), form)
+    return write({(submission.id, question_id): fields for question_id, fields in answers.items()})
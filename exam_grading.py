@@ -0,0 +1,269 @@
+import threading
+from collections import namedtuple
+from flask import current_app
+from sqlalchemy import and_, func, insert, update
+from extensions import db
+from models import Question, Choice, Answer, Quiz, FinalExam, ExamSubmission
+import exam_analytics
+
+AUTO_GRADED_TYPES = ('multiple_choice_single', 'multiple_choice_multiple', 'true_false')
+ANSWER_FIELDS = ('selected_choice_id', 'selected_choices', 'true_false_answer', 'text_answer')
+# Submissions that are graded and can be marked by hand; grading a later submit would overwrite earlier marks
+GRADABLE_STATUSES = ('pending_review', 'released')
+
+QuestionKey = namedtuple('QuestionKey', 'id question_type marks negative_marking correct_choice_ids true_false_answer')
+# auto_marks: the marks available from auto-graded questions alone
+AnswerKey = namedtuple('AnswerKey', 'questions total_marks auto_marks needs_review')
+
+_keys_lock = threading.Lock()
+
+
+def _cache():
+    """The current app's {(kind, id): (answer_key_version, AnswerKey)} map for exams and quizzes."""
+    return current_app.extensions.setdefault('exam_answer_keys', {})
+
+
+def _owner(assessment):
+    """Cache key and Question foreign key for a FinalExam or Quiz."""
+    if isinstance(assessment, Quiz):
+        return ('quiz', assessment.id), Question.quiz_id
+    return ('exam', assessment.id), Question.exam_id
+
+
+def _load_answer_key(owner_column, owner_id):
+    """Questions with their correct choice ids, in one query."""
+    rows = db.session.query(
+        Question.id, Question.question_type, Question.marks, Question.negative_marking,
+        Question.true_false_answer, Choice.id
+    ).outerjoin(Choice, and_(Choice.question_id == Question.id, Choice.is_correct.is_(True)))\
+        .filter(owner_column == owner_id)\
+        .order_by(Question.id, Choice.id).all()
+
+    questions = {}
+    for question_id, question_type, marks, negative_marking, true_false_answer, choice_id in rows:
+        if question_id not in questions:
+            questions[question_id] = QuestionKey(question_id, question_type, marks, negative_marking or 0, set(), true_false_answer)
+        if choice_id is not None:
+            questions[question_id].correct_choice_ids.add(choice_id)
+
+    questions = [q._replace(correct_choice_ids=frozenset(q.correct_choice_ids)) for q in questions.values()]
+    auto_graded = [q for q in questions if q.question_type in AUTO_GRADED_TYPES]
+    return AnswerKey(questions, sum(q.marks for q in questions), sum(q.marks for q in auto_graded),
+                     len(auto_graded) < len(questions))
+
+
+def get_answer_key(assessment):
+    """
+    Returns the AnswerKey of a FinalExam or Quiz, loading it on first use. Entries are tied
+    to answer_key_version, so a bump made by any process retires them everywhere.
+    """
+    cache = _cache()
+    key, owner_column = _owner(assessment)
+    with _keys_lock:
+        cached = cache.get(key)
+    if cached and cached[0] == assessment.answer_key_version:
+        return cached[1]
+
+    answer_key = _load_answer_key(owner_column, assessment.id)
+    with _keys_lock:
+        cache[key] = (assessment.answer_key_version, answer_key)
+    return answer_key
+
+
+def invalidate(assessment):
+    """
+    Retires the cached answer key of an exam or quiz after its questions or answers change,
+    and refreshes an exam's stored total marks. Caller commits.
+    """
+    assessment.answer_key_version = (assessment.answer_key_version or 0) + 1
+    key, owner_column = _owner(assessment)
+    if isinstance(assessment, FinalExam):
+        assessment.total_marks = db.session.query(func.coalesce(func.sum(Question.marks), 0))\
+            .filter(owner_column == assessment.id).scalar()
+    with _keys_lock:
+        _cache().pop(key, None)
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_answers(answer_key, form):
+    """
+    Reads answers from submitted form data, keyed by question id. Only questions whose
+    q_<id> field is present are included, so partial forms (autosaves) leave the rest alone;
+    an unchecked radio button or checkbox sends no field at all.
+    """
+    answers = {}
+    for question in answer_key.questions:
+        field = f'q_{question.id}'
+        if field not in form:
+            continue
+        answer = dict.fromkeys(ANSWER_FIELDS)
+        if question.question_type == 'multiple_choice_single':
+            answer['selected_choice_id'] = _to_int(form.get(field))
+        elif question.question_type == 'multiple_choice_multiple':
+            answer['selected_choices'] = [cid for cid in map(_to_int, form.getlist(field)) if cid is not None] or None
+        elif question.question_type == 'true_false':
+            tf_answer = form.get(field)
+            answer['true_false_answer'] = (tf_answer == 'True') if tf_answer else None
+        else: # short_answer, essay, file_upload are graded manually
+            answer['text_answer'] = form.get(field)
+        answers[question.id] = answer
+    return answers
+
+
+def mark(question, answer):
+    """
+    Marks for an auto-graded answer: full marks if right, minus the question's negative
+    marking if wrong. None when unanswered or graded manually.
+    """
+    if question.question_type == 'multiple_choice_single':
+        if answer['selected_choice_id'] is None:
+            return None
+        correct = answer['selected_choice_id'] in question.correct_choice_ids
+    elif question.question_type == 'multiple_choice_multiple':
+        if not answer['selected_choices']:
+            return None
+        correct = set(answer['selected_choices']) == question.correct_choice_ids
+    elif question.question_type == 'true_false':
+        if answer['true_false_answer'] is None:
+            return None
+        correct = answer['true_false_answer'] == question.true_false_answer
+    else:
+        return None
+    return question.marks if correct else -question.negative_marking
+
+
+def stored_answers(submission_ids):
+    """Saved answers as {(submission_id, question_id): (answer_id, answer fields)}, in one query."""
+    rows = db.session.query(Answer.exam_submission_id, Answer.question_id, Answer.id,
+                            *(getattr(Answer, field) for field in ANSWER_FIELDS))\
+        .filter(Answer.exam_submission_id.in_(submission_ids)).all()
+    return {(row[0], row[1]): (row[2], dict(zip(ANSWER_FIELDS, row[3:]))) for row in rows}
+
+
+def save_answers(answers, existing=None):
+    """
+    Upserts answers given as {(submission_id, question_id): fields}, where every value has
+    the same keys. `existing` is a stored_answers() result, looked up if not given.
+    Writes with at most one bulk update and one bulk insert. Caller commits.
+    """
+    if not answers:
+        return
+    if existing is None:
+        existing = stored_answers({submission_id for submission_id, _ in answers})
+
+    updates, inserts = [], []
+    for (submission_id, question_id), fields in answers.items():
+        if (submission_id, question_id) in existing:
+            updates.append(dict(fields, id=existing[(submission_id, question_id)][0]))
+        else:
+            inserts.append(dict(fields, exam_submission_id=submission_id, question_id=question_id))
+    if updates:
+        db.session.execute(update(Answer), updates)
+    if inserts:
+        # A Core insert keeps every row's NULL columns, so all rows go out as one executemany
+        db.session.execute(insert(Answer.__table__), inserts)
+
+
+def grade_submission(submission, form):
+    """
+    Scores an exam submission from the submitted form data, which is the whole answer sheet:
+    a question without a field is unanswered, whatever was autosaved for it. Stores every
+    answer with its marks, replacing autosaves, sets submission.score as a percentage, and
+    marks the exam's analytics stale. Returns the AnswerKey used; caller commits.
+    """
+    answer_key = get_answer_key(submission.final_exam)
+    existing = stored_answers([submission.id])
+    submitted = parse_answers(answer_key, form)
+
+    earned = 0
+    answers = {}
+    for question in answer_key.questions:
+        answer = submitted.get(question.id) or dict.fromkeys(ANSWER_FIELDS)
+        marks = mark(question, answer)
+        earned += marks or 0
+        answers[(submission.id, question.id)] = dict(answer, marks_awarded=marks)
+    save_answers(answers, existing)
+
+    earned = max(earned, 0)
+    submission.score = (earned / answer_key.total_marks) * 100 if answer_key.total_marks > 0 else 0
+    exam_analytics.mark_stale(submission.final_exam_id)
+    return answer_key
+
+
+def rescore(exam, submission_ids):
+    """
+    Recomputes submission scores from their answers' marks_awarded, with one aggregate
+    query and one bulk update, and marks the exam's analytics stale. Caller commits.
+    """
+    if not submission_ids:
+        return
+    earned = dict(db.session.query(Answer.exam_submission_id, func.coalesce(func.sum(Answer.marks_awarded), 0))
+                  .filter(Answer.exam_submission_id.in_(submission_ids))
+                  .group_by(Answer.exam_submission_id).all())
+    db.session.execute(update(ExamSubmission), [
+        {'id': submission_id,
+         'score': (max(earned.get(submission_id, 0), 0) / exam.total_marks) * 100 if exam.total_marks > 0 else 0}
+        for submission_id in submission_ids
+    ])
+    exam_analytics.mark_stale(exam.id)
+
+
+def save_grades(exam, grades, grader_id):
+    """
+    Stores manual grades given as {answer_id: (marks, feedback)} with one bulk update and
+    rescores the affected submissions. Returns the ids of rejected answers: not part of this
+    exam or of a graded submission (see GRADABLE_STATUSES), auto-graded, or marked outside
+    0 to the question's marks. Nothing is saved if any are rejected. Caller commits.
+    """
+    answers = db.session.query(Answer.id, Answer.exam_submission_id, Question.question_type, Question.marks)\
+        .join(Question, Question.id == Answer.question_id)\
+        .join(ExamSubmission, ExamSubmission.id == Answer.exam_submission_id)\
+        .filter(Answer.id.in_(list(grades)), Question.exam_id == exam.id,
+                ExamSubmission.status.in_(GRADABLE_STATUSES)).all()
+    found = {answer_id: (submission_id, question_type, marks) for answer_id, submission_id, question_type, marks in answers}
+
+    rejected = [
+        answer_id for answer_id, (marks, _) in grades.items()
+        if answer_id not in found or found[answer_id][1] in AUTO_GRADED_TYPES
+        or (marks is not None and not 0 <= marks <= found[answer_id][2])
+    ]
+    if rejected or not grades:
+        return rejected
+
+    db.session.execute(update(Answer), [
+        {'id': answer_id, 'marks_awarded': marks, 'feedback': feedback, 'graded_by_id': grader_id}
+        for answer_id, (marks, feedback) in grades.items()
+    ])
+    rescore(exam, sorted({found[answer_id][0] for answer_id in grades}))
+    return []
+
+
+def grade_quiz(quiz, form):
+    """
+    Scores a quiz attempt. Returns (score, answers): the percentage of auto-graded marks
+    earned, and the answers given as {question_id: value} for QuizSubmission.answers.
+    Manually graded question types are recorded but do not count towards the score.
+    """
+    answer_key = get_answer_key(quiz)
+    submitted = parse_answers(answer_key, form)
+
+    earned = 0
+    answers = {}
+    for question in answer_key.questions:
+        answer = submitted.get(question.id)
+        if answer is None:
+            continue
+        earned += mark(question, answer) or 0
+        value = next((value for value in answer.values() if value is not None), None)
+        if value is not None:
+            answers[str(question.id)] = value
+
+    earned = max(earned, 0)
+    score = (earned / answer_key.auto_marks) * 100 if answer_key.auto_marks > 0 else 0
+    return score, answers
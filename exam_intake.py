@@ -0,0 +1,239 @@
+import os
+import queue
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import func, insert, update
+from werkzeug.datastructures import MultiDict
+from extensions import db
+from models import ExamSubmission
+import exam_grading
+
+_intakes_lock = threading.Lock()
+
+
+class ExamIntake:
+    """
+    Deferred grading for exam submissions (enabled with EXAM_SUBMISSION_INTAKE).
+
+    submit_exam stores the raw form on the submission with status 'submitted' and returns
+    straight away; EXAM_GRADING_WORKERS threads grade the queue and move each submission
+    to 'pending_review', or to 'released' when nothing needs manual marking and the exam
+    releases scores immediately. The database is the durable queue: submissions still
+    'submitted' after a restart are picked up again when the intake starts.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.workers = max(app.config.get('EXAM_GRADING_WORKERS', 4), 1)
+
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, submission_ids):
+        """Queues submissions (already committed with status 'submitted') for grading."""
+        self._ensure_started()
+        for submission_id in submission_ids:
+            self._queue.put(submission_id)
+
+    def wait(self):
+        """Blocks until every queued submission has been graded or has failed."""
+        self._queue.join()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'exam-grading-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            with self.app.app_context():
+                backlog = [submission_id for submission_id, in db.session.query(ExamSubmission.id)
+                           .filter(ExamSubmission.status == 'submitted').order_by(ExamSubmission.submitted_at)]
+                db.session.remove()
+            for submission_id in backlog:
+                self._queue.put(submission_id)
+
+    def _work(self):
+        while True:
+            submission_id = self._queue.get()
+            try:
+                with self.app.app_context():
+                    grade_queued(submission_id)
+            except Exception as e:
+                # Left as 'submitted'; the next start or `flask grade-exam-submissions` retries it
+                print(f"Error grading exam submission {submission_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+
+def get_intake():
+    """Returns the current app's ExamIntake, or None when submissions are graded inline."""
+    if not current_app.config.get('EXAM_SUBMISSION_INTAKE', False):
+        return None
+    with _intakes_lock:
+        intake = current_app.extensions.get('exam_intake')
+        if intake is None:
+            intake = ExamIntake(current_app._get_current_object())
+            current_app.extensions['exam_intake'] = intake
+    return intake
+
+
+def record_submission(submission, form):
+    """Durably stores a submission's raw answers and queues it for grading. Commits."""
+    submission.submitted_payload = form.to_dict(flat=False)
+    submission.status = 'submitted'
+    submission.submitted_at = datetime.utcnow()
+    db.session.commit()
+    get_intake().submit([submission.id])
+
+
+def grade_queued(submission_id):
+    """
+    Grades one stored submission. Claiming it with a conditional update makes this safe
+    to run from several workers or processes at once: only the first one grades it.
+    Returns True if this call graded the submission.
+    """
+    try:
+        claimed = db.session.execute(
+            update(ExamSubmission)
+            .where(ExamSubmission.id == submission_id, ExamSubmission.status == 'submitted')
+            .values(status='pending_review')
+        ).rowcount
+        if not claimed:
+            db.session.rollback()
+            return False
+
+        submission = db.session.get(ExamSubmission, submission_id)
+        answer_key = exam_grading.grade_submission(submission, MultiDict(submission.submitted_payload or {}))
+        if submission.final_exam.release_scores_immediately and not answer_key.needs_review:
+            submission.status = 'released'
+        submission.submitted_payload = None
+        db.session.commit()
+        return True
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def queue_depth():
+    """
+    Grading backlog for the admin dashboard: how many submissions are waiting and how long
+    the oldest has waited, in seconds.
+    """
+    waiting, oldest = db.session.query(func.count(ExamSubmission.id), func.min(ExamSubmission.submitted_at))\
+        .filter(ExamSubmission.status == 'submitted').one()
+    oldest_seconds = (datetime.utcnow() - oldest).total_seconds() if oldest else 0
+    return {'waiting': waiting, 'oldest_seconds': round(oldest_seconds, 1)}
+
+
+def load_test(count=2000, concurrency=200, questions=20, database_uri=None):
+    """
+    Simulates `count` students submitting the same exam at its deadline against a scratch
+    app with the intake enabled, `concurrency` requests at a time. Uses a temporary SQLite
+    database unless `database_uri` names a scratch database, whose tables are dropped after.
+    Returns acknowledgement latencies and how long the workers took to drain the queue.
+    """
+    from app import create_app
+    from models import User, Category, Course, Enrollment, FinalExam, Question, Choice
+
+    source = current_app._get_current_object()
+    temp_dir = tempfile.mkdtemp(prefix='exam-load-test-')
+
+    class LoadTestConfig:
+        TESTING = True
+        SECRET_KEY = 'load-test'
+        SQLALCHEMY_DATABASE_URI = database_uri or 'sqlite:///' + os.path.join(temp_dir, 'load_test.db')
+        SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'timeout': 60}} if not database_uri else {}
+        EXAM_SUBMISSION_INTAKE = True
+        EXAM_GRADING_WORKERS = source.config.get('EXAM_GRADING_WORKERS', 4)
+
+    app = create_app(LoadTestConfig)
+    try:
+        with app.app_context():
+            db.create_all()
+            instructor = User(name='Load Test Instructor', email='load-test-instructor@example.com', role='instructor', approved=True)
+            instructor.set_password(os.urandom(8).hex())
+            category = Category(name='Load Test')
+            db.session.add_all([instructor, category])
+            db.session.flush()
+            course = Course(title='Load Test Course', instructor_id=instructor.id, category_id=category.id, price_naira=0)
+            db.session.add(course)
+            db.session.flush()
+            exam = FinalExam(course_id=course.id, time_limit_minutes=60, pass_mark=50, is_published=True)
+            db.session.add(exam)
+            db.session.flush()
+
+            answers = {}
+            for i in range(questions):
+                question = Question(exam_id=exam.id, question_text=f'Question {i}', question_type='multiple_choice_single', marks=1)
+                db.session.add(question)
+                db.session.flush()
+                choices = [Choice(question_id=question.id, choice_text=str(n), is_correct=(n == 0)) for n in range(4)]
+                db.session.add_all(choices)
+                db.session.flush()
+                answers[f'q_{question.id}'] = [str(choice.id) for choice in choices]
+
+            password_hash = instructor.password_hash
+            db.session.execute(insert(User), [
+                {'name': f'Student {i}', 'email': f'load-test-{i}@example.com', 'role': 'student',
+                 'approved': True, 'password_hash': password_hash}
+                for i in range(count)
+            ])
+            student_ids = [user_id for user_id, in db.session.query(User.id).filter(User.role == 'student').order_by(User.id)]
+            db.session.execute(insert(Enrollment), [
+                {'user_id': student_id, 'course_id': course.id, 'status': 'approved'} for student_id in student_ids
+            ])
+            db.session.execute(insert(ExamSubmission), [
+                {'final_exam_id': exam.id, 'student_id': student_id, 'status': 'in_progress', 'attempt_number': 1}
+                for student_id in student_ids
+            ])
+            db.session.commit()
+            submissions = db.session.query(ExamSubmission.id, ExamSubmission.student_id).all()
+
+        def submit(submission_id, student_id):
+            client = app.test_client()
+            with client.session_transaction() as session:
+                session['_user_id'] = str(student_id)
+                session['_fresh'] = True
+            # Every student picks a random choice per question
+            data = {field: choices[(submission_id + n) % len(choices)] for n, (field, choices) in enumerate(answers.items())}
+            started = time.perf_counter()
+            response = client.post(f'/exam/{submission_id}/submit', data=data)
+            return time.perf_counter() - started, response.status_code
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda row: submit(*row), submissions))
+        acknowledged = time.perf_counter() - started
+
+        with app.app_context():
+            peak = queue_depth()['waiting']
+            get_intake().wait()
+            drained = time.perf_counter() - started
+            graded = ExamSubmission.query.filter(ExamSubmission.status.in_(['pending_review', 'released'])).count()
+            if database_uri:
+                db.drop_all()
+            db.session.remove()
+
+        latencies = sorted(latency for latency, _ in results)
+        return {
+            'submissions': count,
+            'errors': sum(1 for _, status in results if status != 200),
+            'graded': graded,
+            'waiting_after_acks': peak,
+            'ack_p50_ms': statistics.median(latencies) * 1000,
+            'ack_p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+            'ack_max_ms': latencies[-1] * 1000,
+            'all_acknowledged_s': acknowledged,
+            'all_graded_s': drained,
+        }
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
@@ -0,0 +1,76 @@
+import random
+import threading
+from flask import current_app
+from extensions import db
+from models import Question, Choice
+
+# What students see of a question; correct answers stay in the answer key (exam_grading)
+QUESTION_FIELDS = ('id', 'question_text', 'question_type', 'marks', 'shuffle_choices', 'allowed_file_types', 'max_file_size_kb')
+
+_papers_lock = threading.Lock()
+
+
+def build_paper(exam):
+    """
+    Serializes an exam's questions and choices, in two queries, as
+    {'version': answer_key_version, 'questions': [{...question fields, 'choices': [...]}]}.
+    """
+    questions = [
+        dict(zip(QUESTION_FIELDS, row), choices=[])
+        for row in db.session.query(*(getattr(Question, field) for field in QUESTION_FIELDS))
+            .filter(Question.exam_id == exam.id).order_by(Question.id)
+    ]
+    by_id = {question['id']: question for question in questions}
+    choices = db.session.query(Choice.question_id, Choice.id, Choice.choice_text)\
+        .join(Question, Question.id == Choice.question_id)\
+        .filter(Question.exam_id == exam.id).order_by(Choice.id)
+    for question_id, choice_id, choice_text in choices:
+        by_id[question_id]['choices'].append({'id': choice_id, 'choice_text': choice_text})
+    return {'version': exam.answer_key_version, 'questions': questions}
+
+
+def publish(exam):
+    """Stores a fresh paper on the exam when it is published or its questions change. Caller commits."""
+    exam.paper = build_paper(exam)
+    with _papers_lock:
+        current_app.extensions.setdefault('exam_papers', {})[exam.id] = exam.paper
+
+
+def get_paper(exam):
+    """
+    Returns the exam's current paper from the process cache, falling back to the stored
+    copy. publish() stores a new one whenever the exam's questions change; until it has,
+    a paper is built for the request without being stored. Only reads.
+    """
+    cache = current_app.extensions.setdefault('exam_papers', {})
+    with _papers_lock:
+        paper = cache.get(exam.id)
+    if paper and paper['version'] == exam.answer_key_version:
+        return paper
+
+    paper = exam.paper
+    if not paper or paper['version'] != exam.answer_key_version:
+        return build_paper(exam)
+
+    with _papers_lock:
+        cache[exam.id] = paper
+    return paper
+
+
+def questions_for(paper, exam, submission=None):
+    """
+    The paper's questions in the order a submission sees them. Order and choice order are
+    derived from the submission's shuffle_seed, so they are the same on every reload.
+    """
+    questions = paper['questions']
+    if submission is None or submission.shuffle_seed is None:
+        return questions
+
+    rng = random.Random(submission.shuffle_seed)
+    if exam.shuffle_questions:
+        questions = rng.sample(questions, len(questions))
+    return [
+        dict(question, choices=rng.sample(question['choices'], len(question['choices'])))
+        if question['shuffle_choices'] else question
+        for question in questions
+    ]
@@ -0,0 +1,71 @@
+import os
+from flask import current_app, request, url_for, redirect, abort
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file
+import upload_store
+
+OFFLOAD_HEADERS = {'x-sendfile': 'X-Sendfile', 'x-accel-redirect': 'X-Accel-Redirect'}
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt='file-delivery')
+
+
+def signed_url(path, download_name):
+    """
+    A link to a file relative to the static folder that works without a session for
+    DOWNLOAD_URL_TTL seconds, so resumed and retried downloads skip the access checks
+    and download counting of the route that handed it out.
+    """
+    token = _serializer().dumps([path, download_name])
+    return url_for('main.deliver_file', token=token, filename=download_name)
+
+
+def load(token):
+    """The (path, download_name) a signed link was made for, or None if it is forged or expired."""
+    try:
+        path, download_name = _serializer().loads(token, max_age=current_app.config.get('DOWNLOAD_URL_TTL', 900))
+    except (BadSignature, ValueError):
+        return None
+    return path, download_name
+
+
+def _locate(path):
+    """(filesystem path, strong ETag) of a file relative to the static folder; the ETag of a stored blob is its SHA-256."""
+    if upload_store.is_stored(path):
+        return upload_store.local_path(path), upload_store.content_hash(path)
+    return safe_join(current_app.static_folder, path), None
+
+
+def send(path, download_name):
+    """
+    Sends a file relative to the static folder as an attachment. Range requests resume
+    it and If-None-Match/If-Range revalidate it against its ETag. With DOWNLOAD_OFFLOAD
+    set the front server sends the body, via X-Sendfile or nginx's X-Accel-Redirect to
+    DOWNLOAD_ACCEL_PREFIX, and handles Range itself; this only answers conditional GETs.
+    """
+    filesystem_path, etag = _locate(path)
+    if filesystem_path is None and upload_store.is_stored(path):
+        return redirect(upload_store.url(path))
+    if filesystem_path is None or not os.path.isfile(filesystem_path):
+        abort(404)
+
+    offload = current_app.config.get('DOWNLOAD_OFFLOAD')
+    response = send_file(filesystem_path, request.environ, as_attachment=True, download_name=download_name,
+                         etag=etag or True, conditional=not offload, use_x_sendfile=bool(offload),
+                         response_class=current_app.response_class)
+    if not offload:
+        return response
+
+    response.headers.pop('Content-Length', None)
+    if offload == 'x-accel-redirect':
+        response.headers.pop('X-Sendfile')
+        prefix = current_app.config.get('DOWNLOAD_ACCEL_PREFIX', '/protected-static/')
+        response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + path
+    response.make_conditional(request.environ)
+    if response.status_code == 304:
+        # Some servers would send the file despite the 304
+        for header in OFFLOAD_HEADERS.values():
+            response.headers.pop(header, None)
+    return response
@@ -0,0 +1,269 @@
+import queue
+import threading
+from io import BytesIO
+from flask import current_app, url_for
+from markupsafe import escape
+from sqlalchemy import insert, update
+from extensions import db
+from models import StoredFile, ImageVariant
+import upload_store
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+EXTENSIONS = {'webp': '.webp', 'jpeg': '.jpg', 'png': '.png'}
+QUALITY = 80 # WebP and JPEG encoder quality
+CACHE_SIZE = 10000 # Images whose variants each process keeps in memory
+LESSON_IMAGE_SIZES = '(max-width: 800px) 100vw, 800px'
+AVATAR_WIDTH = 64 # Chat avatars are drawn at up to 40px, so this covers 1.5x screens
+
+_pipelines_lock = threading.Lock()
+_cache_lock = threading.Lock()
+
+
+class ImagePipeline:
+    """
+    Background threads (IMAGE_VARIANT_WORKERS of them) that render the variants of newly
+    uploaded images. Pillow releases the GIL while it decodes, resizes and encodes, so the
+    threads run on several cores. The database is the queue: StoredFile.variants_status is
+    'queued' until a worker claims it, and images still queued after a restart are picked
+    up again when the pipeline starts.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.workers = app.config.get('IMAGE_VARIANT_WORKERS', 2)
+
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, stored_file_ids):
+        """Queues images (already committed with variants_status 'queued') for rendering."""
+        self._ensure_started()
+        for stored_file_id in stored_file_ids:
+            self._queue.put(stored_file_id)
+
+    def wait(self):
+        """Blocks until every queued image has its variants or has failed."""
+        self._queue.join()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'image-variants-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            with self.app.app_context():
+                backlog = [stored_file_id for stored_file_id, in db.session.query(StoredFile.id)
+                           .filter(StoredFile.variants_status == 'queued').order_by(StoredFile.id)]
+                db.session.remove()
+            for stored_file_id in backlog:
+                self._queue.put(stored_file_id)
+
+    def _work(self):
+        while True:
+            stored_file_id = self._queue.get()
+            try:
+                with self.app.app_context():
+                    process(stored_file_id)
+            except Exception as e:
+                # Left as 'processing'; `flask render-image-variants --retry` queues it again
+                print(f"Error rendering variants of stored file {stored_file_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+
+def get_pipeline():
+    """Returns the current app's ImagePipeline, or None when IMAGE_VARIANT_WORKERS is 0 and variants render inline."""
+    if current_app.config.get('IMAGE_VARIANT_WORKERS', 2) <= 0:
+        return None
+    with _pipelines_lock:
+        pipeline = current_app.extensions.get('image_pipeline')
+        if pipeline is None:
+            pipeline = ImagePipeline(current_app._get_current_object())
+            current_app.extensions['image_pipeline'] = pipeline
+    return pipeline
+
+
+def save(file, allowed_extensions=IMAGE_EXTENSIONS, max_size=None):
+    """
+    Stores an uploaded image as it is and queues its variants, so the request only pays
+    for streaming it to disk. Content that was uploaded before reuses its variants.
+    Returns the stored path; raises upload_store.UploadRejected like upload_store.save().
+    Commits, since the workers load the image from the database.
+    """
+    path = upload_store.save(file, allowed_extensions, max_size)
+    stored_file = upload_store.lookup(path)
+    if stored_file.variants_status is None:
+        stored_file.variants_status = 'queued'
+    db.session.commit()
+    if stored_file.variants_status == 'queued':
+        pipeline = get_pipeline()
+        if pipeline is None:
+            process(stored_file.id)
+        else:
+            pipeline.submit([stored_file.id])
+    return path
+
+
+def render(source, widths):
+    """
+    Decodes an image and renders it at each of `widths` no wider than itself, as WebP and
+    as JPEG, or PNG when it has transparency. EXIF orientation is applied and no metadata
+    is written, so camera and location details are stripped. JPEGs are decoded at a
+    reduced scale when the widest variant allows it. Returns [(format, width, height, bytes)].
+    """
+    # Imported here so processes that never render images don't load Pillow
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as image:
+        widest = min(max(widths), max(image.size))
+        image.draft('RGB', (widest, widest))
+        image = ImageOps.exif_transpose(image)
+        transparent = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if transparent else 'RGB')
+
+    renditions = []
+    for width in sorted({min(width, image.width) for width in widths}):
+        height = max(1, round(image.height * width / image.width))
+        resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+        for format in ('webp', 'png' if transparent else 'jpeg'):
+            output = BytesIO()
+            resized.save(output, format=format.upper(), quality=QUALITY, optimize=True)
+            renditions.append((format, width, height, output.getvalue()))
+    return renditions
+
+
+def process(stored_file_id):
+    """
+    Renders and records one queued image's variants, each stored as a blob of its own.
+    Claiming it with a conditional update makes this safe to run from several workers or
+    processes at once. Returns True if this call rendered the image. Commits.
+    """
+    claimed = db.session.execute(
+        update(StoredFile)
+        .where(StoredFile.id == stored_file_id, StoredFile.variants_status == 'queued')
+        .values(variants_status='processing')
+    ).rowcount
+    db.session.commit()
+    if not claimed:
+        return False
+
+    stored_file = db.session.get(StoredFile, stored_file_id)
+    widths = current_app.config.get('IMAGE_VARIANT_WIDTHS', (160, 320, 640, 1280))
+    try:
+        with upload_store.open_stored(upload_store.PREFIX + stored_file.key) as source:
+            renditions = render(source, widths)
+    except Exception as e:
+        print(f"Could not render variants of {stored_file.key}: {e}")
+        stored_file.variants_status = 'failed'
+        db.session.commit()
+        return False
+
+    rows = [{'source_id': stored_file.id, 'format': format, 'width': width, 'height': height,
+             'path': upload_store.save(BytesIO(data), extension=EXTENSIONS[format])}
+            for format, width, height, data in renditions]
+    db.session.execute(insert(ImageVariant.__table__), rows)
+    stored_file.variants_status = 'ready'
+    db.session.commit()
+    return True
+
+
+def render_queued(retry=False):
+    """
+    Renders every queued image inline, as `flask render-image-variants` does. With retry,
+    images a stopped worker left 'processing' and images that failed are queued again
+    first, so run it that way while no workers are running. Returns the number rendered.
+    """
+    if retry:
+        db.session.execute(
+            update(StoredFile).where(StoredFile.variants_status.in_(['processing', 'failed']))
+            .values(variants_status='queued')
+        )
+        db.session.commit()
+    queued = [stored_file_id for stored_file_id, in db.session.query(StoredFile.id)
+              .filter(StoredFile.variants_status == 'queued').order_by(StoredFile.id)]
+    return sum(process(stored_file_id) for stored_file_id in queued)
+
+
+def _variants(path):
+    """
+    A stored image's variants as [(format, width, path)] by width, or [] until they are
+    ready. Variants never change once rendered, so those are cached per process.
+    """
+    if not upload_store.is_stored(path):
+        return []
+    cache = current_app.extensions.setdefault('image_variant_cache', {})
+    with _cache_lock:
+        cached = cache.get(path)
+    if cached is not None:
+        return cached
+
+    variants = db.session.query(ImageVariant.format, ImageVariant.width, ImageVariant.path)\
+        .join(StoredFile, StoredFile.id == ImageVariant.source_id)\
+        .filter(StoredFile.key == path[len(upload_store.PREFIX):], StoredFile.variants_status == 'ready')\
+        .order_by(ImageVariant.width).all()
+    if variants:
+        with _cache_lock:
+            if len(cache) >= CACHE_SIZE:
+                cache.clear()
+            cache[path] = variants
+    return variants
+
+
+def _rendering(path):
+    """Whether a stored image's variants are queued or being rendered; False for failed and legacy images."""
+    stored_file = upload_store.lookup(path)
+    return stored_file is not None and stored_file.variants_status in ('queued', 'processing')
+
+
+def sources(path):
+    """
+    An image's variants for a <picture>, as the `image_sources` filter: {'webp': srcset,
+    'fallback': srcset, 'src': URL of the widest fallback}, or None when it has none.
+    """
+    variants = _variants(path)
+    if not variants:
+        return None
+    srcsets = {'webp': [], 'fallback': []}
+    for format, width, variant_path in variants:
+        srcsets['webp' if format == 'webp' else 'fallback'].append(f'{upload_store.url(variant_path)} {width}w')
+    return {'webp': ', '.join(srcsets['webp']), 'fallback': ', '.join(srcsets['fallback']),
+            'src': srcsets['fallback'][-1].rsplit(' ', 1)[0]}
+
+
+def fitting_path(path, width):
+    """
+    The path of the narrowest JPEG/PNG variant at least `width` pixels wide (or the widest
+    there is), for places that need a single URL; the image's own path until it has variants.
+    """
+    fallbacks = [(variant_width, variant_path) for format, variant_width, variant_path in _variants(path) if format != 'webp']
+    for variant_width, variant_path in fallbacks:
+        if variant_width >= width:
+            return variant_path
+    return fallbacks[-1][1] if fallbacks else path
+
+
+def responsive_image(attrs):
+    """
+    Gives a stored image in rendered lesson HTML its variants. Takes an <img>'s attributes as
+    [(name, value)] and returns (html, pending): html is the <img> wrapped in a <picture>
+    with a WebP source, or None to leave it as it is; pending is whether its variants are
+    queued or being rendered, and so will be there later.
+    """
+    src = dict(attrs).get('src') or ''
+    static_url = url_for('static', filename='')
+    if not src.startswith(static_url):
+        return None, False
+    path = src[len(static_url):]
+    image_sources = sources(path)
+    if image_sources is None:
+        return None, _rendering(path)
+
+    replaced = {'src': image_sources['src'], 'srcset': image_sources['fallback'],
+                'sizes': LESSON_IMAGE_SIZES, 'loading': 'lazy'}
+    attrs = [(name, value) for name, value in attrs if name not in replaced] + list(replaced.items())
+    img = ''.join(f' {name}' if value is None else f' {name}="{escape(value)}"' for name, value in attrs)
+    return (f'<picture><source type="image/webp" srcset="{escape(image_sources["webp"])}" '
+            f'sizes="{LESSON_IMAGE_SIZES}"><img{img}></picture>'), False
@@ -20,8 +20,14 @@ from flask import request, flash, redirect, url_for, current_app, jsonify
 from datetime import datetime
 import json
 import bleach
-from models import Category, LibraryMaterial, Module, Lesson, Assignment, AssignmentSubmission, Quiz, FinalExam, ChatRoom, ChatRoomMember, Question, Choice, ExamSubmission
-from werkzeug.utils import secure_filename
+from models import Category, LibraryMaterial, Module, Lesson, Assignment, AssignmentSubmission, Quiz, FinalExam, ChatRoom, ChatRoomMember, Question, Choice, ExamSubmission, Enrollment, Answer, User, ExamQuestionAnalytics
+from sqlalchemy.orm import joinedload
+from course_progress import get_progress_for_students
+import catalog_search
+import exam_grading
+import exam_paper
+import data_export
+import upload_store
 import os
 from utils import save_editor_image
 
@@ -43,8 +49,12 @@ def dashboard():
 
 @instructor_bp.route('/exams')
 def exam_dashboard():
-    exams = FinalExam.query.join(Course).filter(Course.instructor_id == current_user.id).all()
-    return render_template('instructor/exam_dashboard.html', exams=exams)
+    exams = FinalExam.query.join(Course).filter(Course.instructor_id == current_user.id)\
+        .options(joinedload(FinalExam.course), joinedload(FinalExam.analytics)).all()
+    submission_counts = dict(db.session.query(ExamSubmission.final_exam_id, db.func.count(ExamSubmission.id))
+                             .filter(ExamSubmission.final_exam_id.in_([exam.id for exam in exams]))
+                             .group_by(ExamSubmission.final_exam_id).all())
+    return render_template('instructor/exam_dashboard.html', exams=exams, submission_counts=submission_counts)
 
 @instructor_bp.route('/course/create', methods=['GET', 'POST'])
 def create_course():
@@ -149,6 +159,7 @@ def edit_course(course_id):
     course.title = request.form.get('title', course.title)
     course.description = request.form.get('description', course.description)
     course.final_exam_enabled = request.form.get('final_exam_enabled') == 'on'
+    catalog_search.sync(course)
     db.session.commit()
     flash('Course details updated successfully.')
     return redirect(url_for('instructor.manage_course', course_id=course.id))
@@ -307,6 +318,7 @@ def edit_quiz(quiz_id):
     quiz.calculator_allowed = request.form.get('calculator_allowed') == 'on'
     quiz.randomized_questions = request.form.get('randomized_questions') == 'on'
     quiz.pass_mark = request.form.get('pass_mark', type=int)
+    exam_grading.invalidate(quiz)
     db.session.commit()
 
     flash('Quiz settings updated successfully.', 'success')
@@ -335,16 +347,14 @@ def add_question_to_quiz(quiz_id):
     # Create the question and choices
     new_question = Question(quiz_id=quiz.id, question_text=question_text)
     db.session.add(new_question)
-    db.session.commit()
+    db.session.flush()
 
     new_choices = []
-    for text in choices:
-        choice = Choice(question_id=new_question.id, choice_text=text)
+    for i, text in enumerate(choices):
+        choice = Choice(question_id=new_question.id, choice_text=text, is_correct=(i == correct_choice_index))
         new_choices.append(choice)
     db.session.add_all(new_choices)
-    db.session.commit()
-
-    new_question.correct_choice_id = new_choices[correct_choice_index].id
+    exam_grading.invalidate(quiz)
     db.session.commit()
 
     flash('New question added successfully.', 'success')
@@ -410,6 +420,8 @@ def edit_exam(exam_id):
     exam.release_scores_immediately = request.form.get('release_scores_immediately') == 'on'
     exam.calculator_allowed = request.form.get('calculator_allowed') == 'on'
     exam.retake_allowed = request.form.get('retake_allowed') == 'on'
+    exam_grading.invalidate(exam)
+    exam_paper.publish(exam)
 
     db.session.commit()
 
@@ -430,7 +442,8 @@ def preview_exam(exam_id):
     exam = FinalExam.query.get_or_404(exam_id)
     if exam.course.instructor_id != current_user.id:
         abort(403)
-    return render_template('take_assessment.html', assessment=exam, preview=True, submit_url="#")
+    questions = exam_paper.get_paper(exam)['questions']
+    return render_template('take_assessment.html', assessment=exam, questions=questions, preview=True, submit_url="#")
 
 @instructor_bp.route('/exam/<int:exam_id>/publish', methods=['POST'])
 @login_required
@@ -439,6 +452,7 @@ def publish_exam(exam_id):
     if exam.course.instructor_id != current_user.id:
         abort(403)
     exam.is_published = True
+    exam_paper.publish(exam)
     db.session.commit()
     flash('Exam published successfully.', 'success')
     return redirect(url_for('instructor.manage_exam', exam_id=exam.id))
@@ -474,6 +488,8 @@ def add_question_to_exam(exam_id):
                 return redirect(url_for('instructor.manage_exam', exam_id=exam.id))
 
         db.session.add(new_question)
+        # The commits below change the answer key, including the partial ones on error paths
+        exam_grading.invalidate(exam)
         db.session.commit()
 
         new_choices = []
@@ -514,6 +530,8 @@ def add_question_to_exam(exam_id):
     # For short_answer and essay, no extra data is needed at question creation
 
     db.session.add(new_question)
+    exam_grading.invalidate(exam)
+    exam_paper.publish(exam)
     db.session.commit()
 
     flash('New question added successfully.', 'success')
@@ -526,38 +544,123 @@ def review_exam_submissions(exam_id):
     if exam.course.instructor_id != current_user.id:
         abort(403)
 
-    submissions = exam.submissions.order_by(ExamSubmission.submitted_at.desc()).all()
-    return render_template('instructor/review_submissions.html', exam=exam, submissions=submissions)
+    submissions = exam.submissions.options(joinedload(ExamSubmission.student))\
+        .order_by(ExamSubmission.submitted_at.desc()).all()
+    manual_questions = exam.questions.filter(Question.question_type.notin_(exam_grading.AUTO_GRADED_TYPES))\
+        .order_by(Question.id).all()
+    return render_template('instructor/review_submissions.html', exam=exam, submissions=submissions,
+                           manual_questions=manual_questions)
+
+@instructor_bp.route('/exam/<int:exam_id>/analytics')
+@login_required
+def exam_analytics(exam_id):
+    """Score distribution and item statistics, as last materialized by exam_analytics."""
+    exam = FinalExam.query.get_or_404(exam_id)
+    if exam.course.instructor_id != current_user.id:
+        abort(403)
+
+    item_stats = {row.question_id: row for row in ExamQuestionAnalytics.query.filter_by(exam_id=exam.id)}
+    questions = exam_paper.get_paper(exam)['questions']
+    return render_template('instructor/exam_analytics.html', exam=exam, analytics=exam.analytics,
+                           questions=questions, item_stats=item_stats)
+
+def _read_grades(form, answer_ids):
+    """{answer_id: (marks, feedback)} from marks_<id> and feedback_<id> form fields."""
+    return {
+        answer_id: (form.get(f'marks_{answer_id}', type=float), form.get(f'feedback_{answer_id}'))
+        for answer_id in answer_ids if f'marks_{answer_id}' in form
+    }
 
 @instructor_bp.route('/submission/<int:submission_id>/review', methods=['GET', 'POST'])
 @login_required
 def review_submission(submission_id):
     submission = ExamSubmission.query.get_or_404(submission_id)
-    if submission.final_exam.course.instructor_id != current_user.id:
+    exam = submission.final_exam
+    if exam.course.instructor_id != current_user.id:
         abort(403)
 
+    answers = submission.answers.options(joinedload(Answer.question)).order_by(Answer.question_id).all()
+
     if request.method == 'POST':
-        total_score = 0
-        for answer in submission.answers:
-            if answer.question.question_type in ['short_answer', 'essay', 'file_upload']:
-                marks = request.form.get(f'marks_{answer.id}', type=float)
-                feedback = request.form.get(f'feedback_{answer.id}')
-                answer.marks_awarded = marks
-                answer.feedback = feedback
-                if marks:
-                    total_score += marks
-            else: # Auto-graded questions
-                if answer.marks_awarded:
-                    total_score += answer.marks_awarded
-
-        total_marks = sum(q.marks for q in submission.final_exam.questions)
-        submission.score = (total_score / total_marks) * 100 if total_marks > 0 else 0
+        if submission.status not in exam_grading.GRADABLE_STATUSES:
+            flash('This submission has not been graded yet, so it cannot be marked or released.', 'warning')
+            return redirect(url_for('instructor.review_exam_submissions', exam_id=submission.final_exam_id))
+        manual_ids = [answer.id for answer in answers if answer.question.question_type not in exam_grading.AUTO_GRADED_TYPES]
+        grades = _read_grades(request.form, manual_ids)
+        rejected = exam_grading.save_grades(exam, grades, current_user.id)
+        if rejected:
+            db.session.rollback()
+            flash('Marks must be between 0 and the marks available for the question.', 'danger')
+            return redirect(url_for('instructor.review_submission', submission_id=submission.id))
+        if not grades:
+            # save_grades rescores what it saves; without manual grades the auto-graded marks still count
+            exam_grading.rescore(exam, [submission.id])
         submission.status = 'released'
         db.session.commit()
         flash('Grades have been saved and released to the student.', 'success')
         return redirect(url_for('instructor.review_exam_submissions', exam_id=submission.final_exam_id))
 
-    return render_template('instructor/review_submission.html', submission=submission)
+    return render_template('instructor/review_submission.html', submission=submission, answers=answers)
+
+@instructor_bp.route('/exam/<int:exam_id>/question/<int:question_id>/grade', methods=['GET', 'POST'])
+@login_required
+def grade_question(exam_id, question_id):
+    """Question-major grading: one manually graded question across every submission."""
+    exam = FinalExam.query.get_or_404(exam_id)
+    if exam.course.instructor_id != current_user.id:
+        abort(403)
+    question = Question.query.filter_by(id=question_id, exam_id=exam.id).first_or_404()
+    if question.question_type in exam_grading.AUTO_GRADED_TYPES:
+        abort(404)
+
+    ungraded_only = request.args.get('ungraded') == '1'
+    query = db.session.query(Answer, User.name)\
+        .join(ExamSubmission, ExamSubmission.id == Answer.exam_submission_id)\
+        .join(User, User.id == ExamSubmission.student_id)\
+        .filter(Answer.question_id == question.id, ExamSubmission.status.in_(exam_grading.GRADABLE_STATUSES))
+    if ungraded_only:
+        query = query.filter(Answer.marks_awarded.is_(None))
+    rows = query.order_by(User.name, Answer.id).all()
+
+    if request.method == 'POST':
+        grades = _read_grades(request.form, [answer.id for answer, _ in rows])
+        rejected = exam_grading.save_grades(exam, grades, current_user.id)
+        if rejected:
+            db.session.rollback()
+            flash(f'Marks must be between 0 and {question.marks:g}. No grades were saved.', 'danger')
+        else:
+            db.session.commit()
+            flash(f'Saved grades for {len(grades)} answers.', 'success')
+        return redirect(url_for('instructor.grade_question', exam_id=exam.id, question_id=question.id,
+                                ungraded='1' if ungraded_only else None))
+
+    return render_template('instructor/grade_question.html', exam=exam, question=question, rows=rows,
+                           ungraded_only=ungraded_only)
+
+@instructor_bp.route('/exam/<int:exam_id>/grades', methods=['POST'])
+@login_required
+def save_exam_grades(exam_id):
+    """
+    Bulk grading API. Takes {"grades": [{"answer_id": 1, "marks": 2.5, "feedback": "..."}]}
+    for any manually graded answers of the exam's graded submissions and saves them in one update.
+    """
+    exam = FinalExam.query.get_or_404(exam_id)
+    if exam.course.instructor_id != current_user.id:
+        abort(403)
+
+    data = request.get_json(silent=True) or {}
+    try:
+        grades = {int(grade['answer_id']): (None if grade.get('marks') is None else float(grade['marks']), grade.get('feedback'))
+                  for grade in data.get('grades', [])}
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Each grade needs an answer_id and numeric marks.'}), 400
+
+    rejected = exam_grading.save_grades(exam, grades, current_user.id)
+    if rejected:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': 'Some grades were rejected.', 'rejected': rejected}), 400
+    db.session.commit()
+    return jsonify({'status': 'success', 'graded': len(grades)})
 
 @instructor_bp.route('/submission/<int:submission_id>/release', methods=['POST'])
 @login_required
@@ -565,6 +668,9 @@ def release_submission_results(submission_id):
     submission = ExamSubmission.query.get_or_404(submission_id)
     if submission.final_exam.course.instructor_id != current_user.id:
         abort(403)
+    if submission.status not in exam_grading.GRADABLE_STATUSES:
+        flash('This submission has not been graded yet, so its results cannot be released.', 'warning')
+        return redirect(url_for('instructor.review_exam_submissions', exam_id=submission.final_exam_id))
 
     submission.status = 'released'
     db.session.commit()
@@ -602,24 +708,33 @@ def enrolled_students(course_id):
     course = Course.query.get_or_404(course_id)
     if course.instructor_id != current_user.id:
         abort(403)
-    return render_template('instructor/enrolled_students.html', course=course)
+
+    enrollments = Enrollment.query.filter_by(course_id=course.id, status='approved')\
+        .options(joinedload(Enrollment.student)).order_by(Enrollment.timestamp).all()
+    students = [enrollment.student for enrollment in enrollments]
+    progress_by_student = get_progress_for_students(course, students)
+    roster = [{'student': student, 'progress': progress_by_student[student.id]} for student in students]
+    return render_template('instructor/enrolled_students.html', course=course, roster=roster)
+
+@instructor_bp.route('/course/<int:course_id>/export/<name>.<file_format>')
+def export_course_data(course_id, name, file_format):
+    course = Course.query.get_or_404(course_id)
+    if course.instructor_id != current_user.id:
+        abort(403)
+    if name not in ('gradebook', 'enrollments') or file_format not in data_export.FORMATS:
+        abort(404)
+    kwargs = {'course_id': course.id}
+    if name == 'enrollments':
+        kwargs['status'] = request.args.get('status', 'approved')
+    return data_export.response(name, file_format, **kwargs)
 
 def save_library_file(file):
     allowed_extensions = {'pdf', 'epub', 'txt', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx'}
-    filename = secure_filename(file.filename)
-    if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
+    try:
+        return upload_store.save(file, allowed_extensions)
+    except upload_store.UploadRejected:
         return None
 
-    random_hex = os.urandom(8).hex()
-    _, f_ext = os.path.splitext(filename)
-    new_filename = random_hex + f_ext
-
-    filepath = os.path.join(current_app.root_path, 'static/library', new_filename)
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-
-    file.save(filepath)
-    return os.path.join('library', new_filename)
-
 @instructor_bp.route('/library/submit', methods=['POST'])
 def submit_library_material():
     title = request.form.get('title')
@@ -0,0 +1,40 @@
+from collections import namedtuple
+from sqlalchemy import tuple_
+
+# next_cursor/prev_cursor: ids to pass as `after`/`before` for the neighbouring pages, or None
+KeysetPage = namedtuple('KeysetPage', 'items next_cursor prev_cursor')
+
+
+def paginate(query, sort_columns, after=None, before=None, per_page=50, descending=False):
+    """
+    A page of `query` ordered by `sort_columns`, which must end with the model's id so the
+    order is total. Pages continue from the row whose id is `after`, or end just before
+    the row whose id is `before`, by comparing sort keys; the cost of a page doesn't grow
+    with how deep it is, unlike OFFSET. A cursor whose row was deleted starts over.
+    """
+    id_column = sort_columns[-1]
+    position = tuple_(*sort_columns)
+    forward = before is None
+    cursor = None
+    if after or before:
+        cursor = query.session.query(*sort_columns).filter(id_column == (after or before)).first()
+    if cursor is None:
+        after = before = None
+        forward = True
+
+    if cursor is not None:
+        query = query.filter(position > tuple(cursor) if forward != descending else position < tuple(cursor))
+    ascending = forward != descending
+    query = query.order_by(*(column.asc() if ascending else column.desc() for column in sort_columns))
+    items = query.limit(per_page + 1).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+
+    if not forward:
+        items.reverse()
+    if not items:
+        return KeysetPage(items, None, None)
+    first_id, last_id = getattr(items[0], id_column.key), getattr(items[-1], id_column.key)
+    if forward:
+        return KeysetPage(items, last_id if more else None, first_id if after else None)
+    return KeysetPage(items, last_id, first_id if more else None)
@@ -0,0 +1,200 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from html.parser import HTMLParser
+from flask import current_app
+from markupsafe import Markup, escape
+
+# Lesson notes without either of these have nothing to rewrite and are never parsed
+MARKERS = ('secure-embed', '<img')
+
+_cache_lock = threading.Lock()
+
+
+class _Rewriter(HTMLParser):
+    """
+    Copies lesson HTML through as it is parsed, tag by tag, rewriting only secure-embed
+    placeholders and stored images; everything else is written out as it came in.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.out = []
+        self.pending = 0
+        self._embed_depth = 0 # Open <div>s of a placeholder being replaced, whose contents are dropped
+        self._picture_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self._embed_depth:
+            if tag == 'div':
+                self._embed_depth += 1
+            return
+        if tag == 'div' and self._embed(attrs):
+            self._embed_depth = 1
+            return
+        if tag == 'picture':
+            self._picture_depth += 1
+        elif tag == 'img' and self._image(attrs):
+            return
+        self.out.append(self.get_starttag_text())
+
+    def handle_startendtag(self, tag, attrs):
+        if self._embed_depth or (tag == 'div' and self._embed(attrs)) or (tag == 'img' and self._image(attrs)):
+            return
+        self.out.append(self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        if self._embed_depth:
+            if tag == 'div':
+                self._embed_depth -= 1
+            return
+        if tag == 'picture' and self._picture_depth:
+            self._picture_depth -= 1
+        self.out.append(f'</{tag}>')
+
+    def _embed(self, attrs):
+        """Writes out the iframe of a secure-embed placeholder; False if the <div> isn't one."""
+        attrs = dict(attrs)
+        if 'secure-embed' not in (attrs.get('class') or '').split():
+            return False
+        iframe = _iframe(attrs)
+        if iframe is None:
+            return False
+        self.out.append(iframe)
+        return True
+
+    def _image(self, attrs):
+        """Writes a stored image out with its variants; False to copy the <img> as it is."""
+        if self._picture_depth:
+            return False
+        from image_variants import responsive_image
+        html, pending = responsive_image(attrs)
+        self.pending += pending
+        if html is None:
+            return False
+        self.out.append(html)
+        return True
+
+    def _copy(self, text):
+        if not self._embed_depth:
+            self.out.append(text)
+
+    def handle_data(self, data):
+        self._copy(data)
+
+    def handle_entityref(self, name):
+        self._copy(f'&{name};')
+
+    def handle_charref(self, name):
+        self._copy(f'&#{name};')
+
+    def handle_comment(self, data):
+        self._copy(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self._copy(f'<!{decl}>')
+
+    def handle_pi(self, data):
+        self._copy(f'<?{data}>')
+
+    def unknown_decl(self, data):
+        self._copy(f'<![{data}]>')
+
+
+def _iframe(attrs):
+    """The iframe a secure-embed placeholder stands for, or None for an unknown or empty one."""
+    data_type, data_id = attrs.get('data-type'), attrs.get('data-id')
+    if not data_id:
+        return None
+    if data_type == 'youtube':
+        src = escape(f"https://www.youtube-nocookie.com/embed/{data_id}")
+        return f'<iframe src="{src}" width="560" height="315" frameborder="0" allowfullscreen></iframe>'
+    if data_type == 'gdrive':
+        src = escape(f"https://drive.google.com/file/d/{data_id}/preview")
+        return f'<iframe src="{src}" width="100%" height="480"></iframe>'
+    return None
+
+
+def transform(html_content):
+    """
+    Replaces the secure-embed placeholders in lesson notes with their iframes and gives
+    stored images their responsive variants, in one streaming pass with no document tree.
+    Returns (html, complete), where complete is False while an image's variants are still
+    being rendered.
+    """
+    if not any(marker in html_content for marker in MARKERS):
+        return html_content, True
+
+    rewriter = _Rewriter()
+    rewriter.feed(html_content)
+    rewriter.close()
+    return ''.join(rewriter.out), not rewriter.pending
+
+
+def secure_embeds(html_content):
+    """
+    The `secure_embeds` filter: transform()ed notes, kept in a per-app LRU cache of
+    SECURE_EMBEDS_CACHE_SIZE entries keyed by the notes' SHA-256, so each version of a
+    lesson is parsed once per process rather than on every view. Output with images
+    whose variants are still rendering isn't cached, so it picks them up once ready.
+    """
+    if not html_content:
+        return ""
+    size = current_app.config.get('SECURE_EMBEDS_CACHE_SIZE', 512)
+    if size <= 0:
+        return Markup(transform(html_content)[0])
+
+    key = hashlib.sha256(html_content.encode()).digest()
+    cache = current_app.extensions.setdefault('secure_embeds_cache', OrderedDict())
+    with _cache_lock:
+        cached = cache.get(key)
+        if cached is not None:
+            cache.move_to_end(key)
+            return cached
+
+    html, complete = transform(html_content)
+    rendered = Markup(html)
+    if complete:
+        with _cache_lock:
+            cache[key] = rendered
+            while len(cache) > size:
+                cache.popitem(last=False)
+    return rendered
+
+
+def sample_notes(paragraphs):
+    """Lesson notes like an instructor writes: paragraphs of formatted text with an embed every tenth."""
+    parts = []
+    for i in range(paragraphs):
+        parts.append(f'<h3>Section {i + 1}</h3><p>Some <strong>important</strong> text with a '
+                     f'<a href="https://example.com/{i}">link</a> and <em>emphasis</em>.</p>'
+                     '<ul><li>First point</li><li>Second point</li></ul>')
+        if i % 10 == 0:
+            parts.append(f'<div class="secure-embed" data-type="youtube" data-id="video{i:06d}"></div>')
+    return ''.join(parts)
+
+
+def benchmark(sizes=(10, 100, 1000), views=200):
+    """
+    Renders sample notes of each size (in paragraphs) `views` times, parsed every time and
+    from the warmed cache. Returns {size: (bytes, uncached seconds per view, cached seconds per view)}.
+    """
+    results = {}
+    with current_app.test_request_context():
+        for paragraphs in sizes:
+            notes = sample_notes(paragraphs)
+
+            started = time.perf_counter()
+            for _ in range(views):
+                transform(notes)
+            uncached = (time.perf_counter() - started) / views
+
+            secure_embeds(notes)
+            started = time.perf_counter()
+            for _ in range(views):
+                secure_embeds(notes)
+            cached = (time.perf_counter() - started) / views
+
+            results[paragraphs] = (len(notes.encode()), uncached, cached)
+    return results
@@ -0,0 +1,220 @@
+import atexit
+import signal
+import threading
+from collections import Counter
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import func, insert, update, text
+from sqlalchemy.exc import DataError, IntegrityError
+from extensions import db, socketio
+from models import ChatMessage, ChatRoom
+import unread_counts
+import chat_search
+
+_writers_lock = threading.Lock()
+
+
+class MessageWriter:
+    """
+    Write-behind buffer for chat messages (enabled with CHAT_WRITE_BEHIND).
+
+    Messages get their id and timestamp when queued so they can be broadcast right away,
+    and a background task persists them with batched multi-row inserts. Ids are allocated
+    in-process, so write-behind assumes a single server process handles chat writes.
+
+    Queued messages are flushed when the process exits normally and on SIGTERM, as process
+    managers stop it; one killed outright (SIGKILL, a crash) loses what was still queued,
+    at most CHAT_WRITE_BEHIND_MAX_BUFFER messages. Rows the database rejects, like a reply
+    to a message that does not exist, are dropped and logged rather than retried.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.flush_size = app.config.get('CHAT_WRITE_BEHIND_FLUSH_SIZE', 100)
+        self.flush_interval = app.config.get('CHAT_WRITE_BEHIND_FLUSH_INTERVAL', 0.5)
+        self.max_buffer = app.config.get('CHAT_WRITE_BEHIND_MAX_BUFFER', 5000)
+
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._next_id = None
+        self._task = None
+        self._running = False
+
+        atexit.register(self.stop)
+        self._flush_on_sigterm()
+
+    def _flush_on_sigterm(self):
+        """
+        atexit handlers don't run when SIGTERM kills the process, so flush on it too and then
+        defer to the handler that was there. Signal handlers can only be set from the main
+        thread; create_app() creates the writer there.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def handle(signum, frame):
+            try:
+                self.stop()
+            finally:
+                if callable(previous):
+                    previous(signum, frame)
+                elif previous == signal.SIG_DFL:
+                    raise SystemExit(128 + signum)
+
+        signal.signal(signal.SIGTERM, handle)
+
+    def allocate_id(self):
+        """Returns the next ChatMessage id. Must be used for every message insert while write-behind is on."""
+        with self._buffer_lock:
+            if self._next_id is None:
+                self._next_id = (db.session.query(func.max(ChatMessage.id)).scalar() or 0) + 1
+            message_id = self._next_id
+            self._next_id += 1
+            return message_id
+
+    def enqueue(self, **fields):
+        """
+        Queues a new message and returns it as a transient ChatMessage with id and timestamp set.
+        When the buffer is full the caller flushes a batch itself, which throttles senders to the
+        speed of the database.
+        """
+        row = {
+            'id': self.allocate_id(),
+            'timestamp': datetime.utcnow(),
+            'is_pinned': False,
+            'is_edited': False,
+            'content': None,
+            'file_path': None,
+            'file_name': None,
+            'replied_to_id': None,
+        }
+        row.update(fields)
+
+        while True:
+            with self._buffer_lock:
+                if len(self._buffer) < self.max_buffer:
+                    self._buffer.append(row)
+                    pending = len(self._buffer)
+                    break
+            self.flush()
+
+        self._ensure_task()
+        if pending >= self.flush_size:
+            self._wake.set()
+        return ChatMessage(**row)
+
+    def pending_count(self):
+        with self._buffer_lock:
+            return len(self._buffer)
+
+    def flush(self):
+        """Persists up to flush_size queued messages. Returns the number written."""
+        with self._flush_lock:
+            with self._buffer_lock:
+                batch = self._buffer[:self.flush_size]
+                del self._buffer[:self.flush_size]
+            if not batch:
+                return 0
+
+            written = set()
+            with self.app.app_context():
+                try:
+                    self._write_valid(batch, written)
+                except Exception:
+                    db.session.rollback()
+                    # Put back what wasn't written so it is retried on the next flush
+                    with self._buffer_lock:
+                        self._buffer[:0] = [row for row in batch if row['id'] not in written]
+                    raise
+            return len(written)
+
+    def flush_all(self):
+        """Persists everything that is queued. Returns the number written."""
+        total = 0
+        while self.pending_count():
+            total += self.flush()
+        return total
+
+    def stop(self):
+        """Stops the background task and flushes whatever is still queued."""
+        self._running = False
+        self._wake.set()
+        self.flush_all()
+
+    def _write_valid(self, batch, written):
+        """
+        Writes a batch, adding the ids of committed rows to `written`. A batch the database
+        rejects is written in halves, so one bad row only costs itself.
+        """
+        try:
+            self._write(batch)
+        except (IntegrityError, DataError) as e:
+            db.session.rollback()
+            if len(batch) == 1:
+                print(f"Dropping chat message {batch[0]['id']}: {e}")
+                return
+            middle = len(batch) // 2
+            self._write_valid(batch[:middle], written)
+            self._write_valid(batch[middle:], written)
+            return
+        written.update(row['id'] for row in batch)
+
+    def _write(self, batch):
+        db.session.execute(insert(ChatMessage), batch)
+        chat_search.index_messages(batch)
+
+        latest = {}
+        for row in batch:
+            if row['room_id'] not in latest or row['timestamp'] > latest[row['room_id']]:
+                latest[row['room_id']] = row['timestamp']
+        db.session.execute(update(ChatRoom), [
+            {'id': room_id, 'last_message_timestamp': timestamp} for room_id, timestamp in latest.items()
+        ])
+
+        senders = Counter((row['room_id'], row['user_id']) for row in batch)
+        for (room_id, sender_id), count in senders.items():
+            unread_counts.record_new_message(room_id, sender_id, count)
+
+        if db.engine.dialect.name == 'postgresql':
+            # Explicit ids do not advance the serial sequence
+            db.session.execute(text(
+                "SELECT setval(pg_get_serial_sequence('chat_message', 'id'), (SELECT MAX(id) FROM chat_message))"
+            ))
+        db.session.commit()
+
+    def _ensure_task(self):
+        with self._buffer_lock:
+            if self._task is not None:
+                return
+            self._running = True
+            self._task = socketio.start_background_task(self._run)
+
+    def _run(self):
+        while self._running:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush_all()
+            except Exception as e:
+                print(f"Error flushing chat messages: {e}")
+
+
+def get_writer():
+    """Returns the current app's MessageWriter, or None when write-behind is disabled."""
+    if not current_app.config.get('CHAT_WRITE_BEHIND', False):
+        return None
+    with _writers_lock:
+        writer = current_app.extensions.get('message_writer')
+        if writer is None:
+            writer = MessageWriter(current_app._get_current_object())
+            current_app.extensions['message_writer'] = writer
+    return writer
+
+
+def flush_pending():
+    """Persists any queued messages so reads see them. No-op when write-behind is disabled."""
+    writer = get_writer()
+    return writer.flush_all() if writer else 0
@@ -0,0 +1,121 @@
+from datetime import date, datetime, timedelta
+from sqlalchemy import func, insert, update
+from sqlalchemy.exc import IntegrityError
+from extensions import db
+from models import User, Course, Enrollment, ChatMessage, ExamSubmission, DailyMetric
+
+# Counted per day from the rows' own timestamps: metric -> (timestamp column, dimension column)
+DAILY_COUNTS = {
+    'signups': (User.created_at, User.role),
+    'enrollments': (Enrollment.timestamp, Enrollment.status),
+    'chat_messages': (ChatMessage.timestamp, ChatMessage.room_id),
+    'exam_submissions': (ExamSubmission.submitted_at, None),
+}
+# Running totals snapshotted on the day of each rollup: metric -> (counted column, dimension column)
+TOTALS = {
+    'users_total': (User.id, User.role),
+    'courses_total': (Course.id, None),
+    'enrollments_total': (Enrollment.id, Enrollment.status),
+}
+# Recorded as they happen by record(), as nothing else keeps a dated trail of them
+RECORDED = ('downloads',)
+TREND_METRICS = tuple(DAILY_COUNTS) + RECORDED
+
+def _as_date(value):
+    """func.date() gives a date on most databases but an ISO string on SQLite."""
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+def record(metric, dimension='', amount=1):
+    """Adds `amount` to today's counter of a recorded metric. Caller commits."""
+    day = datetime.utcnow().date()
+    counter = update(DailyMetric)\
+        .where(DailyMetric.metric == metric, DailyMetric.day == day, DailyMetric.dimension == dimension)\
+        .values(value=DailyMetric.value + amount)
+    if db.session.execute(counter).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(DailyMetric.__table__), [
+                {'day': day, 'metric': metric, 'dimension': dimension, 'value': amount}
+            ])
+    except IntegrityError:
+        # Another request created today's row first
+        db.session.execute(counter)
+
+
+def rollup(days=2):
+    """
+    Recounts the daily metrics of the last `days` days, today included, and snapshots
+    today's totals, replacing earlier rollups of those days. The timestamp columns are
+    indexed, so each count is a range scan over the days being rolled up. Commits.
+    """
+    today = datetime.utcnow().date()
+    start = today - timedelta(days=max(days, 1) - 1)
+
+    rows = []
+    for metric, (timestamp, dimension) in DAILY_COUNTS.items():
+        group = [func.date(timestamp)] + ([dimension] if dimension is not None else [])
+        query = db.session.query(func.count(), *group).filter(timestamp >= datetime.combine(start, datetime.min.time()))
+        for count, day, *value in query.group_by(*group):
+            rows.append({'day': _as_date(day), 'metric': metric,
+                         'dimension': str(value[0]) if value and value[0] is not None else '', 'value': count})
+
+    for metric, (counted, dimension) in TOTALS.items():
+        if dimension is None:
+            rows.append({'day': today, 'metric': metric, 'dimension': '', 'value': db.session.query(func.count(counted)).scalar()})
+            continue
+        for value, count in db.session.query(dimension, func.count(counted)).group_by(dimension):
+            rows.append({'day': today, 'metric': metric, 'dimension': str(value) if value is not None else '', 'value': count})
+
+    DailyMetric.query.filter(DailyMetric.metric.in_(list(DAILY_COUNTS)), DailyMetric.day >= start)\
+        .delete(synchronize_session=False)
+    DailyMetric.query.filter(DailyMetric.metric.in_(list(TOTALS)), DailyMetric.day == today)\
+        .delete(synchronize_session=False)
+    if rows:
+        db.session.execute(insert(DailyMetric.__table__), rows)
+    db.session.commit()
+    return len(rows)
+
+
+def rolled_up_on():
+    """The day of the latest totals snapshot, or None if metrics were never rolled up."""
+    return db.session.query(func.max(DailyMetric.day)).filter(DailyMetric.metric.in_(list(TOTALS))).scalar()
+
+
+def totals():
+    """The latest snapshot of every running total, as {metric: {dimension: value}}."""
+    latest = rolled_up_on()
+    snapshot = {metric: {} for metric in TOTALS}
+    rows = DailyMetric.query.with_entities(DailyMetric.metric, DailyMetric.dimension, DailyMetric.value)\
+        .filter(DailyMetric.metric.in_(list(TOTALS)), DailyMetric.day == latest)
+    for metric, dimension, value in rows:
+        snapshot[metric][dimension] = value
+    return snapshot
+
+
+def trends(days=90):
+    """
+    Daily series of the trend metrics over the last `days` days, summed over dimensions:
+    {'labels': [ISO dates], 'series': {metric: [value per day]}}, in one query.
+    """
+    today = datetime.utcnow().date()
+    start = today - timedelta(days=days - 1)
+    labels = [start + timedelta(days=n) for n in range(days)]
+    series = {metric: dict.fromkeys(labels, 0) for metric in TREND_METRICS}
+    rows = db.session.query(DailyMetric.day, DailyMetric.metric, func.sum(DailyMetric.value))\
+        .filter(DailyMetric.metric.in_(TREND_METRICS), DailyMetric.day >= start)\
+        .group_by(DailyMetric.day, DailyMetric.metric)
+    for day, metric, value in rows:
+        series[metric][day] = value
+    return {'labels': [day.isoformat() for day in labels],
+            'series': {metric: list(values.values()) for metric, values in series.items()}}
+
+
+def top_dimensions(metric, days=90, limit=5):
+    """The `limit` dimensions with the highest totals of a metric over the last `days` days."""
+    start = datetime.utcnow().date() - timedelta(days=days - 1)
+    total = func.sum(DailyMetric.value)
+    return db.session.query(DailyMetric.dimension, total)\
+        .filter(DailyMetric.metric == metric, DailyMetric.day >= start)\
+        .group_by(DailyMetric.dimension).order_by(total.desc()).limit(limit).all()
@@ -90,9 +90,20 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
+    # the search indexes (chat_search.py, catalog_search.py) are created outside
+    # the models, so keep autogenerate from proposing to drop them
+    def include_object(object, name, type_, reflected, compare_to):
+        if reflected and type_ == 'table' and name.startswith(('chat_message_fts', 'course_fts', 'library_fts')):
+            return False
+        if reflected and type_ == 'index' and name == 'ix_chat_message_content_tsv':
+            return False
+        return True
+
     conf_args = current_app.extensions['migrate'].configure_args
     if conf_args.get("process_revision_directives") is None:
         conf_args["process_revision_directives"] = process_revision_directives
+    if conf_args.get("include_object") is None:
+        conf_args["include_object"] = include_object
 
     connectable = get_engine()
 
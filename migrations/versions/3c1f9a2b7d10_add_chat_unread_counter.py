@@ -0,0 +1,39 @@
+"""Add chat_unread_counter table
+
+Revision ID: 3c1f9a2b7d10
+Revises: da444f06d509
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1f9a2b7d10'
+down_revision = 'da444f06d509'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Create the per-(user, room) unread counter table.
+    """
+    op.create_table('chat_unread_counter',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('room_id', sa.Integer(), nullable=False),
+    sa.Column('unread_count', sa.Integer(), nullable=False, server_default='0'),
+    sa.ForeignKeyConstraint(['room_id'], ['chat_room.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'room_id', name='_user_room_unread_uc')
+    )
+
+
+def downgrade():
+    """
+    Drop the per-(user, room) unread counter table.
+    """
+    op.drop_table('chat_unread_counter')
@@ -0,0 +1,41 @@
+"""Add full-text search index for chat messages
+
+Revision ID: 4e8b1f3a6d92
+Revises: 9d4a6c2e8f17
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e8b1f3a6d92'
+down_revision = '9d4a6c2e8f17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    On SQLite, create the chat_message_fts FTS5 table and fill it from existing messages.
+    On Postgres, add a GIN index over the message text's tsvector.
+    """
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5(content, tokenize='porter unicode61')")
+        op.execute("INSERT INTO chat_message_fts (rowid, content) SELECT id, content FROM chat_message WHERE content IS NOT NULL")
+    elif dialect == 'postgresql':
+        op.execute("CREATE INDEX IF NOT EXISTS ix_chat_message_content_tsv ON chat_message "
+                   "USING gin (to_tsvector('english', coalesce(content, '')))")
+
+
+def downgrade():
+    """
+    Remove the chat message search index.
+    """
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("DROP TABLE IF EXISTS chat_message_fts")
+    elif dialect == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_chat_message_content_tsv")
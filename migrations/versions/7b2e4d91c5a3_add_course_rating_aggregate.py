@@ -0,0 +1,45 @@
+"""Add rating aggregate columns to Course
+
+Revision ID: 7b2e4d91c5a3
+Revises: 3c1f9a2b7d10
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b2e4d91c5a3'
+down_revision = '3c1f9a2b7d10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add rating_sum, rating_count and rating_avg to the course table and backfill them from comments.
+    """
+    with op.batch_alter_table('course', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('rating_sum', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('rating_count', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('rating_avg', sa.Float(), nullable=False, server_default='0'))
+        batch_op.create_index(batch_op.f('ix_course_rating_avg'), ['rating_avg'], unique=False)
+
+    op.execute("""
+        UPDATE course SET
+            rating_sum = (SELECT COALESCE(SUM(rating), 0) FROM comment WHERE comment.course_id = course.id AND rating IS NOT NULL),
+            rating_count = (SELECT COUNT(rating) FROM comment WHERE comment.course_id = course.id AND rating IS NOT NULL)
+    """)
+    op.execute("UPDATE course SET rating_avg = rating_sum * 1.0 / rating_count WHERE rating_count > 0")
+
+
+def downgrade():
+    """
+    Remove the rating aggregate columns from the course table.
+    """
+    with op.batch_alter_table('course', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_course_rating_avg'))
+        batch_op.drop_column('rating_avg')
+        batch_op.drop_column('rating_count')
+        batch_op.drop_column('rating_sum')
@@ -0,0 +1,32 @@
+"""Add composite index for chat history pagination
+
+Revision ID: 9d4a6c2e8f17
+Revises: 7b2e4d91c5a3
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4a6c2e8f17'
+down_revision = '7b2e4d91c5a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add a (room_id, timestamp, id) index to chat_message for keyset-paginated history.
+    """
+    with op.batch_alter_table('chat_message', schema=None) as batch_op:
+        batch_op.create_index('ix_chat_message_room_timestamp_id', ['room_id', 'timestamp', 'id'], unique=False)
+
+
+def downgrade():
+    """
+    Remove the chat history index.
+    """
+    with op.batch_alter_table('chat_message', schema=None) as batch_op:
+        batch_op.drop_index('ix_chat_message_room_timestamp_id')
@@ -0,0 +1,48 @@
+"""Add content-addressed upload store
+
+Revision ID: a1c3e5f7b9d2
+Revises: f8b0d2e4a6c7
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f7b9d2'
+down_revision = 'f8b0d2e4a6c7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Create the stored_file table. Files uploaded before it keep their old paths, which
+    the upload_url filter still resolves; only new uploads are deduplicated.
+    """
+    op.create_table('stored_file',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('key', sa.String(length=100), nullable=False),
+    sa.Column('sha256', sa.String(length=64), nullable=False),
+    sa.Column('size', sa.Integer(), nullable=False),
+    sa.Column('ref_count', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('released_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('key')
+    )
+    with op.batch_alter_table('stored_file', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_stored_file_sha256'), ['sha256'], unique=False)
+        batch_op.create_index('ix_stored_file_ref_count_released_at', ['ref_count', 'released_at'], unique=False)
+
+
+def downgrade():
+    """
+    Drop the stored_file table. Blobs under static/uploads/ are left in place.
+    """
+    with op.batch_alter_table('stored_file', schema=None) as batch_op:
+        batch_op.drop_index('ix_stored_file_ref_count_released_at')
+        batch_op.drop_index(batch_op.f('ix_stored_file_sha256'))
+
+    op.drop_table('stored_file')
@@ -0,0 +1,38 @@
+"""Add the cached exam paper and per-submission shuffle seed
+
+Revision ID: a2c4e6f8b0d1
+Revises: f7a9c1e3d5b8
+Create Date: 2026-10-17 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a2c4e6f8b0d1'
+down_revision = 'f7a9c1e3d5b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add paper to final_exam and shuffle_seed to exam_submission.
+    """
+    with op.batch_alter_table('final_exam', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('paper', sa.JSON(), nullable=True))
+
+    with op.batch_alter_table('exam_submission', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('shuffle_seed', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    """
+    Remove shuffle_seed from exam_submission and paper from final_exam.
+    """
+    with op.batch_alter_table('exam_submission', schema=None) as batch_op:
+        batch_op.drop_column('shuffle_seed')
+
+    with op.batch_alter_table('final_exam', schema=None) as batch_op:
+        batch_op.drop_column('paper')
@@ -0,0 +1,55 @@
+"""Add image variants
+
+Revision ID: b2d4f6a8c0e1
+Revises: a1c3e5f7b9d2
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2d4f6a8c0e1'
+down_revision = 'a1c3e5f7b9d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Track the variants rendered for uploaded images. Images stored before this are
+    served as they are; only new uploads are queued for variants.
+    """
+    with op.batch_alter_table('stored_file', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('variants_status', sa.String(length=20), nullable=True))
+        batch_op.create_index(batch_op.f('ix_stored_file_variants_status'), ['variants_status'], unique=False)
+
+    op.create_table('image_variant',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('source_id', sa.Integer(), nullable=False),
+    sa.Column('format', sa.String(length=10), nullable=False),
+    sa.Column('width', sa.Integer(), nullable=False),
+    sa.Column('height', sa.Integer(), nullable=False),
+    sa.Column('path', sa.String(length=150), nullable=False),
+    sa.ForeignKeyConstraint(['source_id'], ['stored_file.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('source_id', 'format', 'width', name='_image_variant_uc')
+    )
+    with op.batch_alter_table('image_variant', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_image_variant_source_id'), ['source_id'], unique=False)
+
+
+def downgrade():
+    """
+    Drop the image_variant table and the variants status. Variant blobs stay in the
+    store with their references until pruned by hand.
+    """
+    with op.batch_alter_table('image_variant', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_image_variant_source_id'))
+
+    op.drop_table('image_variant')
+
+    with op.batch_alter_table('stored_file', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_stored_file_variants_status'))
+        batch_op.drop_column('variants_status')
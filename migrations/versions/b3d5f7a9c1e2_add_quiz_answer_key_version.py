@@ -0,0 +1,32 @@
+"""Add answer_key_version to Quiz
+
+Revision ID: b3d5f7a9c1e2
+Revises: a2c4e6f8b0d1
+Create Date: 2026-10-17 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3d5f7a9c1e2'
+down_revision = 'a2c4e6f8b0d1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add answer_key_version to the quiz table.
+    """
+    with op.batch_alter_table('quiz', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('answer_key_version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    """
+    Remove answer_key_version from the quiz table.
+    """
+    with op.batch_alter_table('quiz', schema=None) as batch_op:
+        batch_op.drop_column('answer_key_version')
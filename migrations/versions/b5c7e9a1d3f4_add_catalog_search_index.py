@@ -0,0 +1,49 @@
+"""Add catalog search index for courses and library materials
+
+Revision ID: b5c7e9a1d3f4
+Revises: 4e8b1f3a6d92
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5c7e9a1d3f4'
+down_revision = '4e8b1f3a6d92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    On SQLite, create the course_fts and library_fts FTS5 tables and fill them from approved items.
+    Other databases search the catalog with ILIKE and need no index.
+    """
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS course_fts USING fts5(title, description, category, instructor, tokenize='porter unicode61')")
+    op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS library_fts USING fts5(title, description, category, instructor, tokenize='porter unicode61')")
+    op.execute("""
+        INSERT INTO course_fts (rowid, title, description, category, instructor)
+        SELECT course.id, course.title, course.description, category.name, user.name
+        FROM course JOIN category ON category.id = course.category_id JOIN user ON user.id = course.instructor_id
+        WHERE course.approved = 1
+    """)
+    op.execute("""
+        INSERT INTO library_fts (rowid, title, description, category, instructor)
+        SELECT library_material.id, library_material.title, library_material.description, category.name, user.name
+        FROM library_material JOIN category ON category.id = library_material.category_id JOIN user ON user.id = library_material.uploader_id
+        WHERE library_material.approved = 1
+    """)
+
+
+def downgrade():
+    """
+    Remove the catalog search tables.
+    """
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("DROP TABLE IF EXISTS library_fts")
+    op.execute("DROP TABLE IF EXISTS course_fts")
@@ -0,0 +1,37 @@
+"""Add total_marks to FinalExam
+
+Revision ID: c4e6a8b0d2f3
+Revises: b3d5f7a9c1e2
+Create Date: 2026-10-17 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e6a8b0d2f3'
+down_revision = 'b3d5f7a9c1e2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add total_marks to final_exam and fill it from the existing questions.
+    """
+    with op.batch_alter_table('final_exam', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('total_marks', sa.Float(), nullable=False, server_default='0'))
+
+    op.execute(
+        "UPDATE final_exam SET total_marks = "
+        "(SELECT COALESCE(SUM(question.marks), 0) FROM question WHERE question.exam_id = final_exam.id)"
+    )
+
+
+def downgrade():
+    """
+    Remove total_marks from final_exam.
+    """
+    with op.batch_alter_table('final_exam', schema=None) as batch_op:
+        batch_op.drop_column('total_marks')
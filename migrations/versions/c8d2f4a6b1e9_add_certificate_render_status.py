@@ -0,0 +1,37 @@
+"""Add render status to Certificate
+
+Revision ID: c8d2f4a6b1e9
+Revises: b5c7e9a1d3f4
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8d2f4a6b1e9'
+down_revision = 'b5c7e9a1d3f4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add status, render_attempts and render_error to the certificate table.
+    Existing certificates were rendered inline, so they start out 'ready'.
+    """
+    with op.batch_alter_table('certificate', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('status', sa.String(length=20), nullable=False, server_default='ready'))
+        batch_op.add_column(sa.Column('render_attempts', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('render_error', sa.Text(), nullable=True))
+
+
+def downgrade():
+    """
+    Remove the render status columns from the certificate table.
+    """
+    with op.batch_alter_table('certificate', schema=None) as batch_op:
+        batch_op.drop_column('render_error')
+        batch_op.drop_column('render_attempts')
+        batch_op.drop_column('status')
@@ -0,0 +1,32 @@
+"""Add answer_key_version to FinalExam
+
+Revision ID: d1e3a5c7f9b2
+Revises: c8d2f4a6b1e9
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd1e3a5c7f9b2'
+down_revision = 'c8d2f4a6b1e9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add answer_key_version to the final_exam table.
+    """
+    with op.batch_alter_table('final_exam', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('answer_key_version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    """
+    Remove answer_key_version from the final_exam table.
+    """
+    with op.batch_alter_table('final_exam', schema=None) as batch_op:
+        batch_op.drop_column('answer_key_version')
@@ -0,0 +1,71 @@
+"""Add materialized exam analytics
+
+Revision ID: d5f7b9c1e3a4
+Revises: c4e6a8b0d2f3
+Create Date: 2026-10-17 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5f7b9c1e3a4'
+down_revision = 'c4e6a8b0d2f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add analytics_stale to final_exam, marking exams with graded submissions for a first
+    refresh, and create the exam_analytics and exam_question_analytics tables.
+    """
+    with op.batch_alter_table('final_exam', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('analytics_stale', sa.Boolean(), nullable=False, server_default='0'))
+
+    op.execute(
+        "UPDATE final_exam SET analytics_stale = 1 WHERE EXISTS "
+        "(SELECT 1 FROM exam_submission WHERE exam_submission.final_exam_id = final_exam.id "
+        "AND exam_submission.status IN ('pending_review', 'released'))"
+    )
+
+    op.create_table('exam_analytics',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('exam_id', sa.Integer(), nullable=False),
+    sa.Column('submissions', sa.Integer(), nullable=False),
+    sa.Column('mean_score', sa.Float(), nullable=True),
+    sa.Column('score_stddev', sa.Float(), nullable=True),
+    sa.Column('pass_rate', sa.Float(), nullable=True),
+    sa.Column('score_histogram', sa.JSON(), nullable=False),
+    sa.Column('refreshed_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['exam_id'], ['final_exam.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('exam_id')
+    )
+
+    op.create_table('exam_question_analytics',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('exam_id', sa.Integer(), nullable=False),
+    sa.Column('question_id', sa.Integer(), nullable=False),
+    sa.Column('responses', sa.Integer(), nullable=False),
+    sa.Column('percent_correct', sa.Float(), nullable=True),
+    sa.Column('mean_marks', sa.Float(), nullable=True),
+    sa.Column('discrimination', sa.Float(), nullable=True),
+    sa.Column('choice_counts', sa.JSON(), nullable=True),
+    sa.ForeignKeyConstraint(['exam_id'], ['final_exam.id'], ),
+    sa.ForeignKeyConstraint(['question_id'], ['question.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('exam_id', 'question_id', name='_exam_question_analytics_uc')
+    )
+
+
+def downgrade():
+    """
+    Drop the exam analytics tables and analytics_stale from final_exam.
+    """
+    op.drop_table('exam_question_analytics')
+    op.drop_table('exam_analytics')
+
+    with op.batch_alter_table('final_exam', schema=None) as batch_op:
+        batch_op.drop_column('analytics_stale')
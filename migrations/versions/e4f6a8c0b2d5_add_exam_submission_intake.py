@@ -0,0 +1,34 @@
+"""Add exam submission intake payload and status index
+
+Revision ID: e4f6a8c0b2d5
+Revises: d1e3a5c7f9b2
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4f6a8c0b2d5'
+down_revision = 'd1e3a5c7f9b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add submitted_payload to exam_submission and index it by status and submission time.
+    """
+    with op.batch_alter_table('exam_submission', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('submitted_payload', sa.JSON(), nullable=True))
+        batch_op.create_index('ix_exam_submission_status_submitted_at', ['status', 'submitted_at'], unique=False)
+
+
+def downgrade():
+    """
+    Remove the status index and submitted_payload from exam_submission.
+    """
+    with op.batch_alter_table('exam_submission', schema=None) as batch_op:
+        batch_op.drop_index('ix_exam_submission_status_submitted_at')
+        batch_op.drop_column('submitted_payload')
@@ -0,0 +1,57 @@
+"""Add daily metric rollups
+
+Revision ID: e6a8c0d2f4b5
+Revises: d5f7b9c1e3a4
+Create Date: 2026-10-17 22:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6a8c0d2f4b5'
+down_revision = 'd5f7b9c1e3a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Create the daily_metric table and index the timestamps the rollup counts by.
+    Run `flask rollup-metrics --days 90` afterwards to backfill the dashboard trends.
+    """
+    op.create_table('daily_metric',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('metric', sa.String(length=50), nullable=False),
+    sa.Column('dimension', sa.String(length=100), nullable=False),
+    sa.Column('value', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('metric', 'day', 'dimension', name='_daily_metric_uc')
+    )
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_user_created_at'), ['created_at'], unique=False)
+
+    with op.batch_alter_table('enrollment', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_enrollment_timestamp'), ['timestamp'], unique=False)
+
+    with op.batch_alter_table('exam_submission', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_exam_submission_submitted_at'), ['submitted_at'], unique=False)
+
+
+def downgrade():
+    """
+    Drop the timestamp indexes and the daily_metric table.
+    """
+    with op.batch_alter_table('exam_submission', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_exam_submission_submitted_at'))
+
+    with op.batch_alter_table('enrollment', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_enrollment_timestamp'))
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_created_at'))
+
+    op.drop_table('daily_metric')
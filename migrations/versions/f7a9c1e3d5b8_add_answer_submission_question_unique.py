@@ -0,0 +1,33 @@
+"""Make answers unique per submission and question
+
+Revision ID: f7a9c1e3d5b8
+Revises: e4f6a8c0b2d5
+Create Date: 2026-10-17 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7a9c1e3d5b8'
+down_revision = 'e4f6a8c0b2d5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add a unique constraint on answer (exam_submission_id, question_id), so autosaved
+    answers can be upserted.
+    """
+    with op.batch_alter_table('answer', schema=None) as batch_op:
+        batch_op.create_unique_constraint('_submission_question_uc', ['exam_submission_id', 'question_id'])
+
+
+def downgrade():
+    """
+    Remove the answer (exam_submission_id, question_id) unique constraint.
+    """
+    with op.batch_alter_table('answer', schema=None) as batch_op:
+        batch_op.drop_constraint('_submission_question_uc', type_='unique')
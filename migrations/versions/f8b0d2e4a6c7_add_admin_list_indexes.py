@@ -0,0 +1,46 @@
+"""Add indexes for paginated admin lists
+
+Revision ID: f8b0d2e4a6c7
+Revises: e6a8c0d2f4b5
+Create Date: 2026-10-17 23:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f8b0d2e4a6c7'
+down_revision = 'e6a8c0d2f4b5'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('user', 'ix_user_name_id', ['name', 'id']),
+    ('user', 'ix_user_role_approved_name_id', ['role', 'approved', 'name', 'id']),
+    ('course', 'ix_course_approved_id', ['approved', 'id']),
+    ('library_material', 'ix_library_material_approved_id', ['approved', 'id']),
+    ('chat_room', 'ix_chat_room_name_id', ['name', 'id']),
+    ('reported_message', 'ix_reported_message_timestamp_id', ['timestamp', 'id']),
+    ('enrollment', 'ix_enrollment_status_timestamp', ['status', 'timestamp']),
+    ('library_purchase', 'ix_library_purchase_status_timestamp', ['status', 'timestamp']),
+]
+
+
+def upgrade():
+    """
+    Index the filter and sort columns of the keyset-paginated admin lists and the
+    payment queues.
+    """
+    for table, name, columns in INDEXES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.create_index(name, columns, unique=False)
+
+
+def downgrade():
+    """
+    Drop the admin list indexes.
+    """
+    for table, name, columns in reversed(INDEXES):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_index(name)
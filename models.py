@@ -2,7 +2,7 @@ from extensions import db
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from datetime import datetime
-from sqlalchemy.orm import synonym
+from sqlalchemy.orm import synonym, deferred
 
 class Enrollment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -11,14 +11,17 @@ class Enrollment(db.Model):
     status = db.Column(db.String(50), default='pending')
     proof_of_payment_path = db.Column(db.String(255), nullable=True)
     rejection_reason = db.Column(db.String(255), nullable=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
     student = db.relationship('User', back_populates='enrollments')
     course = db.relationship('Course', back_populates='enrollments')
 
+    # Payment queues list enrollments of one status oldest first
+    __table_args__ = (db.Index('ix_enrollment_status_timestamp', 'status', 'timestamp'),)
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     name = db.Column(db.String(150), nullable=False)
     email = db.Column(db.String(150), unique=True, nullable=False)
     password_hash = db.Column(db.String(128))
@@ -39,6 +42,12 @@ class User(UserMixin, db.Model):
     library_purchases = db.relationship('LibraryPurchase', backref='user', lazy='dynamic', cascade="all, delete-orphan")
     chat_messages = db.relationship('ChatMessage', backref='author', lazy='dynamic')
 
+    # Admin user lists are keyset-paginated by (name, id), optionally within a role
+    __table_args__ = (
+        db.Index('ix_user_name_id', 'name', 'id'),
+        db.Index('ix_user_role_approved_name_id', 'role', 'approved', 'name', 'id'),
+    )
+
     def is_enrolled(self, course):
         return Enrollment.query.filter_by(student=self, course=course, status='approved').count() > 0
 
@@ -71,6 +80,10 @@ class Course(db.Model):
     account_name = db.Column(db.String(100), nullable=True)
     extra_instructions = db.Column(db.Text, nullable=True)
     final_exam_enabled = db.Column(db.Boolean, default=True)
+    # Rating aggregate, maintained by record_rating() and the backfill-course-ratings command
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_avg = db.Column(db.Float, nullable=False, default=0, index=True)
 
     modules = db.relationship('Module', backref='course', lazy='dynamic', cascade="all, delete-orphan")
     comments = db.relationship('Comment', backref='course', lazy='dynamic', cascade="all, delete-orphan")
@@ -78,12 +91,20 @@ class Course(db.Model):
     final_exam = db.relationship('FinalExam', backref='course', uselist=False, cascade="all, delete-orphan")
     chat_room = db.relationship('ChatRoom', backref='course_room', uselist=False, cascade="all, delete-orphan")
 
+    __table_args__ = (db.Index('ix_course_approved_id', 'approved', 'id'),)
+
     @property
     def avg_rating(self):
-        if not self.comments.all(): return 0
-        ratings = [c.rating for c in self.comments if c.rating is not None]
-        if not ratings: return 0
-        return sum(ratings) / len(ratings)
+        return self.rating_avg or 0
+
+    def record_rating(self, rating):
+        """Folds a new rating into the stored aggregate with one atomic UPDATE. Caller commits."""
+        Course.query.filter_by(id=self.id).update({
+            Course.rating_sum: Course.rating_sum + rating,
+            Course.rating_count: Course.rating_count + 1,
+            Course.rating_avg: (Course.rating_sum + rating) * 1.0 / (Course.rating_count + 1)
+        }, synchronize_session=False)
+
     def __repr__(self): return f'<Course {self.title}>'
 
 class Module(db.Model):
@@ -130,6 +151,8 @@ class LibraryMaterial(db.Model):
     category = db.relationship('Category', backref='library_materials')
     purchases = db.relationship('LibraryPurchase', backref='material', lazy='dynamic', cascade="all, delete-orphan")
 
+    __table_args__ = (db.Index('ix_library_material_approved_id', 'approved', 'id'),)
+
     def __repr__(self): return f'<LibraryMaterial {self.title}>'
 
 class PlatformSetting(db.Model):
@@ -146,6 +169,8 @@ class Quiz(db.Model):
     randomized_questions = db.Column(db.Boolean, default=False)
     attempt_limit = db.Column(db.Integer, default=1)
     pass_mark = db.Column(db.Integer, default=70)
+    # Bumped whenever questions change; cached answer keys are keyed on it
+    answer_key_version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     questions = db.relationship('Question', backref='quiz', lazy='dynamic', cascade="all, delete-orphan")
     submissions = db.relationship('QuizSubmission', backref='quiz', lazy='dynamic', cascade="all, delete-orphan")
@@ -181,9 +206,19 @@ class FinalExam(db.Model):
     webcam_monitoring = db.Column(db.Boolean, default=False)
     release_scores_immediately = db.Column(db.Boolean, default=True)
     is_published = db.Column(db.Boolean, default=False)
+    # Bumped whenever questions or grading settings change; cached answer keys and papers are keyed on it
+    answer_key_version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # Sum of the questions' marks, kept up to date by exam_grading.invalidate
+    total_marks = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    # Questions and choices as shown to students, without answers; see exam_paper
+    paper = deferred(db.Column(db.JSON, nullable=True))
+    # Set when a submission is graded after exam_analytics last refreshed this exam
+    analytics_stale = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
 
     questions = db.relationship('Question', backref='exam', lazy='dynamic', cascade="all, delete-orphan")
     submissions = db.relationship('ExamSubmission', backref='final_exam', lazy='dynamic', cascade="all, delete-orphan")
+    analytics = db.relationship('ExamAnalytics', backref='exam', uselist=False, cascade="all, delete-orphan")
+    question_analytics = db.relationship('ExamQuestionAnalytics', lazy='dynamic', cascade="all, delete-orphan")
 
 class Question(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -238,8 +273,16 @@ class ExamSubmission(db.Model):
     locked = db.Column(db.Boolean, default=False)
     appeal_text = db.Column(db.Text, nullable=True)
     appeal_status = db.Column(db.String(50), nullable=True) # pending, accepted, rejected
-    submitted_at = db.Column(db.DateTime, nullable=True)
+    submitted_at = db.Column(db.DateTime, index=True, nullable=True)
     attempt_number = db.Column(db.Integer, nullable=False, default=1)
+    # Seeds this attempt's question and choice order when the exam shuffles them
+    shuffle_seed = db.Column(db.Integer, nullable=True)
+    # Raw form data kept while the submission waits in the grading queue
+    submitted_payload = db.Column(db.JSON, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_exam_submission_status_submitted_at', 'status', 'submitted_at'),
+    )
 
     answers = db.relationship('Answer', backref='submission', lazy='dynamic', cascade="all, delete-orphan")
     violations = db.relationship('ExamViolation', backref='submission', lazy='dynamic', cascade="all, delete-orphan")
@@ -273,12 +316,39 @@ class Answer(db.Model):
     selected_choice = db.relationship('Choice')
     grader = db.relationship('User')
 
+    __table_args__ = (db.UniqueConstraint('exam_submission_id', 'question_id', name='_submission_question_uc'),)
+
 class ExamViolation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     submission_id = db.Column(db.Integer, db.ForeignKey('exam_submission.id'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     details = db.Column(db.Text, nullable=True)
 
+class ExamAnalytics(db.Model):
+    # Materialized by exam_analytics.refresh from graded submissions
+    id = db.Column(db.Integer, primary_key=True)
+    exam_id = db.Column(db.Integer, db.ForeignKey('final_exam.id'), nullable=False, unique=True)
+    submissions = db.Column(db.Integer, nullable=False, default=0)
+    mean_score = db.Column(db.Float, nullable=True)
+    score_stddev = db.Column(db.Float, nullable=True)
+    pass_rate = db.Column(db.Float, nullable=True)
+    score_histogram = db.Column(db.JSON, nullable=False, default=list) # Submissions per 10-point band, 0-10 to 90-100
+    refreshed_at = db.Column(db.DateTime, nullable=True)
+
+class ExamQuestionAnalytics(db.Model):
+    # Item statistics per question, materialized alongside ExamAnalytics
+    id = db.Column(db.Integer, primary_key=True)
+    exam_id = db.Column(db.Integer, db.ForeignKey('final_exam.id'), nullable=False)
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), nullable=False)
+    responses = db.Column(db.Integer, nullable=False, default=0)
+    percent_correct = db.Column(db.Float, nullable=True)
+    mean_marks = db.Column(db.Float, nullable=True)
+    discrimination = db.Column(db.Float, nullable=True) # Point-biserial correlation with the exam score
+    choice_counts = db.Column(db.JSON, nullable=True) # {choice id or 'True'/'False': responses}
+
+    question = db.relationship('Question')
+    __table_args__ = (db.UniqueConstraint('exam_id', 'question_id', name='_exam_question_analytics_uc'),)
+
 class LessonCompletion(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -293,6 +363,9 @@ class Certificate(db.Model):
     certificate_uid = db.Column(db.String(100), unique=True, nullable=False)
     issued_at = db.Column(db.DateTime, default=datetime.utcnow)
     file_path = db.Column(db.String(255), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued', server_default='ready') # queued, rendering, ready, failed
+    render_attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    render_error = db.Column(db.Text, nullable=True)
 
     user = db.relationship('User', backref=db.backref('certificates', lazy='dynamic'))
     course = db.relationship('Course', backref=db.backref('certificates', lazy='dynamic'))
@@ -318,6 +391,8 @@ class LibraryPurchase(db.Model):
     rejection_reason = db.Column(db.String(255), nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (db.Index('ix_library_purchase_status_timestamp', 'status', 'timestamp'),)
+
 class ChatRoom(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -337,6 +412,8 @@ class ChatRoom(db.Model):
     creator = db.relationship('User', backref='created_chat_rooms')
     polls = db.relationship('Poll', back_populates='room', lazy='dynamic', cascade="all, delete-orphan")
 
+    __table_args__ = (db.Index('ix_chat_room_name_id', 'name', 'id'),)
+
 class ChatRoomMember(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     chat_room_id = db.Column(db.Integer, db.ForeignKey('chat_room.id'), nullable=False)
@@ -362,6 +439,9 @@ class ChatMessage(db.Model):
     reactions = db.relationship('MessageReaction', backref='message', lazy='dynamic', cascade="all, delete-orphan")
     poll = db.relationship('Poll', back_populates='message', uselist=False, cascade="all, delete-orphan")
 
+    # Keyset pagination of a room's history walks (timestamp, id) within the room
+    __table_args__ = (db.Index('ix_chat_message_room_timestamp_id', 'room_id', 'timestamp', 'id'),)
+
 class MutedUser(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -379,6 +459,8 @@ class ReportedMessage(db.Model):
     message = db.relationship('ChatMessage', backref='reports')
     reporter = db.relationship('User', foreign_keys=[reported_by_id])
 
+    __table_args__ = (db.Index('ix_reported_message_timestamp_id', 'timestamp', 'id'),)
+
 class MessageReaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     message_id = db.Column(db.Integer, db.ForeignKey('chat_message.id'), nullable=False)
@@ -396,6 +478,46 @@ class UserLastRead(db.Model):
     last_read_timestamp = db.Column(db.DateTime, nullable=False)
     __table_args__ = (db.UniqueConstraint('user_id', 'room_id', name='_user_room_read_uc'),)
 
+class ChatUnreadCounter(db.Model):
+    # Maintained incrementally by chat_events when CHAT_UNREAD_COUNTERS is enabled
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    room_id = db.Column(db.Integer, db.ForeignKey('chat_room.id'), nullable=False)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('user_id', 'room_id', name='_user_room_unread_uc'),)
+
+class DailyMetric(db.Model):
+    # Daily counters rolled up by metrics_rollup for the admin dashboard
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    metric = db.Column(db.String(50), nullable=False)
+    dimension = db.Column(db.String(100), nullable=False, default='') # e.g. a role, status or room id
+    value = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('metric', 'day', 'dimension', name='_daily_metric_uc'),)
+
+class StoredFile(db.Model):
+    # One row per distinct uploaded blob in upload_store, shared by every record that references it
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(100), unique=True, nullable=False) # <sha256[:2]>/<sha256><ext>
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    released_at = db.Column(db.DateTime, nullable=True) # When ref_count last dropped to zero
+    variants_status = db.Column(db.String(20), nullable=True, index=True) # queued, processing, ready or failed; None for non-images
+    variants = db.relationship('ImageVariant', backref='source', lazy=True)
+    __table_args__ = (db.Index('ix_stored_file_ref_count_released_at', 'ref_count', 'released_at'),)
+
+class ImageVariant(db.Model):
+    # A resized, metadata-free rendition of an uploaded image, generated by image_variants
+    id = db.Column(db.Integer, primary_key=True)
+    source_id = db.Column(db.Integer, db.ForeignKey('stored_file.id'), nullable=False, index=True)
+    format = db.Column(db.String(10), nullable=False) # webp, or jpeg/png as the fallback
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    path = db.Column(db.String(150), nullable=False) # upload_store path of the variant's own blob
+    __table_args__ = (db.UniqueConstraint('source_id', 'format', 'width', name='_image_variant_uc'),)
+
 class AdminLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     admin_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
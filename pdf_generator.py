@@ -1,10 +1,25 @@
 from flask import render_template
-from weasyprint import HTML
 import os
 
-def generate_certificate_pdf(certificate, user, course, app):
+# Parsed certificate stylesheets, keyed by their source. Parsing the CSS, fetching the
+# @import'ed web fonts and decoding images only happens on a process's first render.
+_layouts = {}
+
+def certificate_relative_path(certificate):
+    # The path should be relative to the static folder for url_for to work
+    # and must use forward slashes for URL compatibility.
+    return f"certificates/{certificate.certificate_uid}.pdf"
+
+def certificate_stylesheet(app):
+    """Source of the certificate stylesheet, read once per app."""
+    if 'certificate_stylesheet' not in app.extensions:
+        source, _, _ = app.jinja_env.loader.get_source(app.jinja_env, 'certificate/certificate.css')
+        app.extensions['certificate_stylesheet'] = source
+    return app.extensions['certificate_stylesheet']
+
+def render_certificate_html(certificate, user, course, app):
     with app.app_context():
-        rendered_html = render_template(
+        return render_template(
             'certificate/template.html',
             student_name=user.name,
             course_name=course.title,
@@ -12,14 +27,44 @@ def generate_certificate_pdf(certificate, user, course, app):
             certificate_id=certificate.certificate_uid
         )
 
-    pdf_folder = os.path.join(app.static_folder, 'certificates')
-    os.makedirs(pdf_folder, exist_ok=True)
+def load_layout(stylesheet):
+    """Returns (CSS, FontConfiguration, image cache) for a stylesheet, parsing it on first use."""
+    layout = _layouts.get(stylesheet)
+    if layout is None:
+        # WeasyPrint loads Pango and cairo on import, so only processes that render pay for it
+        from weasyprint import CSS
+        from weasyprint.text.fonts import FontConfiguration
+        font_config = FontConfiguration()
+        layout = (CSS(string=stylesheet, font_config=font_config), font_config, {})
+        _layouts[stylesheet] = layout
+    return layout
 
-    file_path = os.path.join(pdf_folder, f'{certificate.certificate_uid}.pdf')
+def write_certificate_pdf(rendered_html, file_path, stylesheet):
+    """Runs WeasyPrint. Takes only plain values so it can run in a worker process."""
+    from weasyprint import HTML
 
-    HTML(string=rendered_html).write_pdf(file_path)
+    css, font_config, image_cache = load_layout(stylesheet)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    HTML(string=rendered_html).write_pdf(file_path, stylesheets=[css], font_config=font_config, cache=image_cache)
+    return file_path
 
-    # The path should be relative to the static folder for url_for to work
-    # and must use forward slashes for URL compatibility.
-    certificate.file_path = f"certificates/{certificate.certificate_uid}.pdf"
+def write_certificate_pdfs(jobs, stylesheet):
+    """
+    Renders a list of (rendered_html, file_path) with one layout.
+    Returns an error message per job, None for the ones that succeeded.
+    """
+    errors = []
+    for rendered_html, file_path in jobs:
+        try:
+            write_certificate_pdf(rendered_html, file_path, stylesheet)
+            errors.append(None)
+        except Exception as e:
+            errors.append(str(e) or e.__class__.__name__)
+    return errors
+
+def generate_certificate_pdf(certificate, user, course, app):
+    rendered_html = render_certificate_html(certificate, user, course, app)
+    file_path = os.path.join(app.static_folder, certificate_relative_path(certificate))
+    write_certificate_pdf(rendered_html, file_path, certificate_stylesheet(app))
+    certificate.file_path = certificate_relative_path(certificate)
     return certificate
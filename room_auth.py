@@ -0,0 +1,64 @@
+import threading
+import time
+from flask import current_app
+from models import ChatRoomMember
+
+_cache_lock = threading.Lock()
+
+
+def _ttl():
+    return current_app.config.get('CHAT_AUTH_CACHE_TTL', 60)
+
+
+def _cache():
+    """The current app's {(user_id, room_id): (authorized, expires_at)} map."""
+    return current_app.extensions.setdefault('room_auth_cache', {})
+
+
+def _check(user, room):
+    if room.room_type == 'course' and room.course_room:
+        if user.id == room.course_room.instructor_id or user.is_enrolled(room.course_room):
+            return True
+
+    # Check for explicit membership
+    return ChatRoomMember.query.filter_by(user_id=user.id, chat_room_id=room.id).count() > 0
+
+
+def is_user_authorized_for_room(user, room):
+    """
+    Whether the user may read and post in the room. Enrollment and membership checks are cached
+    per process for CHAT_AUTH_CACHE_TTL seconds; routes that change them call invalidate().
+    Other processes only pick up a change once their entry expires.
+    """
+    if user.role == 'admin':
+        return True
+    if room.room_type == 'public':
+        return True
+
+    cache = _cache()
+    key = (user.id, room.id)
+    now = time.monotonic()
+    with _cache_lock:
+        cached = cache.get(key)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    authorized = _check(user, room)
+    with _cache_lock:
+        cache[key] = (authorized, now + _ttl())
+    return authorized
+
+
+def invalidate(user_id=None, room_id=None):
+    """
+    Drops cached decisions for a user, a room, or a single (user, room) pair.
+    Called with no arguments it clears the whole cache.
+    """
+    cache = _cache()
+    with _cache_lock:
+        if user_id is None and room_id is None:
+            cache.clear()
+            return
+        for key in list(cache):
+            if (user_id is None or key[0] == user_id) and (room_id is None or key[1] == room_id):
+                del cache[key]
@@ -1,67 +1,33 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, send_from_directory, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, jsonify
 from flask_login import login_user, logout_user, login_required, current_user
 from datetime import datetime
 import random
+from collections import Counter
 import secrets
-from models import User, Course, Category, Comment, Lesson, LibraryMaterial, Assignment, AssignmentSubmission, Quiz, FinalExam, QuizSubmission, ExamSubmission, Enrollment, LessonCompletion, Module, Certificate, CertificateRequest, LibraryPurchase, ChatRoom, ChatRoomMember, UserLastRead, ChatMessage, ExamViolation, GroupRequest, Choice, Answer
+from models import User, Course, Category, Comment, Lesson, LibraryMaterial, Assignment, AssignmentSubmission, Quiz, FinalExam, QuizSubmission, ExamSubmission, Enrollment, LessonCompletion, Module, Certificate, CertificateRequest, LibraryPurchase, ChatRoom, ChatRoomMember, UserLastRead, ChatMessage, ExamViolation, GroupRequest, Choice, Answer, MessageReaction
 from extensions import db
+from sqlalchemy import tuple_
+from werkzeug.datastructures import MultiDict
+from werkzeug.utils import secure_filename
+from sqlalchemy.orm import joinedload
 from utils import save_chat_file
+import unread_counts
+import message_writer
+import room_auth
+import chat_search
+import catalog_search
+import exam_grading
+import exam_intake
+import exam_autosave
+import exam_paper
+import upload_store
+import image_variants
+import file_delivery
+import download_counts
+from course_progress import get_course_progress, get_progress_for_courses
 
 main = Blueprint('main', __name__)
 
-def get_course_progress(user, course):
-    """
-    Checks a user's progress in a given course and determines eligibility for the final exam and certificate.
-    """
-    progress = {
-        'quizzes': [],
-        'assignments': [],
-        'final_exam': None,
-        'all_prerequisites_met': True,
-        'can_request_certificate': False,
-        'reasons': []
-    }
-
-    PASSING_GRADES = {'a', 'b', 'c', 'pass'}
-
-    # Check quizzes
-    all_quizzes = Quiz.query.join(Module).filter(Module.course_id == course.id).all()
-    for quiz in all_quizzes:
-        latest_submission = QuizSubmission.query.filter_by(student_id=user.id, quiz_id=quiz.id).order_by(QuizSubmission.id.desc()).first()
-        passed = latest_submission and latest_submission.score >= quiz.pass_mark
-        if not passed:
-            progress['all_prerequisites_met'] = False
-            progress['reasons'].append(f"Quiz not passed: {quiz.module.title}")
-        progress['quizzes'].append({'quiz': quiz, 'submission': latest_submission, 'passed': passed})
-
-    # Check assignments
-    all_assignments = Assignment.query.join(Module).filter(Module.course_id == course.id).all()
-    for assignment in all_assignments:
-        submission = AssignmentSubmission.query.filter_by(student_id=user.id, assignment_id=assignment.id).first()
-        approved = submission and submission.grade and submission.grade.lower() in PASSING_GRADES
-        if not approved:
-            progress['all_prerequisites_met'] = False
-            progress['reasons'].append(f"Assignment not approved: {assignment.title}")
-        progress['assignments'].append({'assignment': assignment, 'submission': submission, 'approved': approved})
-
-    # Check final exam status
-    if course.final_exam_enabled and course.final_exam:
-        exam_submission = ExamSubmission.query.filter_by(student_id=user.id, final_exam_id=course.final_exam.id).order_by(ExamSubmission.id.desc()).first()
-        exam_passed = exam_submission and exam_submission.score is not None and exam_submission.score >= course.final_exam.pass_mark
-        progress['final_exam'] = {'exam': course.final_exam, 'submission': exam_submission, 'passed': exam_passed}
-
-        if progress['all_prerequisites_met'] and exam_passed:
-            progress['can_request_certificate'] = True
-        elif not exam_passed:
-            progress['reasons'].append("Final exam not passed.")
-
-    # If final exam is not enabled, certificate eligibility depends only on prerequisites
-    elif not course.final_exam_enabled:
-        if progress['all_prerequisites_met']:
-            progress['can_request_certificate'] = True
-
-    return progress
-
 @main.route('/')
 def home():
     # For the "Featured Courses" section on the home page
@@ -71,7 +37,8 @@ def home():
     for name in category_names:
         category = Category.query.filter_by(name=name).first()
         if category:
-            course = Course.query.filter_by(approved=True, category_id=category.id).first()
+            course = Course.query.filter_by(approved=True, category_id=category.id)\
+                .order_by(Course.rating_avg.desc(), Course.rating_count.desc()).first()
             if course:
                 featured_courses[name] = course
 
@@ -82,10 +49,11 @@ def courses():
     page = request.args.get('page', 1, type=int)
     query = Course.query.filter_by(approved=True)
 
-    # Search
+    # Search - ranked by relevance unless another sort order is chosen
     search_term = request.args.get('search')
+    sort_by = request.args.get('sort', 'relevance' if search_term else 'title')
     if search_term:
-        query = query.filter(Course.title.ilike(f'%{search_term}%'))
+        query = catalog_search.search(query, Course, search_term, rank=sort_by == 'relevance')
 
     # Category filter
     category_ids = request.args.getlist('category')
@@ -100,10 +68,16 @@ def courses():
     if max_price is not None:
         query = query.filter(Course.price_naira <= max_price)
 
-    courses_pagination = query.order_by(Course.title).paginate(page=page, per_page=9)
+    # Sort order
+    if sort_by == 'rating':
+        query = query.order_by(Course.rating_avg.desc(), Course.rating_count.desc(), Course.title)
+    elif sort_by != 'relevance' or not search_term: # 'title' is default
+        query = query.order_by(Course.title)
+
+    courses_pagination = query.paginate(page=page, per_page=9)
     categories = Category.query.all()
 
-    return render_template('courses.html', courses=courses_pagination, categories=categories)
+    return render_template('courses.html', courses=courses_pagination, categories=categories, sort_by=sort_by)
 
 @main.route('/course/<int:course_id>')
 def course_detail(course_id):
@@ -142,18 +116,17 @@ def post_comment(course_id):
     if comment_body and rating:
         comment = Comment(body=comment_body, rating=rating, author=current_user, course=course)
         db.session.add(comment)
+        course.record_rating(rating)
         db.session.commit()
         flash('Your review has been posted.')
 
     return redirect(url_for('main.course_detail', course_id=course.id))
 
-def save_assignment_file(file):
-    random_hex = os.urandom(8).hex()
-    _, f_ext = os.path.splitext(file.filename)
-    filename = random_hex + f_ext
-    filepath = os.path.join(current_app.root_path, 'static/assignments', filename)
-    file.save(filepath)
-    return filename
+def save_assignment_file(file, max_size=None):
+    try:
+        return upload_store.save(file, max_size=max_size)
+    except upload_store.UploadRejected:
+        return None
 
 @main.route('/assignment/<int:assignment_id>', methods=['GET'])
 @login_required
@@ -193,21 +166,19 @@ def submit_assignment(assignment_id):
         return redirect(url_for('main.view_assignment', assignment_id=assignment.id))
 
     if file:
-        # Check file size
-        if assignment.max_file_size:
-            max_bytes = assignment.max_file_size * 1024 * 1024
-            if len(file.read()) > max_bytes:
-                flash(f'File size exceeds the maximum limit of {assignment.max_file_size}MB.', 'danger')
-                return redirect(url_for('main.view_assignment', assignment_id=assignment.id))
-            file.seek(0) # Reset file pointer after reading
-
-        file_path = save_assignment_file(file)
+        # The size is checked while the upload streams to disk, not by reading it into memory
+        max_bytes = assignment.max_file_size * 1024 * 1024 if assignment.max_file_size else None
+        file_path = save_assignment_file(file, max_bytes)
+        if not file_path:
+            flash(f'File size exceeds the maximum limit of {assignment.max_file_size}MB.', 'danger')
+            return redirect(url_for('main.view_assignment', assignment_id=assignment.id))
 
     # Check for existing submission to update it (resubmission)
     submission = AssignmentSubmission.query.filter_by(student_id=current_user.id, assignment_id=assignment.id).first()
     if submission:
         submission.text_submission = text_submission
         if file_path:
+            upload_store.release(submission.file_path)
             submission.file_path = file_path
         submission.submitted_at = datetime.utcnow()
         submission.grade = None # Reset grade on resubmission
@@ -269,17 +240,7 @@ def submit_quiz(quiz_id):
         flash('You have already submitted the maximum number of attempts for this quiz.', 'danger')
         return redirect(url_for('main.course_detail', course_id=quiz.module.course.id))
 
-    score = 0
-    answers = {}
-    questions = quiz.questions.all()
-    for question in questions:
-        user_answer_id = request.form.get(f'q_{question.id}')
-        if user_answer_id:
-            answers[str(question.id)] = user_answer_id
-            if int(user_answer_id) == question.correct_choice_id:
-                score += 1
-
-    final_score = (score / len(questions)) * 100 if questions else 0
+    final_score, answers = exam_grading.grade_quiz(quiz, request.form)
 
     new_submission = QuizSubmission(
         quiz_id=quiz.id,
@@ -338,7 +299,8 @@ def start_exam(exam_id):
         final_exam_id=exam.id,
         student_id=current_user.id,
         attempt_number=submission_count + 1,
-        status='in_progress'
+        status='in_progress',
+        shuffle_seed=random.getrandbits(31)
     )
     db.session.add(new_submission)
     db.session.commit()
@@ -356,7 +318,35 @@ def take_assessment(submission_id):
     exam = submission.final_exam
     # You might want to add more logic here, e.g., to prevent re-opening a submitted exam
 
-    return render_template('take_assessment.html', assessment=exam, submission=submission, preview=False, time_limit=exam.time_limit_minutes, submit_url=url_for('main.submit_exam', submission_id=submission.id))
+    # Restore autosaved answers after a reload or dropped connection
+    saved_answers = {question_id: fields for (_, question_id), (_, fields)
+                     in exam_grading.stored_answers([submission.id]).items()}
+
+    questions = exam_paper.questions_for(exam_paper.get_paper(exam), exam, submission)
+
+    return render_template('take_assessment.html', assessment=exam, questions=questions, submission=submission, preview=False, time_limit=exam.time_limit_minutes,
+                           submit_url=url_for('main.submit_exam', submission_id=submission.id),
+                           autosave_url=url_for('main.autosave_exam', submission_id=submission.id),
+                           saved_answers=saved_answers)
+
+@main.route('/exam/<int:submission_id>/autosave', methods=['POST'])
+@login_required
+def autosave_exam(submission_id):
+    submission = ExamSubmission.query.get_or_404(submission_id)
+    if submission.student_id != current_user.id:
+        abort(403)
+    if submission.status != 'in_progress':
+        return jsonify({'status': 'error', 'message': 'This exam is no longer in progress.'}), 409
+
+    # Same q_<question id> fields as the exam form, sent as JSON or form data
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        form = MultiDict([(field, value) for field, values in data.items()
+                          for value in (values if isinstance(values, list) else [values]) or ['']])
+    else:
+        form = request.form
+    saved = exam_autosave.save(submission, form)
+    return jsonify({'status': 'success', 'saved': saved})
 
 @main.route('/exam/submission/<int:submission_id>/log-violation', methods=['POST'])
 @login_required
@@ -391,47 +381,11 @@ def submit_exam(submission_id):
          flash("This exam has already been submitted or is locked.", "warning")
          return redirect(url_for('main.course_detail', course_id=submission.final_exam.course.id))
 
-    exam = submission.final_exam
-    questions = exam.questions.all()
-    score = 0
-
-    for question in questions:
-        answer_data = {}
-        if question.question_type == 'multiple_choice_single':
-            choice_id = request.form.get(f'q_{question.id}')
-            if choice_id:
-                answer_data['selected_choice_id'] = int(choice_id)
-                choice = Choice.query.get(int(choice_id))
-                if choice and choice.is_correct:
-                    score += question.marks
-        elif question.question_type == 'multiple_choice_multiple':
-            choice_ids = request.form.getlist(f'q_{question.id}')
-            if choice_ids:
-                answer_data['selected_choices'] = [int(cid) for cid in choice_ids]
-                correct_choices = {c.id for c in question.choices if c.is_correct}
-                selected_choices = {int(cid) for cid in choice_ids}
-                if correct_choices == selected_choices:
-                    score += question.marks
-        elif question.question_type == 'true_false':
-            tf_answer = request.form.get(f'q_{question.id}')
-            if tf_answer:
-                answer_data['true_false_answer'] = (tf_answer == 'True')
-                if (tf_answer == 'True') == question.true_false_answer:
-                    score += question.marks
-        else: # short_answer, essay, file_upload
-            # These will be manually graded, so just store the answer
-            answer_data['text_answer'] = request.form.get(f'q_{question.id}')
-            # File upload logic will need to be added here
-
-        answer = Answer(
-            exam_submission_id=submission.id,
-            question_id=question.id,
-            **answer_data
-        )
-        db.session.add(answer)
+    if exam_intake.get_intake():
+        exam_intake.record_submission(submission, request.form)
+        return render_template('post_exam.html', submission=submission)
 
-    total_marks = sum(q.marks for q in questions)
-    submission.score = (score / total_marks) * 100 if total_marks > 0 else 0
+    exam_grading.grade_submission(submission, request.form)
     submission.status = 'pending_review'
     submission.submitted_at = datetime.utcnow()
     db.session.commit()
@@ -447,6 +401,7 @@ def enroll(course_id):
         new_enrollment = Enrollment(user_id=current_user.id, course_id=course.id, status='approved')
         db.session.add(new_enrollment)
         db.session.commit()
+        room_auth.invalidate(user_id=current_user.id)
         flash('You have been successfully enrolled in this free course!', 'success')
         return redirect(url_for('main.course_detail', course_id=course.id))
 
@@ -474,6 +429,7 @@ def submit_payment_proof(course_id):
         # If rejected, create a new one. Otherwise, update existing
         if existing_enrollment and existing_enrollment.status == 'rejected':
             existing_enrollment.status = 'pending'
+            upload_store.release(existing_enrollment.proof_of_payment_path)
             existing_enrollment.proof_of_payment_path = saved_path
             existing_enrollment.timestamp = datetime.utcnow()
         else:
@@ -491,19 +447,15 @@ def submit_payment_proof(course_id):
 
     return redirect(url_for('main.course_detail', course_id=course.id))
 
-from sqlalchemy import or_
-
 @main.route('/library')
 def library():
     query = LibraryMaterial.query.filter_by(approved=True)
 
-    # Search
+    # Search - ranked by relevance unless another sort order is chosen
     search_term = request.args.get('search')
+    sort_by = request.args.get('sort', 'relevance' if search_term else 'newest')
     if search_term:
-        query = query.filter(or_(
-            LibraryMaterial.title.ilike(f'%{search_term}%'),
-            LibraryMaterial.description.ilike(f'%{search_term}%')
-        ))
+        query = catalog_search.search(query, LibraryMaterial, search_term, rank=sort_by == 'relevance')
 
     # Category filter
     category_id = request.args.get('category')
@@ -518,10 +470,9 @@ def library():
         query = query.filter(LibraryMaterial.price_naira > 0)
 
     # Sort order
-    sort_by = request.args.get('sort', 'newest')
     if sort_by == 'popular':
         query = query.order_by(LibraryMaterial.download_count.desc())
-    else: # 'newest' is default
+    elif sort_by != 'relevance' or not search_term: # 'newest' is default
         query = query.order_by(LibraryMaterial.id.desc())
 
     page = request.args.get('page', 1, type=int)
@@ -531,7 +482,8 @@ def library():
     return render_template('library.html',
                            materials=materials_pagination,
                            categories=categories,
-                           search_values=request.args)
+                           search_values=request.args,
+                           sort_by=sort_by)
 
 @main.route('/register', methods=['GET', 'POST'])
 def register():
@@ -593,7 +545,6 @@ def login():
     return render_template('login.html')
 
 import os
-from PIL import Image
 from flask import current_app
 
 @main.route('/logout')
@@ -604,23 +555,12 @@ def logout():
     return redirect(url_for('main.home'))
 
 def save_payment_proof(file):
-    from werkzeug.utils import secure_filename
     allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'pdf'}
-    filename = secure_filename(file.filename)
-    if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
+    try:
+        return upload_store.save(file, allowed_extensions)
+    except upload_store.UploadRejected:
         return None
 
-    random_hex = os.urandom(8).hex()
-    _, f_ext = os.path.splitext(filename)
-    new_filename = random_hex + f_ext
-
-    filepath = os.path.join(current_app.root_path, 'static/payment_proofs', new_filename)
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-
-    file.save(filepath)
-    # Return just the filename
-    return new_filename
-
 @main.route('/library/<int:material_id>/purchase', methods=['GET'])
 @login_required
 def purchase_library_material(material_id):
@@ -654,6 +594,7 @@ def submit_library_payment_proof(material_id):
 
     if existing_purchase and existing_purchase.status == 'rejected':
         existing_purchase.status = 'pending'
+        upload_store.release(existing_purchase.proof_of_payment_path)
         existing_purchase.proof_of_payment_path = saved_path
         existing_purchase.timestamp = datetime.utcnow()
     else:
@@ -670,19 +611,11 @@ def submit_library_payment_proof(material_id):
     return redirect(url_for('main.student_dashboard'))
 
 def save_picture(form_picture):
-    random_hex = os.urandom(8).hex()
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    # Use static_folder which is configurable for tests
-    picture_path = os.path.join(current_app.static_folder, 'profile_pics', picture_fn)
-    os.makedirs(os.path.dirname(picture_path), exist_ok=True)
-
-    output_size = (125, 125)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
-
-    return picture_fn
+    try:
+        # Resized in the background; templates show the variant that fits
+        return image_variants.save(form_picture)
+    except upload_store.UploadRejected:
+        return None
 
 @main.route("/profile")
 @login_required
@@ -706,6 +639,10 @@ def view_user(user_id):
 def edit_profile():
     if request.files.get('profile_pic'):
         picture_file = save_picture(request.files['profile_pic'])
+        if not picture_file:
+            flash('Invalid image file. Allowed types: png, jpg, jpeg, gif, webp.', 'danger')
+            return redirect(url_for('main.profile'))
+        upload_store.release(current_user.profile_pic)
         current_user.profile_pic = picture_file
 
     current_user.name = request.form.get('name', current_user.name)
@@ -731,18 +668,10 @@ def change_password():
     return redirect(url_for('main.profile'))
 
 def save_group_icon(form_picture):
-    random_hex = os.urandom(8).hex()
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(current_app.root_path, 'static/group_icons', picture_fn)
-    os.makedirs(os.path.dirname(picture_path), exist_ok=True)
-
-    output_size = (256, 256)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
-
-    return os.path.join('group_icons', picture_fn)
+    try:
+        return image_variants.save(form_picture)
+    except upload_store.UploadRejected:
+        return None
 
 @main.route('/chat/create', methods=['GET', 'POST'])
 @login_required
@@ -819,6 +748,10 @@ def edit_group_icon(room_id):
             file = request.files['group_icon']
             if file.filename != '':
                 icon_path = save_group_icon(file)
+                if not icon_path:
+                    flash('Invalid image file. Allowed types: png, jpg, jpeg, gif, webp.', 'danger')
+                    return redirect(url_for('main.edit_group_icon', room_id=room.id))
+                upload_store.release(room.cover_image)
                 room.cover_image = icon_path
                 db.session.commit()
                 flash('Group icon updated successfully!', 'success')
@@ -844,6 +777,7 @@ def add_members(room_id):
                 new_member = ChatRoomMember(user_id=user.id, chat_room_id=room.id)
                 db.session.add(new_member)
         db.session.commit()
+        room_auth.invalidate(room_id=room.id)
         flash('Members added successfully!', 'success')
         return redirect(url_for('main.chat_room_info', room_id=room.id))
 
@@ -868,6 +802,7 @@ def join_chat(token):
         new_member = ChatRoomMember(user_id=current_user.id, chat_room_id=room.id)
         db.session.add(new_member)
         db.session.commit()
+        room_auth.invalidate(user_id=current_user.id, room_id=room.id)
         flash('You have successfully joined the group!', 'success')
 
     return redirect(url_for('main.chat_room', room_id=room.id))
@@ -892,24 +827,16 @@ def chat_list():
         ).order_by(ChatRoom.last_message_timestamp.desc().nullslast())
         user_rooms = user_rooms_query.all()
 
+    room_counts = unread_counts.get_room_counts(current_user, [room.id for room in user_rooms])
     room_data = []
     for room in user_rooms:
-        last_read = UserLastRead.query.filter_by(user_id=current_user.id, room_id=room.id).first()
-        last_read_time = last_read.last_read_timestamp if last_read else datetime.min
-
-        unread_count = db.session.query(ChatMessage).filter(
-            ChatMessage.room_id == room.id,
-            ChatMessage.timestamp > last_read_time,
-            ChatMessage.user_id != current_user.id
-        ).count()
-
         room_data.append({
             'id': room.id,
             'name': room.name,
             'description': room.description,
             'cover_image': room.cover_image,
-            'member_count': room.members.count(),
-            'unread_count': unread_count
+            'member_count': room_counts[room.id]['member_count'],
+            'unread_count': room_counts[room.id]['unread_count']
         })
 
     return render_template('chat_list.html', rooms=room_data)
@@ -976,7 +903,11 @@ def upload_chat_file():
     if file:
         file_path, file_name = save_chat_file(file)
         if file_path:
-            return jsonify({'file_path': file_path, 'file_name': file_name})
+            # Held by the messages that share it, which each take a reference with the token
+            upload_store.release(file_path)
+            db.session.commit()
+            return jsonify({'file_path': file_path, 'file_name': file_name,
+                            'file_token': upload_store.upload_token(file_path, current_user.id)})
         else:
             return jsonify({'error': 'Invalid file type'}), 400
 
@@ -1007,83 +938,104 @@ def get_room_users(room_id):
 @main.route('/chat/unread-counts')
 @login_required
 def get_unread_counts():
-    # This is a simplified version. A real app might need a more optimized query.
-
     # Get all rooms the user has access to
-    user_rooms = []
+    room_ids = []
     if current_user.role == 'student':
         general_room = ChatRoom.query.filter_by(room_type='general').first()
         if general_room:
-            user_rooms.append(general_room)
-        enrollments = Enrollment.query.filter_by(user_id=current_user.id, status='approved').all()
-        for enrollment in enrollments:
-            if enrollment.course.chat_room:
-                user_rooms.append(enrollment.course.chat_room)
+            room_ids.append(general_room.id)
+        course_room_ids = db.session.query(ChatRoom.id).join(
+            Enrollment, Enrollment.course_id == ChatRoom.course_id
+        ).filter(Enrollment.user_id == current_user.id, Enrollment.status == 'approved').all()
+        room_ids.extend(room_id for (room_id,) in course_room_ids)
     # Add logic for instructors and admins if they need unread counts too
 
-    unread_counts = {}
-    for room in user_rooms:
-        last_read = UserLastRead.query.filter_by(user_id=current_user.id, room_id=room.id).first()
-        last_read_time = last_read.last_read_timestamp if last_read else datetime.min
-
-        count = ChatMessage.query.filter(
-            ChatMessage.room_id == room.id,
-            ChatMessage.timestamp > last_read_time,
-            ChatMessage.user_id != current_user.id # Don't count user's own messages
-        ).count()
-        unread_counts[room.id] = count
-
-    return jsonify(unread_counts)
+    return jsonify(unread_counts.get_unread_counts(current_user, room_ids))
 
 @main.route('/chat/room/<int:room_id>/search')
 @login_required
 def search_chat_messages(room_id):
-    query = request.args.get('q', '')
+    """Ranked full-text search over a room's messages, paginated with `page` and `per_page`."""
+    query = request.args.get('q', '').strip()
     if not query:
         return jsonify([])
 
-    # Basic authorization check
     room = ChatRoom.query.get_or_404(room_id)
-    # A full authorization check like in chat_events.py should be here
+    if not room_auth.is_user_authorized_for_room(current_user, room):
+        abort(403)
+    message_writer.flush_pending()
 
-    messages = ChatMessage.query.filter(
-        ChatMessage.room_id == room_id,
-        ChatMessage.content.ilike(f'%{query}%')
-    ).order_by(ChatMessage.timestamp.desc()).limit(50).all()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 50)
+    hits = chat_search.search_messages(room_id, query, limit=per_page, offset=(page - 1) * per_page)
 
     results = [{
+        'message_id': msg.id,
         'user_name': msg.author.name,
         'content': msg.content,
+        'highlight': highlight,
         'timestamp': msg.timestamp.isoformat() + "Z"
-    } for msg in messages]
+    } for msg, highlight in hits]
 
     return jsonify(results)
 
 @main.route('/chat/room/<int:room_id>/history')
 @login_required
 def get_chat_history(room_id):
-    # Authorization check could be more robust here
+    """
+    A page of room messages in chronological order. Without a cursor it returns the latest
+    messages; `before_id` scrolls back from a message and `after_id` catches up after one.
+    """
     room = ChatRoom.query.get_or_404(room_id)
-
-    messages = ChatMessage.query.filter_by(room_id=room_id)\
-        .order_by(ChatMessage.timestamp.desc())\
-        .limit(50)\
-        .all()
-
-    # Reverse the messages to be in chronological order
-    messages.reverse()
+    if not room_auth.is_user_authorized_for_room(current_user, room):
+        abort(403)
+    message_writer.flush_pending()
+
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 100)
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+
+    query = ChatMessage.query.filter_by(room_id=room_id).options(joinedload(ChatMessage.author))
+    position = tuple_(ChatMessage.timestamp, ChatMessage.id)
+    cursor_id = after_id or before_id
+    if cursor_id:
+        cursor = db.session.query(ChatMessage.timestamp, ChatMessage.id)\
+            .filter_by(room_id=room_id, id=cursor_id).first()
+        if cursor is None:
+            abort(404)
+
+    if after_id:
+        messages = query.filter(position > tuple(cursor))\
+            .order_by(ChatMessage.timestamp, ChatMessage.id).limit(limit).all()
+    else:
+        if before_id:
+            query = query.filter(position < tuple(cursor))
+        messages = query.order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc()).limit(limit).all()
+        # Reverse the messages to be in chronological order
+        messages.reverse()
+
+    # Reactions for the whole page in one query
+    reactions = {msg.id: [] for msg in messages}
+    if messages:
+        rows = db.session.query(MessageReaction.message_id, MessageReaction.reaction, User.name)\
+            .join(User, User.id == MessageReaction.user_id)\
+            .filter(MessageReaction.message_id.in_(list(reactions)))\
+            .order_by(MessageReaction.id).all()
+        for message_id, reaction, user_name in rows:
+            reactions[message_id].append({'user_name': user_name, 'reaction': reaction})
 
     history = [{
         'user_name': msg.author.name,
         'user_id': msg.author.id,
-        'user_profile_pic': msg.author.profile_pic or 'default.jpg',
+        'user_profile_pic': image_variants.fitting_path(msg.author.profile_pic or 'default.jpg', image_variants.AVATAR_WIDTH),
         'content': msg.content,
         'file_path': msg.file_path,
         'file_name': msg.file_name,
         'timestamp': msg.timestamp.isoformat() + "Z",
         'message_id': msg.id,
         'is_pinned': msg.is_pinned,
-        'reactions': [{'user_name': r.user.name, 'reaction': r.reaction} for r in msg.reactions]
+        'reactions': reactions[msg.id],
+        'reaction_counts': dict(Counter(r['reaction'] for r in reactions[msg.id]))
     } for msg in messages]
 
     return jsonify(history)
@@ -1096,7 +1048,9 @@ def student_dashboard():
         return redirect(url_for('main.home'))
 
     # Course Enrollments
-    enrollments = current_user.enrollments.all()
+    enrollments = current_user.enrollments.options(joinedload(Enrollment.course)).all()
+    approved_courses = [e.course for e in enrollments if e.status == 'approved']
+    progress_by_course = get_progress_for_courses(current_user, approved_courses)
     enrollment_data = []
     active_courses_count = 0
     completed_courses_count = 0
@@ -1104,17 +1058,7 @@ def student_dashboard():
     for enrollment in enrollments:
         progress_data = None
         if enrollment.status == 'approved':
-            progress_data = get_course_progress(current_user, enrollment.course)
-
-            # Calculate progress percentage
-            total_items = len(progress_data['quizzes']) + len(progress_data['assignments'])
-            completed_items = 0
-            if total_items > 0:
-                completed_items += sum(1 for q in progress_data['quizzes'] if q['passed'])
-                completed_items += sum(1 for a in progress_data['assignments'] if a['approved'])
-                progress_data['percentage'] = (completed_items / total_items) * 100
-            else:
-                progress_data['percentage'] = 0
+            progress_data = progress_by_course[enrollment.course_id]
 
             # Update counts
             if progress_data['can_request_certificate']:
@@ -1134,19 +1078,9 @@ def student_dashboard():
     certificates_count = Certificate.query.filter_by(user_id=current_user.id).count()
 
     # Unread Messages Count
-    unread_messages_count = 0
     # Querying ChatRoomMember directly is more robust than relying on the backref
-    memberships = ChatRoomMember.query.filter_by(user_id=current_user.id).all()
-    member_room_ids = [m.chat_room_id for m in memberships]
-    for room_id in member_room_ids:
-        last_read = UserLastRead.query.filter_by(user_id=current_user.id, room_id=room_id).first()
-        last_read_time = last_read.last_read_timestamp if last_read else datetime.min
-        unread_messages_count += db.session.query(ChatMessage).filter(
-            ChatMessage.room_id == room_id,
-            ChatMessage.timestamp > last_read_time,
-            ChatMessage.user_id != current_user.id
-        ).count()
-
+    member_room_ids = [room_id for (room_id,) in db.session.query(ChatRoomMember.chat_room_id).filter_by(user_id=current_user.id).all()]
+    unread_messages_count = sum(unread_counts.get_unread_counts(current_user, member_room_ids).values())
 
     return render_template('student_dashboard.html',
                            enrollment_data=enrollment_data,
@@ -1167,10 +1101,19 @@ def download_library_material(material_id):
             flash('You do not have access to this material.', 'danger')
             return redirect(url_for('main.library'))
 
-    material.download_count += 1
-    db.session.commit()
+    download_counts.record(material)
 
-    return send_from_directory(os.path.join(current_app.root_path, 'static'), material.file_path, as_attachment=True)
+    # Resumes and retries go to the signed link, so they are neither checked nor counted again
+    download_name = (secure_filename(material.title) or 'download') + os.path.splitext(material.file_path)[1]
+    return redirect(file_delivery.signed_url(material.file_path, download_name))
+
+@main.route('/files/<token>/<filename>')
+def deliver_file(token, filename):
+    signed = file_delivery.load(token)
+    if signed is None:
+        abort(403)
+    path, download_name = signed
+    return file_delivery.send(path, download_name)
 
 @main.route('/exam/submission/<int:submission_id>/appeal', methods=['GET'])
 @login_required
@@ -1316,5 +1259,7 @@ def seed_db():
     db.session.add_all([lib1, lib2])
     db.session.commit()
 
+    catalog_search.rebuild_index()
+
     flash('Database has been cleared and re-seeded with sample data.')
     return redirect(url_for('main.home'))
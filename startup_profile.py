@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+# Imported on first use rather than at startup; profile() reports any that a worker loads anyway
+DEFERRED_MODULES = ('weasyprint', 'PIL')
+
+_SCRIPT = '''
+import sys, time
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+create_app()
+print(imported - started, time.perf_counter() - imported)
+print(' '.join(name for name in sys.argv[1:] if name in sys.modules))
+'''
+
+
+def _parse_importtime(output):
+    """[(module, self seconds, cumulative seconds)] from `python -X importtime` output."""
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        if not own.strip().isdigit():
+            continue # The header line
+        modules.append((name.strip(), int(own) / 1e6, int(cumulative) / 1e6))
+    return modules
+
+
+def profile(limit=15):
+    """
+    Imports the app and builds it in a fresh interpreter under `python -X importtime`, as
+    a web worker or `flask` command does on startup. Returns {'import': seconds,
+    'create_app': seconds, 'packages': [(package, seconds)] of the `limit` top-level
+    packages whose modules took longest to import, 'modules': [(module, cumulative
+    seconds)] of the slowest, and 'deferred': the DEFERRED_MODULES that were loaded}.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', _SCRIPT, *DEFERRED_MODULES],
+                            cwd=root, capture_output=True, text=True, check=True)
+    timings, deferred = result.stdout.splitlines()[-2:]
+    import_seconds, create_app_seconds = (float(value) for value in timings.split())
+
+    modules = _parse_importtime(result.stderr)
+    packages = defaultdict(float)
+    for name, own, _ in modules:
+        packages[name.split('.')[0]] += own
+    return {
+        'import': import_seconds,
+        'create_app': create_app_seconds,
+        'packages': sorted(packages.items(), key=lambda item: item[1], reverse=True)[:limit],
+        'modules': sorted(((name, cumulative) for name, _, cumulative in modules),
+                          key=lambda item: item[1], reverse=True)[:limit],
+        'deferred': deferred.split(),
+    }
@@ -0,0 +1,16 @@
+from contextlib import contextmanager
+from sqlalchemy import event
+from extensions import db
+
+
+@contextmanager
+def count_statements():
+    """Collects the SQL of every statement run on db.engine inside the block into the yielded list."""
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
@@ -2,13 +2,21 @@ import unittest
 import sys
 import os
 import shutil
+from datetime import datetime, timedelta
 
 # Add the parent directory to the path so we can import the app
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app import create_app
 from extensions import db
-from models import User, Course, Category, Enrollment
+from models import User, Course, Category, Enrollment, ChatRoom, ChatRoomMember, ChatMessage, Module, Quiz, QuizSubmission, FinalExam, ExamSubmission
+from query_count import count_statements
+import metrics_rollup
+import data_export
+import keyset
+import startup_profile
+import re
+import json
 
 class TestConfig:
     TESTING = True
@@ -51,5 +59,163 @@ class AdminTests(unittest.TestCase):
         self.assertIn(b'Total Users', response.data)
         self.assertIn(b'3', response.data) # 3 users seeded
 
+    def test_dashboard_reads_daily_metric_rollups(self):
+        ten_days_ago = datetime.utcnow() - timedelta(days=10)
+        old_student = User(name='Old Student', email='old@test.com', role='student', approved=True, created_at=ten_days_ago)
+        old_student.set_password('pw')
+        category = Category(name='Category')
+        room = ChatRoom(name='Study Room')
+        db.session.add_all([old_student, category, room])
+        db.session.flush()
+        course = Course(title='Course', instructor_id=self.instructor.id, category_id=category.id, price_naira=0)
+        db.session.add(course)
+        db.session.flush()
+        db.session.add_all([
+            Enrollment(user_id=self.student.id, course_id=course.id, status='approved'),
+            Enrollment(user_id=old_student.id, course_id=course.id, status='pending', timestamp=ten_days_ago),
+            ChatMessage(room_id=room.id, user_id=self.student.id, content='Hi'),
+            ChatMessage(room_id=room.id, user_id=self.student.id, content='Hello', timestamp=ten_days_ago),
+        ])
+        metrics_rollup.record('downloads')
+        metrics_rollup.record('downloads')
+        db.session.commit()
+
+        # Viewing the dashboard never rolls up; it says the metrics are stale instead
+        self.login_admin()
+        response = self.client.get('/admin/dashboard')
+        self.assertIn(b"haven't been rolled up yet", response.data)
+        self.assertIsNone(metrics_rollup.rolled_up_on())
+
+        metrics_rollup.rollup(days=90)
+        trends = metrics_rollup.trends(days=90)
+        self.assertEqual(len(trends['labels']), 90)
+        self.assertEqual(trends['series']['signups'][-1], 3)
+        self.assertEqual(trends['series']['signups'][-11], 1)
+        self.assertEqual(trends['series']['enrollments'][-11], 1)
+        self.assertEqual(sum(trends['series']['chat_messages']), 2)
+        self.assertEqual(trends['series']['downloads'][-1], 2)
+        totals = metrics_rollup.totals()
+        self.assertEqual(totals['users_total'], {'admin': 1, 'instructor': 1, 'student': 2})
+        self.assertEqual(totals['enrollments_total'], {'approved': 1, 'pending': 1})
+        self.assertEqual(metrics_rollup.top_dimensions('chat_messages'), [(str(room.id), 2)])
+
+        # Rolling up again replaces rather than adds to the stored counts
+        metrics_rollup.rollup(days=90)
+        self.assertEqual(metrics_rollup.trends(days=90)['series']['signups'][-1], 3)
+
+        with count_statements() as statements:
+            response = self.client.get('/admin/dashboard')
+        self.assertIn(b'Study Room', response.data)
+        self.assertIn(b'Daily Activity', response.data)
+        self.assertNotIn(b'flask rollup-metrics', response.data)
+        # The dashboard reads the rollup and doesn't count the base tables
+        self.assertFalse([s for s in statements if 'count(' in s.lower() and 'daily_metric' not in s and 'exam_submission' not in s])
+    def test_streaming_exports(self):
+        category = Category(name='Category')
+        room = ChatRoom(name='Study Room')
+        db.session.add_all([category, room])
+        db.session.flush()
+        course = Course(title='Course', instructor_id=self.instructor.id, category_id=category.id, price_naira=0)
+        db.session.add(course)
+        db.session.flush()
+        module = Module(course_id=course.id, title='Week 1', order=1)
+        exam = FinalExam(course_id=course.id, title='Finals')
+        db.session.add_all([module, exam, Enrollment(user_id=self.student.id, course_id=course.id, status='approved'),
+                            ChatMessage(room_id=room.id, user_id=self.student.id, content='Hi, "all"')])
+        db.session.flush()
+        quiz = Quiz(module_id=module.id)
+        db.session.add(quiz)
+        db.session.flush()
+        db.session.add_all([QuizSubmission(quiz_id=quiz.id, student_id=self.student.id, answers={}, score=80.0),
+                            ExamSubmission(final_exam_id=exam.id, student_id=self.student.id, status='released', score=65.0)])
+        db.session.commit()
+
+        self.login_admin()
+        response = self.client.get('/admin/export/users.csv')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'id,name,email,role,approved,is_banned,created_at')
+        self.assertEqual(len(lines), 4)
+
+        response = self.client.get(f'/admin/export/chat-transcript.jsonl?room_id={room.id}')
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([(row['room_name'], row['content']) for row in rows], [('Study Room', 'Hi, "all"')])
+        response = self.client.get(f'/admin/export/enrollments.csv?status=pending')
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), 1)
+        self.assertEqual(self.client.get('/admin/export/passwords.csv').status_code, 404)
+        self.assertEqual(self.client.get('/admin/export/enrollments.csv?course_id=x').status_code, 400)
+
+        self.client.get('/logout')
+        self.client.post('/login', data={'email': 'inst@test.com', 'password': 'pw'})
+        response = self.client.get(f'/instructor/course/{course.id}/export/gradebook.jsonl')
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([(row['item_type'], row['item_title'], row['score']) for row in rows],
+                         [('quiz', 'Week 1', 80.0), ('exam', 'Finals', 65.0)])
+        self.assertEqual(self.client.get(f'/instructor/course/{course.id}/export/users.csv').status_code, 404)
+
+        # Output is produced a batch at a time rather than all at once
+        rows = ((n, f'name {n}') for n in range(data_export.BATCH_SIZE * 2 + 1))
+        chunks = list(data_export.stream(('id', 'name'), rows))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(sum(chunk.count('\n') for chunk in chunks), data_export.BATCH_SIZE * 2 + 2)
+
+        # Text a spreadsheet would run as a formula is quoted in CSV only
+        rows = [(-1, '=HYPERLINK("http://evil")', '@SUM(A1)', 'plain')]
+        self.assertEqual(''.join(data_export.stream(('id', 'name', 'title', 'note'), rows)).splitlines()[1],
+                         '-1,"\'=HYPERLINK(""http://evil"")",\'@SUM(A1),plain')
+        self.assertIn('"name": "=HYPERLINK', ''.join(data_export.stream(('id', 'name', 'title', 'note'), rows, 'jsonl')))
+
+    def test_admin_lists_are_keyset_paginated(self):
+        db.session.add_all([User(name=f'User {n:03}', email=f'user{n}@test.com', role='student', password_hash='x')
+                            for n in range(120)])
+        rooms = [ChatRoom(name=f'Room {n:03}') for n in range(60)]
+        db.session.add_all(rooms)
+        db.session.flush()
+        db.session.add_all([ChatRoomMember(chat_room_id=room.id, user_id=self.student.id) for room in rooms[:3]])
+        db.session.commit()
+
+        # Walking forward then back visits every user once, in name order
+        names, page = [], keyset.paginate(User.query, [User.name, User.id], per_page=50)
+        while True:
+            names += [user.name for user in page.items]
+            if not page.next_cursor:
+                break
+            page = keyset.paginate(User.query, [User.name, User.id], after=page.next_cursor, per_page=50)
+        self.assertEqual(names, sorted(user.name for user in User.query))
+        self.assertEqual(len(page.items), 23)
+        back = keyset.paginate(User.query, [User.name, User.id], before=page.prev_cursor, per_page=50)
+        self.assertEqual([user.name for user in back.items], names[50:100])
+        self.assertIsNotNone(back.prev_cursor)
+
+        self.login_admin()
+        response = self.client.get('/admin/users?role_filter=student')
+        self.assertIn(b'User 000', response.data)
+        self.assertNotIn(b'User 060', response.data)
+        after = re.search(rb'after=(\d+)', response.data).group(1).decode()
+        response = self.client.get(f'/admin/users?role_filter=student&after={after}')
+        self.assertIn(b'User 060', response.data)
+        self.assertNotIn(b'User 000', response.data)
+
+        # Member counts come from one grouped query, whatever the page size
+        with count_statements() as statements:
+            response = self.client.get('/admin/chat')
+        self.assertIn(b'1 members', response.data)
+        self.assertNotIn(b'Room 055', response.data)
+        self.assertEqual(len([s for s in statements if 'FROM chat_room_member' in s]), 1)
+        for path in ('/admin/courses?status=pending', '/admin/library?status=rejected', '/admin/reported-messages'):
+            self.assertEqual(self.client.get(path).status_code, 200)
+
+
+class StartupTests(unittest.TestCase):
+    def test_startup_defers_heavy_imports(self):
+        report = startup_profile.profile(limit=5)
+        self.assertEqual(report['deferred'], [])
+        self.assertGreater(report['import'], 0)
+        self.assertEqual(len(report['packages']), 5)
+        self.assertEqual(report['modules'][0][0], 'app')
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -10,6 +10,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from app import create_app
 from extensions import db
 from models import User, Course, Category, Enrollment, Module, Lesson, Quiz, Assignment, FinalExam, LessonCompletion, QuizSubmission, AssignmentSubmission, ExamSubmission, CertificateRequest, Certificate, Question, Choice
+from query_count import count_statements
 
 class TestConfig:
     TESTING = True
@@ -129,11 +130,19 @@ class CertificateWorkflowTests(unittest.TestCase):
         self.login('admin@test.com', 'pw')
         response = self.client.post(f'/admin/certificate-request/{request_obj.id}/approve', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
-        self.assertIn(b'has been approved and the certificate has been generated', response.data)
+        self.assertIn(b'has been approved and the certificate is being generated', response.data)
+
+        # The PDF is rendered in the background
+        from certificate_renderer import get_renderer
+        renderer = get_renderer()
+        renderer.wait()
+        renderer.shutdown()
 
         # Verify certificate object and file
+        db.session.expire_all()
         cert = Certificate.query.filter_by(user_id=self.student.id, course_id=self.course.id).first()
         self.assertIsNotNone(cert)
+        self.assertEqual(cert.status, 'ready')
         self.assertTrue(os.path.exists(os.path.join(self.app.static_folder, cert.file_path)))
 
         # 6. Student sees certificate on profile
@@ -143,5 +152,141 @@ class CertificateWorkflowTests(unittest.TestCase):
         self.assertIn(bytes(self.course.title, 'utf-8'), response.data)
         self.assertIn(bytes(cert.file_path, 'utf-8'), response.data)
 
+    def test_roster_progress_uses_fixed_query_count(self):
+        from course_progress import get_progress_for_students
+
+        students = [self.student]
+        for i in range(5):
+            student = User(name=f'Student {i}', email=f'stud{i}@test.com', role='student', approved=True)
+            db.session.add(student)
+            students.append(student)
+        db.session.commit()
+        for student in students[1:]:
+            db.session.add(Enrollment(user_id=student.id, course_id=self.course.id, status='approved'))
+        db.session.add(QuizSubmission(student_id=students[1].id, quiz_id=self.quiz.id, score=40, answers={}))
+        db.session.add(QuizSubmission(student_id=students[1].id, quiz_id=self.quiz.id, score=90, answers={}))
+        db.session.add(AssignmentSubmission(student_id=students[1].id, assignment_id=self.assignment.id, grade='A', file_path=''))
+        db.session.commit()
+        db.session.expire_all()
+        self.course = Course.query.get(self.course.id)
+        students = User.query.filter(User.id.in_([s.id for s in students])).order_by(User.id).all()
+
+        with count_statements() as statements:
+            progress = get_progress_for_students(self.course, students)
+
+        self.assertLessEqual(len(statements), 6)
+        self.assertEqual(progress[students[1].id]['quizzes'][0]['submission'].score, 90)
+        self.assertEqual(progress[students[1].id]['percentage'], 100)
+        self.assertEqual(progress[self.student.id]['percentage'], 0)
+
+        self.login('inst@test.com', 'pw')
+        response = self.client.get(f'/instructor/course/{self.course.id}/students')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Student 4', response.data)
+        self.assertIn(b'Progress: 100%', response.data)
+
+    def test_course_rating_aggregate(self):
+        self.course.approved = True
+        self.course.description = 'Desc'
+        db.session.commit()
+
+        self.login('stud@test.com', 'pw')
+        self.client.post(f'/course/{self.course.id}/comment', data={'comment_body': 'Great', 'rating': 5})
+        self.client.post(f'/course/{self.course.id}/comment', data={'comment_body': 'Good', 'rating': 4})
+
+        course = Course.query.get(self.course.id)
+        self.assertEqual((course.rating_sum, course.rating_count), (9, 2))
+        self.assertEqual(course.avg_rating, 4.5)
+
+        response = self.client.get(f'/course/{self.course.id}')
+        self.assertIn(b'Rating: 4.5 / 5.0', response.data)
+
+        # Backfill recomputes the aggregate from the stored comments
+        course.rating_sum, course.rating_count, course.rating_avg = 0, 0, 0
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['backfill-course-ratings'])
+        self.assertIn('Backfilled ratings for 1 courses.', result.output)
+        db.session.expire_all()
+        self.assertEqual(Course.query.get(self.course.id).avg_rating, 4.5)
+
+        response = self.client.get('/courses?sort=rating')
+        self.assertIn(b'4.5 (2)', response.data)
+
+    def test_batch_approval_and_render_retry(self):
+        from certificate_renderer import get_renderer
+        self.app.config.update(CERTIFICATE_RENDER_WORKERS=2, CERTIFICATE_RENDER_MAX_ATTEMPTS=2)
+        other = User(name='Other Student', email='other@test.com', role='student', approved=True)
+        db.session.add(other)
+        db.session.commit()
+        db.session.add_all([
+            CertificateRequest(user_id=self.student.id, course_id=self.course.id),
+            CertificateRequest(user_id=other.id, course_id=self.course.id)
+        ])
+        db.session.commit()
+
+        # Renders fail while the certificates folder cannot be created
+        certificates_dir = os.path.join(self.static_folder, 'certificates')
+        shutil.rmtree(certificates_dir)
+        open(certificates_dir, 'w').close()
+
+        self.login('admin@test.com', 'pw')
+        response = self.client.post('/admin/certificate-requests/approve-all', follow_redirects=True)
+        self.assertIn(b'2 certificate requests have been approved', response.data)
+        self.assertEqual(CertificateRequest.query.filter_by(status='pending').count(), 0)
+        renderer = get_renderer()
+        renderer.wait()
+
+        db.session.expire_all()
+        certificates = Certificate.query.order_by(Certificate.id).all()
+        self.assertEqual([c.status for c in certificates], ['failed', 'failed'])
+        self.assertEqual([c.render_attempts for c in certificates], [2, 2])
+        response = self.client.get('/admin/certificate-requests')
+        self.assertIn(b'Failed Certificate Renders', response.data)
+
+        self.login('stud@test.com', 'pw')
+        response = self.client.get('/profile')
+        self.assertIn(b'Your certificate is being prepared', response.data)
+
+        # Retrying after the problem is fixed renders the certificate
+        os.remove(certificates_dir)
+        self.login('admin@test.com', 'pw')
+        self.client.post(f'/admin/certificate/{certificates[0].id}/retry')
+        renderer.wait()
+        renderer.shutdown()
+
+        db.session.expire_all()
+        certificate = Certificate.query.get(certificates[0].id)
+        self.assertEqual(certificate.status, 'ready')
+        self.assertTrue(os.path.exists(os.path.join(self.static_folder, certificate.file_path)))
+        self.login('stud@test.com', 'pw')
+        response = self.client.get('/profile')
+        self.assertIn(bytes(certificate.file_path, 'utf-8'), response.data)
+
+    def test_bulk_course_certificate_rendering(self):
+        from certificate_renderer import render_course_certificates, get_renderer
+        self.app.config['CERTIFICATE_RENDER_WORKERS'] = 2
+        students = [User(name=f'Graduate {i}', email=f'grad{i}@test.com', role='student', approved=True) for i in range(5)]
+        db.session.add_all(students)
+        db.session.commit()
+        certificates = [Certificate(user_id=student.id, course_id=self.course.id, certificate_uid=str(uuid.uuid4()),
+                                    file_path='', status='queued') for student in students]
+        db.session.add_all(certificates)
+        db.session.commit()
+
+        self.assertEqual(render_course_certificates(self.course), (5, 0))
+        # Certificates that are already ready are skipped unless re-rendering is asked for
+        self.assertEqual(render_course_certificates(self.course), (0, 0))
+        self.assertEqual(render_course_certificates(self.course, rerender=True), (5, 0))
+        get_renderer().shutdown()
+
+        db.session.expire_all()
+        for certificate in Certificate.query.all():
+            self.assertEqual(certificate.status, 'ready')
+            self.assertTrue(os.path.exists(os.path.join(self.static_folder, certificate.file_path)))
+
+        result = self.app.test_cli_runner().invoke(args=['benchmark-certificates', '--count', '4'])
+        self.assertIn('uncached', result.output)
+        self.assertIn('certificates/s', result.output)
+
 if __name__ == "__main__":
     unittest.main()
@@ -3,12 +3,15 @@ import sys
 import os
 import shutil
 from io import BytesIO
+from datetime import timedelta
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app import create_app
 from extensions import db
-from models import User, Category, LibraryMaterial, LibraryPurchase, Course, Enrollment, ChatMessage, MutedUser, ChatRoom
+from models import User, Category, LibraryMaterial, LibraryPurchase, Course, Enrollment, ChatMessage, MutedUser, ChatRoom, ChatRoomMember, ChatUnreadCounter
+from query_count import count_statements
+from extensions import socketio
 
 class TestConfig:
     TESTING = True
@@ -16,10 +19,14 @@ class TestConfig:
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     SECRET_KEY = 'test'
     MAX_CONTENT_LENGTH = 5 * 1024 * 1024 # 5MB for testing
+    IMAGE_VARIANT_WORKERS = 0 # Render image variants inline
 
 class ChatFeaturesTests(unittest.TestCase):
     def setUp(self):
         self.app = create_app(TestConfig)
+        # Uploads go to a temporary static folder rather than the app's own
+        self.static_folder = os.path.join(os.path.dirname(__file__), 'test_chat_static')
+        self.app.static_folder = self.static_folder
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -30,6 +37,7 @@ class ChatFeaturesTests(unittest.TestCase):
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
+        shutil.rmtree(self.static_folder, ignore_errors=True)
 
     def seed_db(self):
         self.admin = User(name='Admin', email='admin@test.com', role='admin', approved=True)
@@ -150,6 +158,296 @@ class ChatFeaturesTests(unittest.TestCase):
         self.assertEqual(json_data[0]['content'], 'Message 0')
         self.assertEqual(json_data[9]['content'], 'Message 9')
 
+    def test_chat_history_keyset_pagination(self):
+        from datetime import datetime
+        from models import MessageReaction
+        room = ChatRoom.query.filter_by(name='General').first()
+        # Equal timestamps are ordered by id
+        timestamp = datetime(2024, 1, 1)
+        messages = [ChatMessage(room_id=room.id, user_id=self.instructor.id, content=f"Message {i}", timestamp=timestamp)
+                    for i in range(7)]
+        db.session.add_all(messages)
+        db.session.commit()
+        for msg in messages[:5]:
+            db.session.add(MessageReaction(message_id=msg.id, user_id=self.student.id, reaction='👍'))
+            db.session.add(MessageReaction(message_id=msg.id, user_id=self.admin.id, reaction='👍'))
+        db.session.commit()
+        ids = [msg.id for msg in messages]
+        room_id = room.id
+
+        self.login('stud@test.com', 'pw')
+
+        with count_statements() as statements:
+            latest = self.client.get(f'/chat/room/{room_id}/history?limit=3').get_json()
+        self.assertEqual([m['message_id'] for m in latest], ids[4:])
+        self.assertEqual(latest[0]['reaction_counts'], {'👍': 2})
+        self.assertEqual(latest[-1]['reaction_counts'], {})
+        # Login user, room, messages with authors, reactions
+        self.assertLessEqual(len(statements), 4)
+
+        older = self.client.get(f'/chat/room/{room_id}/history?limit=3&before_id={ids[4]}').get_json()
+        self.assertEqual([m['message_id'] for m in older], ids[1:4])
+        oldest = self.client.get(f'/chat/room/{room_id}/history?limit=3&before_id={ids[1]}').get_json()
+        # SQLite would read a negative LIMIT as no limit at all
+        self.assertEqual(len(self.client.get(f'/chat/room/{room_id}/history?limit=-1').get_json()), 1)
+        self.assertEqual([m['message_id'] for m in oldest], ids[:1])
+        newer = self.client.get(f'/chat/room/{room_id}/history?after_id={ids[2]}').get_json()
+        self.assertEqual([m['message_id'] for m in newer], ids[3:])
+
+    def test_chat_search_index(self):
+        import chat_search
+        room = ChatRoom.query.filter_by(name='General').first()
+        other_room = ChatRoom(name='Other', room_type='public')
+        db.session.add(other_room)
+        db.session.commit()
+        room_id = room.id
+
+        self.login('stud@test.com', 'pw')
+        socket_client = socketio.test_client(self.app, flask_test_client=self.client)
+        socket_client.emit('message', {'room_id': room_id, 'content': 'The exam schedule is out'})
+        socket_client.emit('message', {'room_id': room_id, 'content': 'Exam exam exam <b>tomorrow</b>'})
+        socket_client.emit('message', {'room_id': room_id, 'content': 'Unrelated chatter'})
+        socket_client.emit('message', {'room_id': other_room.id, 'content': 'Exam in another room'})
+
+        results = self.client.get(f'/chat/room/{room_id}/search?q=exam').get_json()
+        self.assertEqual([r['content'] for r in results], ['Exam exam exam <b>tomorrow</b>', 'The exam schedule is out'])
+        self.assertIn('<mark>Exam</mark>', results[0]['highlight'])
+        self.assertIn('&lt;b&gt;', results[0]['highlight'])
+
+        # Prefix matching on the last word and pagination
+        results = self.client.get(f'/chat/room/{room_id}/search?q=sched').get_json()
+        self.assertEqual([r['content'] for r in results], ['The exam schedule is out'])
+        page_two = self.client.get(f'/chat/room/{room_id}/search?q=exam&per_page=1&page=2').get_json()
+        self.assertEqual([r['content'] for r in page_two], ['The exam schedule is out'])
+
+        # Edits and deletes keep the index in sync
+        message_id = results[0]['message_id']
+        socket_client.emit('edit_message', {'message_id': message_id, 'content': 'The quiz schedule is out'})
+        results = self.client.get(f'/chat/room/{room_id}/search?q=exam').get_json()
+        self.assertEqual(len(results), 1)
+        socket_client.emit('delete_message', {'message_id': message_id})
+        self.assertEqual(self.client.get(f'/chat/room/{room_id}/search?q=quiz').get_json(), [])
+        socket_client.disconnect()
+
+        self.assertEqual(chat_search.rebuild_index(chunk_size=2), 3)
+        self.assertEqual(len(self.client.get(f'/chat/room/{room_id}/search?q=exam').get_json()), 1)
+
+    def test_deleted_room_leaves_search_index(self):
+        import chat_search
+        general = ChatRoom.query.filter_by(name='General').first()
+        private_room = ChatRoom(name='Private', room_type='private')
+        db.session.add(private_room)
+        db.session.commit()
+        general_id = general.id
+        secret = ChatMessage(room_id=private_room.id, user_id=self.instructor.id, content='secret words')
+        db.session.add(secret)
+        db.session.flush()
+        chat_search.index_message(secret)
+        db.session.commit()
+
+        self.login('admin@test.com', 'pw')
+        self.client.post(f'/admin/chat/{private_room.id}/delete')
+        self.assertIsNone(db.session.get(ChatRoom, private_room.id))
+
+        # The next message reuses the deleted message's id
+        self.login('stud@test.com', 'pw')
+        socket_client = socketio.test_client(self.app, flask_test_client=self.client)
+        socket_client.emit('message', {'room_id': general_id, 'content': 'Hello everyone'})
+        socket_client.disconnect()
+        self.assertEqual(ChatMessage.query.filter_by(room_id=general_id).count(), 1)
+        self.assertEqual(self.client.get(f'/chat/room/{general_id}/search?q=secret').get_json(), [])
+        self.assertEqual(len(self.client.get(f'/chat/room/{general_id}/search?q=hello').get_json()), 1)
+
+    def _create_rooms_with_messages(self):
+        rooms = []
+        for i in range(3):
+            room = ChatRoom(name=f'Room {i}', room_type='private')
+            db.session.add(room)
+            db.session.commit()
+            db.session.add(ChatRoomMember(chat_room_id=room.id, user_id=self.student.id))
+            db.session.add(ChatRoomMember(chat_room_id=room.id, user_id=self.instructor.id))
+            for j in range(i + 1):
+                db.session.add(ChatMessage(room_id=room.id, user_id=self.instructor.id, content=f"Hello {j}"))
+            db.session.add(ChatMessage(room_id=room.id, user_id=self.student.id, content="My own message"))
+            rooms.append(room)
+        db.session.commit()
+        return rooms
+
+    def test_room_counts_grouped_query(self):
+        import unread_counts
+        rooms = self._create_rooms_with_messages()
+        counts = unread_counts.get_room_counts(self.student, [room.id for room in rooms])
+        for i, room in enumerate(rooms):
+            self.assertEqual(counts[room.id], {'member_count': 2, 'unread_count': i + 1})
+
+        self.login('stud@test.com', 'pw')
+        response = self.client.get('/student/dashboard')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'<span class="indicator-value">6</span>', response.data)
+
+    def test_unread_counters_maintained_by_chat_events(self):
+        self.app.config['CHAT_UNREAD_COUNTERS'] = True
+        import unread_counts
+        rooms = self._create_rooms_with_messages()
+        room = rooms[0]
+
+        self.login('stud@test.com', 'pw')
+        student_socket = socketio.test_client(self.app, flask_test_client=self.client)
+        student_socket.emit('join', {'room_id': room.id})
+        counter = ChatUnreadCounter.query.filter_by(user_id=self.student.id, room_id=room.id).first()
+        self.assertEqual(counter.unread_count, 0)
+        student_socket.disconnect()
+
+        self.login('inst@test.com', 'pw')
+        instructor_socket = socketio.test_client(self.app, flask_test_client=self.client)
+        instructor_socket.emit('message', {'room_id': room.id, 'content': 'New message'})
+        instructor_socket.emit('message', {'room_id': room.id, 'content': 'Another message'})
+        instructor_socket.disconnect()
+
+        db.session.expire_all()
+        counter = ChatUnreadCounter.query.filter_by(user_id=self.student.id, room_id=room.id).first()
+        self.assertEqual(counter.unread_count, 2)
+
+        # Rooms without a stored counter fall back to the grouped scan
+        counts = unread_counts.get_unread_counts(self.student, [r.id for r in rooms])
+        self.assertEqual(counts, {rooms[0].id: 2, rooms[1].id: 2, rooms[2].id: 3})
+
+        self.assertEqual(unread_counts.rebuild_counters(), 1)
+        counter = ChatUnreadCounter.query.filter_by(user_id=self.student.id, room_id=room.id).first()
+        self.assertEqual(counter.unread_count, 2)
+
+    def test_write_behind_message_persistence(self):
+        import message_writer
+        self.app.config.update(
+            CHAT_WRITE_BEHIND=True,
+            CHAT_WRITE_BEHIND_FLUSH_SIZE=10,
+            CHAT_WRITE_BEHIND_FLUSH_INTERVAL=60,
+            CHAT_WRITE_BEHIND_MAX_BUFFER=3
+        )
+        room = ChatRoom.query.filter_by(name='General').first()
+
+        self.login('stud@test.com', 'pw')
+        socket_client = socketio.test_client(self.app, flask_test_client=self.client)
+        socket_client.emit('join', {'room_id': room.id})
+        for i in range(3):
+            socket_client.emit('message', {'room_id': room.id, 'content': f'Buffered {i}'})
+
+        broadcast = [event['args'] for event in socket_client.get_received() if event['name'] == 'message']
+        self.assertEqual([m['content'] for m in broadcast], ['Buffered 0', 'Buffered 1', 'Buffered 2'])
+        self.assertEqual(len({m['message_id'] for m in broadcast}), 3)
+        self.assertEqual(ChatMessage.query.count(), 0)
+
+        # A full buffer makes the sender flush a batch itself
+        socket_client.emit('message', {'room_id': room.id, 'content': 'Buffered 3'})
+        self.assertEqual(ChatMessage.query.count(), 3)
+
+        writer = message_writer.get_writer()
+        writer.stop()
+        socket_client.disconnect()
+
+        db.session.expire_all()
+        stored = ChatMessage.query.order_by(ChatMessage.id).all()
+        self.assertEqual([m.content for m in stored], ['Buffered 0', 'Buffered 1', 'Buffered 2', 'Buffered 3'])
+        self.assertEqual(ChatRoom.query.get(room.id).last_message_timestamp, stored[-1].timestamp)
+
+    def test_write_behind_drops_rejected_rows_and_flushes_on_sigterm(self):
+        import signal
+        import message_writer
+        self.app.config.update(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_FLUSH_INTERVAL=60)
+        room = ChatRoom.query.filter_by(name='General').first()
+        previous_calls = []
+        original = signal.signal(signal.SIGTERM, lambda signum, frame: previous_calls.append(signum))
+        self.addCleanup(signal.signal, signal.SIGTERM, original)
+        writer = message_writer.get_writer()
+
+        # A row taking an id that is already used is dropped; the rest of its batch is written
+        taken_id = writer.allocate_id()
+        db.session.add(ChatMessage(id=taken_id + 1, room_id=room.id, user_id=self.student.id, content='Written directly'))
+        db.session.commit()
+        for i in range(3):
+            writer.enqueue(room_id=room.id, user_id=self.student.id, content=f'Queued {i}')
+        self.assertEqual(writer.flush_all(), 2)
+        self.assertEqual(writer.pending_count(), 0)
+        contents = [message.content for message in ChatMessage.query.order_by(ChatMessage.id)]
+        self.assertEqual(contents, ['Written directly', 'Queued 1', 'Queued 2'])
+
+        # SIGTERM flushes the queue before the previous handler runs
+        writer.enqueue(room_id=room.id, user_id=self.student.id, content='Before shutdown')
+        os.kill(os.getpid(), signal.SIGTERM)
+        self.assertEqual(previous_calls, [signal.SIGTERM])
+        self.assertEqual(ChatMessage.query.filter_by(content='Before shutdown').count(), 1)
+
+    def test_room_authorization_cache(self):
+        room = ChatRoom(name='Private', room_type='private', created_by_id=self.admin.id)
+        db.session.add(room)
+        db.session.commit()
+        db.session.add(ChatRoomMember(chat_room_id=room.id, user_id=self.student.id))
+        db.session.commit()
+        room_id = room.id
+
+        self.login('stud@test.com', 'pw')
+        socket_client = socketio.test_client(self.app, flask_test_client=self.client)
+        socket_client.emit('message', {'room_id': room_id, 'content': 'First'})
+
+        with count_statements() as statements:
+            socket_client.emit('message', {'room_id': room_id, 'content': 'Second'})
+        self.assertEqual([s for s in statements if 'FROM chat_room_member' in s or 'FROM enrollment' in s], [])
+        self.assertEqual(ChatMessage.query.filter_by(room_id=room_id).count(), 2)
+
+        # Removing the student through the admin page drops the cached decision
+        self.login('admin@test.com', 'pw')
+        self.client.post(f'/admin/chat/{room_id}/members', data={'members': []})
+        self.login('stud@test.com', 'pw')
+        socket_client.emit('message', {'room_id': room_id, 'content': 'Third'})
+        self.assertEqual(ChatMessage.query.filter_by(room_id=room_id).count(), 2)
+        socket_client.disconnect()
+
+    def test_shared_files_are_stored_once(self):
+        from models import StoredFile
+        import upload_store
+        self.login('stud@test.com', 'pw')
+
+        paths, tokens = [], []
+        for name in ('lecture.pdf', 'lecture-copy.pdf'):
+            response = self.client.post('/chat/upload', data={'file': (BytesIO(b'%PDF lecture notes'), name)},
+                                        content_type='multipart/form-data')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['file_name'], name)
+            paths.append(response.get_json()['file_path'])
+            tokens.append(response.get_json()['file_token'])
+
+        self.assertEqual(paths[0], paths[1])
+        stored = StoredFile.query.one()
+        self.assertEqual(stored.size, len(b'%PDF lecture notes'))
+        blob = os.path.join(self.app.static_folder, *paths[0].split('/'))
+        with open(blob, 'rb') as f:
+            self.assertEqual(f.read(), b'%PDF lecture notes')
+        response = self.client.post('/chat/upload', data={'file': (BytesIO(b'x'), 'script.exe')},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 400)
+
+        # Each message sharing the file holds a reference; paths and other users' tokens are refused
+        room_id = ChatRoom.query.filter_by(name='General').first().id
+        socket_client = socketio.test_client(self.app, flask_test_client=self.client)
+        socket_client.emit('message', {'room_id': room_id, 'file_token': tokens[0], 'file_name': 'lecture.pdf'})
+        socket_client.emit('message', {'room_id': room_id, 'file_token': tokens[0], 'file_name': 'lecture.pdf'})
+        socket_client.emit('message', {'room_id': room_id, 'file_path': paths[0], 'file_name': 'lecture.pdf'})
+        other_token = upload_store.upload_token(paths[0], self.instructor.id)
+        socket_client.emit('message', {'room_id': room_id, 'file_token': other_token, 'file_name': 'lecture.pdf'})
+        messages = ChatMessage.query.filter_by(room_id=room_id).order_by(ChatMessage.id).all()
+        self.assertEqual([message.file_path for message in messages], [paths[0], paths[0]])
+        db.session.refresh(stored)
+        self.assertEqual(stored.ref_count, 2)
+
+        # A blob outlives one of its messages and is pruned only after the last
+        socket_client.emit('delete_message', {'message_id': messages[0].id})
+        self.assertEqual(upload_store.prune(grace=timedelta(0)), 0)
+        self.assertTrue(os.path.exists(blob))
+        socket_client.emit('delete_message', {'message_id': messages[1].id})
+        socket_client.disconnect()
+        self.assertEqual(upload_store.prune(grace=timedelta(0)), 1)
+        self.assertEqual(StoredFile.query.count(), 0)
+        self.assertFalse(os.path.exists(blob))
 
 if __name__ == "__main__":
     unittest.main()
@@ -7,13 +7,20 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app import create_app
 from extensions import db
-from models import User, Course, Category, Module, FinalExam, Question, Choice, Enrollment, ExamSubmission
+from models import User, Course, Category, Module, FinalExam, Question, Choice, Enrollment, ExamSubmission, Answer, Quiz, QuizSubmission
+from query_count import count_statements
+import exam_grading
+import exam_paper
+import exam_intake
+import exam_analytics
+import re
 
 class TestConfig:
     TESTING = True
     WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     SECRET_KEY = 'test'
+    EXAM_ANALYTICS_REFRESH_DELAY = 0
 
 class ExamFeaturesTests(unittest.TestCase):
     def setUp(self):
@@ -34,7 +41,9 @@ class ExamFeaturesTests(unittest.TestCase):
         self.instructor.set_password('pw')
         self.student = User(name='Student', email='stud@test.com', role='student', approved=True)
         self.student.set_password('pw')
-        db.session.add_all([self.instructor, self.student])
+        self.admin = User(name='Admin', email='admin@test.com', role='admin', approved=True)
+        self.admin.set_password('pw')
+        db.session.add_all([self.instructor, self.student, self.admin])
         db.session.commit()
 
         category = Category(name='Test Category')
@@ -131,6 +140,481 @@ class ExamFeaturesTests(unittest.TestCase):
         self.assertIn(b'Request Certificate', response.data)
         self.assertNotIn(b'disabled', response.data)
 
+    def test_exam_grading_uses_cached_answer_key(self):
+        exam = FinalExam(course_id=self.course_id, time_limit_minutes=60, pass_mark=50, is_published=True)
+        db.session.add(exam)
+        db.session.commit()
+        single = []
+        for i in range(6):
+            question = Question(exam_id=exam.id, question_text=f'Single {i}', question_type='multiple_choice_single',
+                                marks=1, negative_marking=0.5)
+            db.session.add(question)
+            db.session.flush()
+            choices = [Choice(question_id=question.id, choice_text=str(n), is_correct=(n == 2)) for n in range(4)]
+            db.session.add_all(choices)
+            single.append((question, choices))
+        multiple = Question(exam_id=exam.id, question_text='Pick two', question_type='multiple_choice_multiple', marks=2)
+        true_false = Question(exam_id=exam.id, question_text='True?', question_type='true_false', marks=1, true_false_answer=True)
+        essay = Question(exam_id=exam.id, question_text='Explain', question_type='essay', marks=2)
+        db.session.add_all([multiple, true_false, essay])
+        db.session.flush()
+        multiple_choices = [Choice(question_id=multiple.id, choice_text=str(n), is_correct=(n < 2)) for n in range(4)]
+        db.session.add_all(multiple_choices)
+        db.session.add(Enrollment(user_id=self.student.id, course_id=self.course_id, status='approved'))
+        db.session.commit()
+
+        self.login('stud@test.com', 'pw')
+        self.client.post(f'/exam/{exam.id}/start')
+        submission = ExamSubmission.query.filter_by(final_exam_id=exam.id, student_id=self.student.id).first()
+
+        # Four singles right, one wrong (-0.5), one unanswered; both multiple-answer choices; true/false right
+        data = {f'q_{question.id}': choices[2].id for question, choices in single[:4]}
+        data[f'q_{single[4][0].id}'] = single[4][1][0].id
+        data[f'q_{multiple.id}'] = [multiple_choices[0].id, multiple_choices[1].id]
+        data[f'q_{true_false.id}'] = 'True'
+        data[f'q_{essay.id}'] = 'Because.'
+
+        with count_statements() as statements:
+            response = self.client.post(f'/exam/{submission.id}/submit', data=data)
+        self.assertEqual(response.status_code, 200)
+
+        db.session.expire_all()
+        submission = ExamSubmission.query.get(submission.id)
+        # (4 - 0.5 + 2 + 1) out of 6 + 2 + 1 + 2
+        self.assertAlmostEqual(submission.score, 6.5 / 11 * 100)
+        self.assertEqual(Answer.query.filter_by(exam_submission_id=submission.id).count(), 9)
+        essay_answer = Answer.query.filter_by(exam_submission_id=submission.id, question_id=essay.id).one()
+        self.assertEqual(essay_answer.text_answer, 'Because.')
+        # The answer key is one query and the answers one bulk insert, however many questions there are
+        self.assertEqual(len([s for s in statements if 'FROM question' in s]), 1)
+        self.assertEqual(len([s for s in statements if s.startswith('INSERT INTO answer')]), 1)
+
+        # The key is cached until the instructor changes the exam
+        self.assertIs(exam_grading.get_answer_key(exam), exam_grading.get_answer_key(exam))
+        before = exam_grading.get_answer_key(exam)
+        self.login('inst@test.com', 'pw')
+        self.client.post(f'/instructor/exam/{exam.id}/add_question', data={
+            'question_type': 'true_false', 'question_text': 'False?', 'true_false_answer': 'False'
+        })
+        db.session.refresh(exam)
+        after = exam_grading.get_answer_key(exam)
+        self.assertIsNot(before, after)
+        self.assertEqual(len(after.questions), 10)
+        self.assertEqual(after.total_marks, 12)
+
+    def test_deferred_grading_with_submission_intake(self):
+        self.app.config['EXAM_SUBMISSION_INTAKE'] = True
+        self.app.config['EXAM_GRADING_WORKERS'] = 2
+        self.test_exam_creation_and_question_management()
+        exam = FinalExam.query.first()
+        question = exam.questions.first()
+        correct_choice = Choice.query.filter_by(question_id=question.id, is_correct=True).first()
+
+        self.login('stud@test.com', 'pw')
+        self.client.get(f'/course/{self.course_id}/enroll', follow_redirects=True)
+        self.client.post(f'/exam/{exam.id}/start')
+        submission = ExamSubmission.query.filter_by(final_exam_id=exam.id, student_id=self.student.id).first()
+
+        # The submission is acknowledged before it is graded
+        intake = exam_intake.get_intake()
+        intake._ensure_started = lambda: None
+        response = self.client.post(f'/exam/{submission.id}/submit', data={f'q_{question.id}': correct_choice.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Your answers are being graded', response.data)
+        db.session.expire_all()
+        submission = ExamSubmission.query.get(submission.id)
+        self.assertEqual(submission.status, 'submitted')
+        self.assertEqual(submission.submitted_payload, {f'q_{question.id}': [str(correct_choice.id)]})
+        self.assertIsNone(submission.score)
+
+        self.login('admin@test.com', 'pw')
+        self.assertEqual(self.client.get('/admin/metrics/exam-grading-queue').get_json()['waiting'], 1)
+
+        # Workers started later pick up the stored backlog; fully auto-graded exams are released
+        del intake._ensure_started
+        intake._ensure_started()
+        intake.wait()
+        db.session.expire_all()
+        submission = ExamSubmission.query.get(submission.id)
+        self.assertEqual(submission.status, 'released')
+        self.assertEqual(submission.score, 100.0)
+        self.assertIsNone(submission.submitted_payload)
+        self.assertEqual(exam_intake.queue_depth()['waiting'], 0)
+        # Already graded, so a second grading attempt is a no-op
+        self.assertFalse(exam_intake.grade_queued(submission.id))
+        self.assertEqual(Answer.query.filter_by(exam_submission_id=submission.id).count(), 1)
+
+    def test_exam_autosave_restores_answers(self):
+        self.test_exam_creation_and_question_management()
+        exam = FinalExam.query.first()
+        question = exam.questions.first()
+        essay = Question(exam_id=exam.id, question_text='Explain', question_type='essay', marks=1)
+        db.session.add(essay)
+        exam_grading.invalidate(exam)
+        exam_paper.publish(exam)
+        db.session.commit()
+        choices = question.choices.order_by(Choice.id).all()
+
+        self.login('stud@test.com', 'pw')
+        self.client.get(f'/course/{self.course_id}/enroll', follow_redirects=True)
+        self.client.post(f'/exam/{exam.id}/start')
+        submission = ExamSubmission.query.filter_by(final_exam_id=exam.id, student_id=self.student.id).first()
+        autosave_url = f'/exam/{submission.id}/autosave'
+
+        # Later saves of the same question replace the stored answer
+        self.client.post(autosave_url, json={f'q_{question.id}': str(choices[0].id), f'q_{essay.id}': 'Draft'})
+        response = self.client.post(autosave_url, json={f'q_{question.id}': str(choices[1].id)})
+        self.assertEqual(response.get_json(), {'status': 'success', 'saved': 1})
+        self.assertEqual(Answer.query.count(), 2)
+
+        # Reopening the exam restores them into the form
+        response = self.client.get(f'/assessment/{submission.id}')
+        self.assertIn(f'value="{choices[1].id}"\n                                       checked'.encode(), response.data)
+        self.assertIn(b'>Draft</textarea>', response.data)
+        self.assertEqual(Answer.query.count(), 2)
+
+        # The submission carries every answer, and replaces the autosaved ones
+        self.client.post(autosave_url, json={f'q_{essay.id}': 'Draft again'})
+        response = self.client.post(f'/exam/{submission.id}/submit',
+                                    data={f'q_{question.id}': str(choices[1].id), f'q_{essay.id}': 'Final answer'})
+        self.assertEqual(response.status_code, 200)
+        db.session.expire_all()
+        submission = ExamSubmission.query.get(submission.id)
+        self.assertEqual(submission.score, 50.0)
+        self.assertEqual(Answer.query.count(), 2)
+        answer = Answer.query.filter_by(question_id=question.id).one()
+        self.assertEqual((answer.selected_choice_id, answer.marks_awarded), (choices[1].id, 1))
+        self.assertEqual(Answer.query.filter_by(question_id=essay.id).one().text_answer, 'Final answer')
+
+        response = self.client.post(autosave_url, json={f'q_{essay.id}': 'Too late'})
+        self.assertEqual(response.status_code, 409)
+
+    def test_exam_submission_is_the_whole_answer_sheet(self):
+        exam = FinalExam(course_id=self.course_id, time_limit_minutes=60, pass_mark=50, is_published=True)
+        db.session.add(exam)
+        db.session.commit()
+        multiple = Question(exam_id=exam.id, question_text='Pick two', question_type='multiple_choice_multiple',
+                            marks=2, negative_marking=1)
+        single = Question(exam_id=exam.id, question_text='Pick one', question_type='multiple_choice_single', marks=2)
+        db.session.add_all([multiple, single])
+        db.session.flush()
+        multiple_choices = [Choice(question_id=multiple.id, choice_text=str(n), is_correct=(n < 2)) for n in range(4)]
+        single_choices = [Choice(question_id=single.id, choice_text=str(n), is_correct=(n == 0)) for n in range(2)]
+        db.session.add_all(multiple_choices + single_choices)
+        db.session.add(Enrollment(user_id=self.student.id, course_id=self.course_id, status='approved'))
+        db.session.commit()
+
+        self.login('stud@test.com', 'pw')
+        self.client.post(f'/exam/{exam.id}/start')
+        submission = ExamSubmission.query.filter_by(final_exam_id=exam.id, student_id=self.student.id).first()
+        self.client.post(f'/exam/{submission.id}/autosave',
+                         json={f'q_{multiple.id}': [str(multiple_choices[3].id)], f'q_{single.id}': str(single_choices[0].id)})
+
+        # Clearing the checkboxes sends no field, so the wrong autosaved choice isn't graded or penalised
+        response = self.client.post(f'/exam/{submission.id}/submit', data={f'q_{single.id}': single_choices[0].id})
+        self.assertEqual(response.status_code, 200)
+        db.session.expire_all()
+        self.assertEqual(ExamSubmission.query.get(submission.id).score, 50.0)
+        answer = Answer.query.filter_by(exam_submission_id=submission.id, question_id=multiple.id).one()
+        self.assertEqual((answer.selected_choices, answer.marks_awarded), (None, None))
+
+    def test_exam_paper_cache_and_stable_shuffle(self):
+        exam = FinalExam(course_id=self.course_id, time_limit_minutes=30, pass_mark=50, shuffle_questions=True)
+        db.session.add(exam)
+        db.session.commit()
+        for i in range(8):
+            question = Question(exam_id=exam.id, question_text=f'Question {i}', question_type='multiple_choice_single', shuffle_choices=True)
+            db.session.add(question)
+            db.session.flush()
+            db.session.add_all([Choice(question_id=question.id, choice_text=f'{i}.{n}', is_correct=(n == 0)) for n in range(4)])
+        db.session.add(Enrollment(user_id=self.student.id, course_id=self.course_id, status='approved'))
+        db.session.commit()
+        exam_id = exam.id
+
+        self.login('inst@test.com', 'pw')
+        self.client.post(f'/instructor/exam/{exam_id}/publish')
+        db.session.expire_all()
+        exam = FinalExam.query.get(exam_id)
+        self.assertEqual(exam.paper['version'], exam.answer_key_version)
+        self.assertEqual(len(exam.paper['questions']), 8)
+        self.assertNotIn('is_correct', exam.paper['questions'][0]['choices'][0])
+
+        self.login('stud@test.com', 'pw')
+        self.client.post(f'/exam/{exam_id}/start')
+        submission = ExamSubmission.query.filter_by(final_exam_id=exam_id).first()
+        self.assertIsNotNone(submission.shuffle_seed)
+
+        def choice_order():
+            response = self.client.get(f'/assessment/{submission.id}')
+            return re.findall(rb'id="q_(\d+)_c_(\d+)"', response.data)
+
+        first = choice_order()
+        with count_statements() as statements:
+            second = choice_order()
+
+        # Reloads show the same order and never touch the question bank
+        self.assertEqual(first, second)
+        self.assertEqual(len(first), 32)
+        self.assertFalse([s for s in statements if 'FROM question' in s or 'FROM choice' in s])
+
+        expected = [(str(q['id']).encode(), str(c['id']).encode())
+                    for q in exam_paper.questions_for(exam.paper, exam, submission) for c in q['choices']]
+        self.assertEqual(first, expected)
+        natural = [(str(q['id']).encode(), str(c['id']).encode()) for q in exam.paper['questions'] for c in q['choices']]
+        self.assertNotEqual(first, natural)
+
+        # Adding a question stores a new paper, and the cached one is retired
+        self.login('inst@test.com', 'pw')
+        self.client.post(f'/instructor/exam/{exam_id}/add_question', data={
+            'question_type': 'true_false', 'question_text': 'Added later', 'true_false_answer': 'True'
+        })
+        db.session.expire_all()
+        exam = db.session.get(FinalExam, exam_id)
+        self.assertEqual(exam.paper['version'], exam.answer_key_version)
+        self.assertEqual(len(exam.paper['questions']), 9)
+        self.login('stud@test.com', 'pw')
+        response = self.client.get(f'/assessment/{submission.id}')
+        self.assertIn(b'Added later', response.data)
+
+    def test_quiz_grading_query_count_is_constant(self):
+        module = Module(course_id=self.course_id, title='Module', order=1)
+        db.session.add(module)
+        db.session.add(Enrollment(user_id=self.student.id, course_id=self.course_id, status='approved'))
+        db.session.commit()
+        quiz = Quiz(module_id=module.id, attempt_limit=10)
+        db.session.add(quiz)
+        db.session.commit()
+        quiz_id = quiz.id
+
+        # Questions added by the instructor record their correct choice
+        self.login('inst@test.com', 'pw')
+        self.client.post(f'/instructor/quiz/{quiz_id}/add_question', data={
+            'question_text': '2+2?', 'choice1': '3', 'choice2': '4', 'choice3': '5', 'choice4': '6', 'correct_choice': '1'
+        })
+        question = Question.query.filter_by(quiz_id=quiz_id).one()
+        self.assertEqual([c.choice_text for c in question.choices if c.is_correct], ['4'])
+
+        def add_questions(count):
+            for i in range(count):
+                q = Question(quiz_id=quiz_id, question_text=f'Extra {i}', question_type='true_false', true_false_answer=bool(i % 2))
+                db.session.add(q)
+            db.session.flush()
+            exam_grading.invalidate(Quiz.query.get(quiz_id))
+            db.session.commit()
+
+        def submit(all_correct):
+            db.session.expire_all()
+            questions = Question.query.filter_by(quiz_id=quiz_id).order_by(Question.id).all()
+            data = {}
+            for q in questions:
+                if q.question_type == 'true_false':
+                    data[f'q_{q.id}'] = str(q.true_false_answer if all_correct else not q.true_false_answer)
+                else:
+                    data[f'q_{q.id}'] = next(c.id for c in q.choices if c.is_correct == all_correct)
+            with count_statements() as statements:
+                self.client.post(f'/quiz/{quiz_id}/submit', data=data)
+            return QuizSubmission.query.order_by(QuizSubmission.id.desc()).first(), statements
+
+        self.login('stud@test.com', 'pw')
+        add_questions(4)
+        submit(True)  # Warms the answer key cache
+        small, small_statements = submit(True)
+        self.assertEqual(small.score, 100.0)
+        self.assertEqual(small.answers[str(question.id)], next(c.id for c in question.choices if c.is_correct))
+
+        add_questions(40)
+        submit(False)
+        large, large_statements = submit(False)
+        self.assertEqual(large.score, 0.0)
+        self.assertEqual(len(large.answers), 45)
+        self.assertEqual(len(small_statements), len(large_statements))
+        self.assertFalse([s for s in large_statements if 'FROM question' in s or 'FROM choice' in s])
+
+    def test_question_major_bulk_grading(self):
+        exam = FinalExam(course_id=self.course_id, time_limit_minutes=30, pass_mark=50, is_published=True)
+        db.session.add(exam)
+        db.session.commit()
+        self.login('inst@test.com', 'pw')
+        self.client.post(f'/instructor/exam/{exam.id}/add_question', data={
+            'question_type': 'true_false', 'question_text': 'Sky is blue?', 'true_false_answer': 'True'
+        })
+        self.client.post(f'/instructor/exam/{exam.id}/add_question', data={
+            'question_type': 'essay', 'question_text': 'Why?'
+        })
+        db.session.expire_all()
+        exam = FinalExam.query.first()
+        self.assertEqual(exam.total_marks, 2)
+        true_false, essay = exam.questions.order_by(Question.id).all()
+
+        students = []
+        for i in range(3):
+            student = User(name=f'Student {i}', email=f's{i}@test.com', role='student', approved=True)
+            student.set_password('pw')
+            db.session.add(student)
+            db.session.flush()
+            db.session.add(Enrollment(user_id=student.id, course_id=self.course_id, status='approved'))
+            students.append(student)
+        db.session.commit()
+        for i, student in enumerate(students):
+            self.login(student.email, 'pw')
+            self.client.post(f'/exam/{exam.id}/start')
+            submission = ExamSubmission.query.filter_by(student_id=student.id).one()
+            self.client.post(f'/exam/{submission.id}/submit', data={f'q_{true_false.id}': 'True', f'q_{essay.id}': f'Essay {i}'})
+
+        self.login('inst@test.com', 'pw')
+        response = self.client.get(f'/instructor/exam/{exam.id}/submissions')
+        self.assertIn(f'/instructor/exam/{exam.id}/question/{essay.id}/grade'.encode(), response.data)
+        response = self.client.get(f'/instructor/exam/{exam.id}/question/{essay.id}/grade?ungraded=1')
+        for i in range(3):
+            self.assertIn(f'Essay {i}'.encode(), response.data)
+        self.assertEqual(self.client.get(f'/instructor/exam/{exam.id}/question/{true_false.id}/grade').status_code, 404)
+
+        # Marks above the question's marks reject the whole batch
+        answers = Answer.query.filter_by(question_id=essay.id).order_by(Answer.id).all()
+        data = {f'marks_{answer.id}': '0.5' for answer in answers}
+        data[f'marks_{answers[0].id}'] = '2'
+        response = self.client.post(f'/instructor/exam/{exam.id}/question/{essay.id}/grade', data=data, follow_redirects=True)
+        self.assertIn(b'No grades were saved', response.data)
+        self.assertEqual(Answer.query.filter(Answer.question_id == essay.id, Answer.marks_awarded.isnot(None)).count(), 0)
+
+        data = {f'marks_{answer.id}': '0.5' for answer in answers}
+        data[f'feedback_{answers[1].id}'] = 'Good'
+        with count_statements() as statements:
+            response = self.client.post(f'/instructor/exam/{exam.id}/question/{essay.id}/grade?ungraded=1', data=data, follow_redirects=True)
+        self.assertIn(b'Saved grades for 3 answers', response.data)
+        self.assertIn(b'Every answer to this question has been graded', response.data)
+        self.assertEqual(len([s for s in statements if s.startswith('UPDATE answer')]), 1)
+        self.assertEqual(len([s for s in statements if s.startswith('UPDATE exam_submission')]), 1)
+
+        db.session.expire_all()
+        self.assertEqual([s.score for s in ExamSubmission.query.order_by(ExamSubmission.id)], [75.0, 75.0, 75.0])
+        self.assertEqual(Answer.query.get(answers[1].id).feedback, 'Good')
+        self.assertEqual(Answer.query.get(answers[1].id).graded_by_id, self.instructor.id)
+
+        # The JSON API grades across questions and submissions in one call
+        response = self.client.post(f'/instructor/exam/{exam.id}/grades', json={'grades': [
+            {'answer_id': answers[0].id, 'marks': 1}, {'answer_id': answers[2].id, 'marks': 0}
+        ]})
+        self.assertEqual(response.get_json(), {'status': 'success', 'graded': 2})
+        tf_answer = Answer.query.filter_by(question_id=true_false.id).first()
+        response = self.client.post(f'/instructor/exam/{exam.id}/grades', json={'grades': [{'answer_id': tf_answer.id, 'marks': 1}]})
+        self.assertEqual(response.status_code, 400)
+        db.session.expire_all()
+        self.assertEqual([s.score for s in ExamSubmission.query.order_by(ExamSubmission.id)], [100.0, 75.0, 50.0])
+
+        # Answers of an exam still being taken can't be graded, nor are they listed
+        late = User(name='Late Student', email='late@test.com', role='student', approved=True)
+        late.set_password('pw')
+        db.session.add(late)
+        db.session.flush()
+        db.session.add(Enrollment(user_id=late.id, course_id=self.course_id, status='approved'))
+        db.session.commit()
+        self.login('late@test.com', 'pw')
+        self.client.post(f'/exam/{exam.id}/start')
+        late_submission = ExamSubmission.query.filter_by(student_id=late.id).one()
+        self.client.post(f'/exam/{late_submission.id}/autosave', json={f'q_{essay.id}': 'Half written'})
+        late_answer = Answer.query.filter_by(exam_submission_id=late_submission.id, question_id=essay.id).one()
+        self.login('inst@test.com', 'pw')
+        response = self.client.post(f'/instructor/exam/{exam.id}/grades', json={'grades': [{'answer_id': late_answer.id, 'marks': 1}]})
+        self.assertEqual(response.get_json()['rejected'], [late_answer.id])
+        self.assertNotIn(b'Half written', self.client.get(f'/instructor/exam/{exam.id}/question/{essay.id}/grade').data)
+        response = self.client.post(f'/instructor/submission/{late_submission.id}/review',
+                                    data={f'marks_{late_answer.id}': '1'}, follow_redirects=True)
+        self.assertIn(b'has not been graded yet', response.data)
+        response = self.client.post(f'/instructor/submission/{late_submission.id}/release', follow_redirects=True)
+        self.assertIn(b'has not been graded yet', response.data)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(ExamSubmission, late_submission.id).status, 'in_progress')
+        self.assertIsNone(db.session.get(Answer, late_answer.id).marks_awarded)
+
+        # Per-submission review still grades and releases one submission
+        submission_id = answers[2].exam_submission_id
+        self.assertIn(b'Essay 2', self.client.get(f'/instructor/submission/{submission_id}/review').data)
+        self.client.post(f'/instructor/submission/{submission_id}/review', data={f'marks_{answers[2].id}': '1'})
+        submission = ExamSubmission.query.get(submission_id)
+        self.assertEqual((submission.score, submission.status), (100.0, 'released'))
+
+    def test_exam_analytics_refresh(self):
+        exam = FinalExam(course_id=self.course_id, time_limit_minutes=30, pass_mark=50, is_published=True)
+        db.session.add(exam)
+        db.session.commit()
+        questions = []
+        for i in range(2):
+            question = Question(exam_id=exam.id, question_text=f'Single {i}', question_type='multiple_choice_single', marks=1)
+            db.session.add(question)
+            db.session.flush()
+            choices = [Choice(question_id=question.id, choice_text=str(n), is_correct=(n == 0)) for n in range(3)]
+            db.session.add_all(choices)
+            questions.append((question, choices))
+        true_false = Question(exam_id=exam.id, question_text='True?', question_type='true_false', marks=1, true_false_answer=True)
+        db.session.add(true_false)
+        db.session.commit()
+        exam_grading.invalidate(exam)
+        db.session.commit()
+
+        # Student i gets the first 3 - i questions right: scores 100, 66.7, 33.3 and 0
+        for i in range(4):
+            student = User(name=f'Student {i}', email=f's{i}@test.com', role='student', approved=True)
+            student.set_password('pw')
+            db.session.add(student)
+            db.session.flush()
+            db.session.add(Enrollment(user_id=student.id, course_id=self.course_id, status='approved'))
+            db.session.commit()
+            self.login(student.email, 'pw')
+            self.client.post(f'/exam/{exam.id}/start')
+            submission = ExamSubmission.query.filter_by(student_id=student.id).one()
+            data = {f'q_{question.id}': choices[0 if n < 3 - i else 1].id for n, (question, choices) in enumerate(questions)}
+            data[f'q_{true_false.id}'] = 'True' if i == 0 else 'False'
+            self.client.post(f'/exam/{submission.id}/submit', data=data)
+
+        db.session.expire_all()
+        exam = FinalExam.query.get(exam.id)
+        self.assertTrue(exam.analytics_stale)
+        self.assertIsNone(exam.analytics)
+        self.assertEqual(exam_analytics.refresh_stale(), 1)
+
+        db.session.expire_all()
+        exam = FinalExam.query.get(exam.id)
+        self.assertFalse(exam.analytics_stale)
+        analytics = exam.analytics
+        self.assertEqual(analytics.submissions, 4)
+        self.assertAlmostEqual(analytics.mean_score, 50.0)
+        self.assertEqual(analytics.pass_rate, 50.0)
+        self.assertEqual(analytics.score_histogram, [1, 0, 0, 1, 0, 0, 1, 0, 0, 1])
+
+        item_stats = {row.question_id: row for row in exam_analytics.ExamQuestionAnalytics.query.filter_by(exam_id=exam.id)}
+        first, first_choices = questions[0]
+        self.assertEqual(item_stats[first.id].percent_correct, 75.0)
+        self.assertEqual(item_stats[questions[1][0].id].percent_correct, 50.0)
+        self.assertEqual(item_stats[true_false.id].percent_correct, 25.0)
+        self.assertEqual(item_stats[first.id].choice_counts, {str(first_choices[0].id): 3, str(first_choices[1].id): 1})
+        self.assertEqual(item_stats[true_false.id].choice_counts, {'True': 1, 'False': 3})
+        # Stronger students answered every question right more often
+        for stats in item_stats.values():
+            self.assertGreater(stats.discrimination, 0)
+
+        # Grading again marks the exam stale for the next refresh
+        submission = ExamSubmission.query.first()
+        exam_grading.rescore(exam, [submission.id])
+        db.session.commit()
+        db.session.refresh(exam)
+        self.assertTrue(exam.analytics_stale)
+
+        self.login('inst@test.com', 'pw')
+        response = self.client.get('/instructor/exams')
+        self.assertIn(b'50.0%', response.data)
+        response = self.client.get(f'/instructor/exam/{exam.id}/analytics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Single 0', response.data)
+        self.assertIn(b'75.0%', response.data)
+
+        # Deleting the course takes the analytics with its exam
+        self.login('admin@test.com', 'pw')
+        self.client.post(f'/admin/course/{self.course_id}/delete')
+        self.assertIsNone(db.session.get(FinalExam, exam.id))
+        self.assertEqual(exam_analytics.ExamAnalytics.query.count(), 0)
+        self.assertEqual(exam_analytics.ExamQuestionAnalytics.query.count(), 0)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -8,7 +8,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app import create_app
 from extensions import db
-from models import User, Category, LibraryMaterial, LibraryPurchase
+from models import User, Category, LibraryMaterial, LibraryPurchase, Course
 
 class TestConfig:
     TESTING = True
@@ -16,10 +16,14 @@ class TestConfig:
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     SECRET_KEY = 'test'
     MAX_CONTENT_LENGTH = 50 * 1024 * 1024
+    DOWNLOAD_COUNT_FLUSH_INTERVAL = 0 # Write each download count at once
 
 class LibraryFeaturesTests(unittest.TestCase):
     def setUp(self):
         self.app = create_app(TestConfig)
+        # Uploads go to a temporary static folder rather than the app's own
+        self.static_folder = os.path.join(os.path.dirname(__file__), 'test_library_static')
+        self.app.static_folder = self.static_folder
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -30,6 +34,7 @@ class LibraryFeaturesTests(unittest.TestCase):
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
+        shutil.rmtree(self.static_folder, ignore_errors=True)
 
     def seed_db(self):
         self.admin = User(name='Admin', email='admin@test.com', role='admin', approved=True)
@@ -121,10 +126,92 @@ class LibraryFeaturesTests(unittest.TestCase):
         self.assertEqual(purchase.status, 'approved')
 
         # 5. Student can now download
+        self.login('stud@test.com', 'pw')
+        response = self.client.get(f'/library/{material.id}/download', follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b"this is a test file")
+        self.assertEqual(material.download_count, 1)
+
+    def test_download_delivery(self):
+        import hashlib
+        import download_counts
+        from models import DailyMetric
+        self.login('inst@test.com', 'pw')
+        self.client.post('/instructor/library/submit', data={
+            'title': 'Free Notes', 'category_id': self.category.id, 'price_naira': 0,
+            'file': (BytesIO(b"0123456789abcdef"), 'notes.pdf')
+        }, content_type='multipart/form-data')
+        material = LibraryMaterial.query.filter_by(title='Free Notes').first()
+
         self.login('stud@test.com', 'pw')
         response = self.client.get(f'/library/{material.id}/download')
+        self.assertEqual(response.status_code, 302)
+        signed_url = response.headers['Location']
+        self.assertIn('/files/', signed_url)
+        self.assertEqual(material.download_count, 1)
+
+        # Resumes need no session and aren't counted again
+        self.client.get('/logout')
+        etag = '"' + hashlib.sha256(b"0123456789abcdef").hexdigest() + '"'
+        response = self.client.get(signed_url, headers={'Range': 'bytes=4-7'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, b"4567")
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertIn('Free_Notes.pdf', response.headers['Content-Disposition'])
+        self.assertEqual(self.client.get(signed_url, headers={'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(material.download_count, 1)
+        self.assertEqual(self.client.get(signed_url.replace('/files/', '/files/x')).status_code, 403)
+
+        self.app.config['DOWNLOAD_OFFLOAD'] = 'x-accel-redirect'
+        response = self.client.get(signed_url)
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['X-Accel-Redirect'], '/protected-static/' + material.file_path)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        # Batched counts are written together, with the day's downloads metric
+        self.app.config['DOWNLOAD_COUNT_FLUSH_INTERVAL'] = 3600
+        self.login('stud@test.com', 'pw')
+        for _ in range(2):
+            self.client.get(f'/library/{material.id}/download')
+        db.session.expire_all()
         self.assertEqual(material.download_count, 1)
+        self.assertEqual(download_counts.get_counter().flush(), 2)
+        db.session.expire_all()
+        self.assertEqual(material.download_count, 3)
+        self.assertEqual(DailyMetric.query.filter_by(metric='downloads').one().value, 3)
+
+    def test_catalog_search(self):
+        import catalog_search
+        web = Category(name='Web Development')
+        db.session.add(web)
+        db.session.commit()
+        db.session.add_all([
+            Course(title='Cooking Basics', description='Learn about python snakes in the wild.', instructor_id=self.instructor.id, category_id=self.category.id, price_naira=0, approved=True),
+            Course(title='Python for Beginners', description='Start programming.', instructor_id=self.instructor.id, category_id=web.id, price_naira=0, approved=True),
+            Course(title='Python Drafts', description='Not approved yet.', instructor_id=self.instructor.id, category_id=web.id, price_naira=0, approved=False),
+        ])
+        db.session.commit()
+        self.assertEqual(catalog_search.rebuild_index(), 2)
+
+        # Title matches rank above description matches; category and instructor names are searchable
+        response = self.client.get('/courses?search=python')
+        self.assertLess(response.data.index(b'Python for Beginners'), response.data.index(b'Cooking Basics'))
+        self.assertNotIn(b'Python Drafts', response.data)
+        response = self.client.get('/courses?search=web+develop')
+        self.assertIn(b'Python for Beginners', response.data)
+        self.assertNotIn(b'Cooking Basics', response.data)
+        response = self.client.get('/courses?search=instructor&sort=title')
+        self.assertLess(response.data.index(b'Cooking Basics'), response.data.index(b'Python for Beginners'))
+
+        # Library materials enter the index on approval and leave it on rejection
+        self.test_instructor_submission_and_admin_approval()
+        response = self.client.get('/library?search=ebook')
+        self.assertIn(b'My New eBook', response.data)
+        material = LibraryMaterial.query.filter_by(title='My New eBook').first()
+        self.client.post(f'/admin/library/{material.id}/reject', data={'reason': 'Outdated'})
+        response = self.client.get('/library?search=ebook')
+        self.assertIn(b'No Materials Found', response.data)
 
 if __name__ == "__main__":
     unittest.main()
@@ -9,6 +9,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from app import create_app
 from extensions import db
 from models import User, Course, Category, Module, Lesson
+import lesson_html
 
 class TestConfig:
     TESTING = True
@@ -16,6 +17,7 @@ class TestConfig:
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     SECRET_KEY = 'test'
     MAX_CONTENT_LENGTH = 2 * 1024 * 1024 # 2MB for testing
+    IMAGE_VARIANT_WORKERS = 0 # Render image variants inline
 
 class RichTextEditorTests(unittest.TestCase):
     def setUp(self):
@@ -87,7 +89,7 @@ class RichTextEditorTests(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         json_data = response.get_json()
         self.assertEqual(json_data['uploaded'], 1)
-        self.assertIn('/static/uploads/images/', json_data['url'])
+        self.assertIn('/static/uploads/', json_data['url'])
 
         # Test invalid file type
         data = {'upload': (BytesIO(b"fake txt data"), 'document.txt')}
@@ -97,6 +99,41 @@ class RichTextEditorTests(unittest.TestCase):
         self.assertEqual(json_data['uploaded'], 0)
         self.assertIn('Invalid file type', json_data['error']['message'])
 
+    def test_editor_images_get_responsive_variants(self):
+        from PIL import Image
+        from models import StoredFile, ImageVariant
+        self.login('inst@test.com', 'pw')
+
+        photo = BytesIO()
+        exif = Image.Exif()
+        exif[0x010f] = 'Test Camera' # Make
+        Image.new('RGB', (800, 600), 'teal').save(photo, 'JPEG', exif=exif)
+        photo.seek(0)
+        response = self.client.post('/instructor/upload_image', data={'upload': (photo, 'photo.jpg')},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        url = response.get_json()['url']
+
+        stored = StoredFile.query.filter(StoredFile.variants_status.isnot(None)).one()
+        self.assertEqual(stored.variants_status, 'ready')
+        variants = {(v.format, v.width, v.height) for v in stored.variants}
+        self.assertEqual(variants, {(format, width, width * 3 // 4)
+                                    for format in ('webp', 'jpeg') for width in (160, 320, 640, 800)})
+        smallest = ImageVariant.query.filter_by(source_id=stored.id, format='jpeg', width=160).one()
+        with Image.open(os.path.join(self.app.static_folder, *smallest.path.split('/'))) as variant:
+            self.assertNotIn(0x010f, variant.getexif())
+
+        self.client.post(f'/instructor/module/{self.module_id}/lesson/add', data={
+            'title': 'Picture Lesson', 'notes': f'<p><img src="{url}" alt="Diagram"></p>'
+        })
+        lesson = Lesson.query.filter_by(title='Picture Lesson').first()
+        self.login('stud@test.com', 'pw')
+        self.client.get(f'/course/{lesson.module.course.id}/enroll', follow_redirects=True)
+        response = self.client.get(f'/lesson/{lesson.id}')
+        self.assertIn(b'<picture>', response.data)
+        self.assertIn(b'type="image/webp"', response.data)
+        self.assertIn(b' 160w', response.data)
+
     def test_student_view_renders_html(self):
         self.login('inst@test.com', 'pw')
         safe_html = '<strong>This should be bold.</strong>'
@@ -140,6 +177,41 @@ class RichTextEditorTests(unittest.TestCase):
         self.assertIn(b'https://www.youtube-nocookie.com/embed/dQw4w9WgXcQ', response.data)
         self.assertNotIn(b'secure-embed', response.data)
 
+    def test_secure_embeds_are_cached_by_content(self):
+        notes = '<p>Intro</p><div class="secure-embed" data-type="gdrive" data-id="abc123"></div>'
+        with self.app.test_request_context():
+            first = lesson_html.secure_embeds(notes)
+            self.assertIn('https://drive.google.com/file/d/abc123/preview', first)
+            self.assertIs(lesson_html.secure_embeds(notes), first)
+
+            # Edited notes are a new entry; notes with nothing to rewrite pass through unparsed
+            self.assertIn('def456', lesson_html.secure_embeds(notes.replace('abc123', 'def456')))
+            self.assertEqual(lesson_html.transform('<p>a &amp; b<br></p>'), ('<p>a &amp; b<br></p>', True))
+            self.assertEqual(len(self.app.extensions['secure_embeds_cache']), 2)
+
+            # Only the placeholder and its contents are rewritten; the rest is copied as written
+            self.assertEqual(
+                lesson_html.transform('<p>A &amp; B<br/></p><div class="secure-embed" data-type="youtube" data-id="x"><div>Video</div></div><p>End</p>'),
+                ('<p>A &amp; B<br/></p><iframe src="https://www.youtube-nocookie.com/embed/x" width="560" height="315" '
+                 'frameborder="0" allowfullscreen></iframe><p>End</p>', True))
+
+            # Output missing an image's variants isn't cached while they render, so they show up once ready
+            from models import StoredFile
+            stored_file = StoredFile(key='ab/ab12.png', sha256='ab12', size=1, ref_count=1, variants_status='queued')
+            db.session.add(stored_file)
+            db.session.commit()
+            pending = '<p><img src="/static/uploads/ab/ab12.png"/></p>'
+            self.assertEqual(lesson_html.transform(pending), (pending, False))
+            lesson_html.secure_embeds(pending)
+            self.assertEqual(len(self.app.extensions['secure_embeds_cache']), 2)
+
+            # An image that will never get variants doesn't keep the lesson out of the cache
+            stored_file.variants_status = 'failed'
+            db.session.commit()
+            self.assertEqual(lesson_html.transform(pending), (pending, True))
+            lesson_html.secure_embeds(pending)
+            self.assertEqual(len(self.app.extensions['secure_embeds_cache']), 3)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,143 @@
+from flask import current_app
+from sqlalchemy import and_, or_, func, insert
+from extensions import db
+from models import ChatMessage, ChatRoomMember, ChatUnreadCounter, UserLastRead
+
+
+def counters_enabled():
+    """Whether the per-(user, room) ChatUnreadCounter table is maintained."""
+    return current_app.config.get('CHAT_UNREAD_COUNTERS', False)
+
+
+def _scanned_unread_query(user_id, room_ids):
+    """
+    Grouped unread count per room, computed from ChatMessage joined to UserLastRead.
+    Rooms the user has never read count every message not written by the user.
+    """
+    return db.session.query(
+        ChatMessage.room_id.label('room_id'),
+        func.count(ChatMessage.id).label('unread_count')
+    ).outerjoin(UserLastRead, and_(
+        UserLastRead.room_id == ChatMessage.room_id,
+        UserLastRead.user_id == user_id
+    )).filter(
+        ChatMessage.room_id.in_(room_ids),
+        ChatMessage.user_id != user_id,
+        or_(UserLastRead.last_read_timestamp.is_(None),
+            ChatMessage.timestamp > UserLastRead.last_read_timestamp)
+    ).group_by(ChatMessage.room_id)
+
+
+def _unread_subquery(user_id, room_ids):
+    """
+    Subquery of (room_id, unread_count). With counters enabled, stored counters are used
+    and only rooms without a counter row for the user fall back to the grouped scan.
+    """
+    if not counters_enabled():
+        return _scanned_unread_query(user_id, room_ids).subquery()
+
+    counted_rooms = db.session.query(ChatUnreadCounter.room_id).filter(ChatUnreadCounter.user_id == user_id)
+    stored = db.session.query(
+        ChatUnreadCounter.room_id.label('room_id'),
+        ChatUnreadCounter.unread_count.label('unread_count')
+    ).filter(ChatUnreadCounter.user_id == user_id, ChatUnreadCounter.room_id.in_(room_ids))
+    scanned = _scanned_unread_query(user_id, room_ids).filter(ChatMessage.room_id.notin_(counted_rooms))
+    return stored.union_all(scanned).subquery()
+
+
+def get_unread_counts(user, room_ids):
+    """Returns {room_id: unread_count} for the given rooms in a single query."""
+    room_ids = list(room_ids)
+    if not room_ids:
+        return {}
+
+    unread = _unread_subquery(user.id, room_ids)
+    counts = dict.fromkeys(room_ids, 0)
+    counts.update(db.session.query(unread.c.room_id, unread.c.unread_count).all())
+    return counts
+
+
+def get_room_counts(user, room_ids):
+    """
+    Returns {room_id: {'member_count': int, 'unread_count': int}} for the given rooms,
+    computed in a single query.
+    """
+    room_ids = list(room_ids)
+    if not room_ids:
+        return {}
+
+    unread = _unread_subquery(user.id, room_ids)
+    members = db.session.query(
+        ChatRoomMember.chat_room_id.label('room_id'),
+        func.count(ChatRoomMember.id).label('member_count')
+    ).filter(ChatRoomMember.chat_room_id.in_(room_ids)).group_by(ChatRoomMember.chat_room_id).subquery()
+
+    counts = {room_id: {'member_count': 0, 'unread_count': 0} for room_id in room_ids}
+    rows = db.session.query(members.c.room_id, members.c.member_count, db.literal(None))\
+        .union_all(db.session.query(unread.c.room_id, db.literal(None), unread.c.unread_count))\
+        .all()
+    for room_id, member_count, unread_count in rows:
+        if member_count is not None:
+            counts[room_id]['member_count'] = member_count
+        if unread_count is not None:
+            counts[room_id]['unread_count'] = unread_count
+    return counts
+
+
+def record_new_message(room_id, sender_id, count=1):
+    """Increments the stored counters of everyone in the room except the sender. Caller commits."""
+    if not counters_enabled():
+        return
+    ChatUnreadCounter.query.filter(
+        ChatUnreadCounter.room_id == room_id,
+        ChatUnreadCounter.user_id != sender_id
+    ).update({ChatUnreadCounter.unread_count: ChatUnreadCounter.unread_count + count}, synchronize_session=False)
+
+
+def record_deleted_message(message):
+    """Decrements the stored counters of users who had not yet read the deleted message. Caller commits."""
+    if not counters_enabled():
+        return
+    unread_by = db.session.query(UserLastRead.user_id).filter(
+        UserLastRead.room_id == message.room_id,
+        UserLastRead.last_read_timestamp < message.timestamp
+    )
+    ChatUnreadCounter.query.filter(
+        ChatUnreadCounter.room_id == message.room_id,
+        ChatUnreadCounter.user_id != message.user_id,
+        ChatUnreadCounter.unread_count > 0,
+        ChatUnreadCounter.user_id.in_(unread_by)
+    ).update({ChatUnreadCounter.unread_count: ChatUnreadCounter.unread_count - 1}, synchronize_session=False)
+
+
+def reset_counter(user_id, room_id):
+    """Zeroes (creating if needed) the user's stored counter for a room they just read. Caller commits."""
+    if not counters_enabled():
+        return
+    counter = ChatUnreadCounter.query.filter_by(user_id=user_id, room_id=room_id).first()
+    if counter:
+        counter.unread_count = 0
+    else:
+        db.session.add(ChatUnreadCounter(user_id=user_id, room_id=room_id, unread_count=0))
+
+
+def rebuild_counters():
+    """
+    Recomputes every stored counter from ChatMessage and UserLastRead in one INSERT ... SELECT.
+    Returns the number of counters written.
+    """
+    ChatUnreadCounter.query.delete()
+    recount = db.session.query(
+        UserLastRead.user_id,
+        UserLastRead.room_id,
+        func.count(ChatMessage.id)
+    ).outerjoin(ChatMessage, and_(
+        ChatMessage.room_id == UserLastRead.room_id,
+        ChatMessage.user_id != UserLastRead.user_id,
+        ChatMessage.timestamp > UserLastRead.last_read_timestamp
+    )).group_by(UserLastRead.id, UserLastRead.user_id, UserLastRead.room_id)
+    db.session.execute(insert(ChatUnreadCounter).from_select(
+        ['user_id', 'room_id', 'unread_count'], recount
+    ))
+    db.session.commit()
+    return ChatUnreadCounter.query.count()
@@ -0,0 +1,272 @@
+import hashlib
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from flask import current_app, url_for, send_from_directory
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from sqlalchemy import case, insert, update, delete
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename
+from extensions import db
+from models import StoredFile, ImageVariant
+
+CHUNK_SIZE = 64 * 1024 # Bytes copied and hashed at a time
+PREFIX = 'uploads/' # Stored paths are PREFIX + key, relative to the static folder
+TOKEN_TTL = 30 * 60 # Seconds an upload_token() is valid; shorter than prune()'s default grace
+
+_backends_lock = threading.Lock()
+
+
+class UploadRejected(ValueError):
+    """An upload with a disallowed extension or over its size limit."""
+
+
+class LocalBackend:
+    """
+    Keeps blobs as files under the static folder's uploads/, so they are served like any
+    other static file. A backend for an S3-compatible store implements the same methods.
+    """
+
+    def __init__(self, app):
+        self.root = os.path.join(app.static_folder, PREFIX.rstrip('/'))
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def temp_file(self):
+        """A named temp file to spool an upload into, on the same filesystem as the blobs."""
+        directory = os.path.join(self.root, 'tmp')
+        os.makedirs(directory, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=directory, delete=False)
+
+    def put(self, key, temp_path):
+        """Moves a spooled upload to `key`. Blobs never change, so racing puts of one key are harmless."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def open(self, key):
+        return open(self._path(key), 'rb')
+
+    def local_path(self, key):
+        """Where the blob is on this machine's filesystem; a remote backend returns None."""
+        return self._path(key)
+
+    def url(self, key):
+        return url_for('static', filename=PREFIX + key)
+
+    def send(self, key, **kwargs):
+        return send_from_directory(self.root, key, **kwargs)
+
+
+BACKENDS = {'local': LocalBackend}
+
+
+def get_backend():
+    """The current app's storage backend, chosen by UPLOAD_STORE_BACKEND."""
+    with _backends_lock:
+        backend = current_app.extensions.get('upload_store')
+        if backend is None:
+            backend = BACKENDS[current_app.config.get('UPLOAD_STORE_BACKEND', 'local')](current_app)
+            current_app.extensions['upload_store'] = backend
+    return backend
+
+
+def _key(path):
+    """The blob key of a stored path, or None for a path saved before the store."""
+    if path and path.startswith(PREFIX):
+        key = path[len(PREFIX):]
+        head, _, name = key.partition('/')
+        if len(head) == 2 and name.startswith(head):
+            return key
+    return None
+
+
+def is_stored(path):
+    return _key(path) is not None
+
+
+def lookup(path):
+    """The StoredFile behind a stored path, or None."""
+    key = _key(path)
+    return StoredFile.query.filter_by(key=key).first() if key is not None else None
+
+
+def content_hash(path):
+    """The SHA-256 of a stored path's content, read from its key, or None for a legacy path."""
+    key = _key(path)
+    return os.path.splitext(key.split('/', 1)[1])[0] if key is not None else None
+
+
+def local_path(path):
+    """A stored path's location on the local filesystem, or None when the backend is remote."""
+    return get_backend().local_path(_key(path))
+
+
+def send(path, **kwargs):
+    """A response serving a stored path's content."""
+    return get_backend().send(_key(path), **kwargs)
+
+
+def open_stored(path):
+    """A binary file object reading a stored path's content."""
+    return get_backend().open(_key(path))
+
+
+def _spool(stream, backend, max_size):
+    """Copies a stream to a temp file in chunks, hashing as it goes. Returns (temp path, sha256, size)."""
+    digest = hashlib.sha256()
+    size = 0
+    temp = backend.temp_file()
+    try:
+        with temp:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise UploadRejected(f'File is too large. Maximum size is {max_size // (1024 * 1024)}MB.')
+                digest.update(chunk)
+                temp.write(chunk)
+    except BaseException:
+        os.remove(temp.name)
+        raise
+    return temp.name, digest.hexdigest(), size
+
+
+def save(file, allowed_extensions=None, max_size=None, extension=None):
+    """
+    Stores an upload (a FileStorage or any binary file object) and returns its path
+    relative to the static folder. The file is spooled to disk in CHUNK_SIZE pieces
+    while it is hashed, so it is never held in memory; if the same content was stored
+    before, the spooled copy is dropped and the existing blob gains a reference.
+    `extension` defaults to the upload's filename's. Raises UploadRejected for an
+    extension outside `allowed_extensions` or more than `max_size` bytes. The reference
+    is part of the current transaction; the caller commits.
+    """
+    if extension is None:
+        extension = os.path.splitext(secure_filename(getattr(file, 'filename', None) or ''))[1]
+    extension = extension.lower()
+    if allowed_extensions is not None and extension.lstrip('.') not in allowed_extensions:
+        raise UploadRejected(f"Invalid file type. Allowed: {', '.join(sorted(allowed_extensions))}.")
+
+    backend = get_backend()
+    temp_path, sha256, size = _spool(getattr(file, 'stream', file), backend, max_size)
+    key = f'{sha256[:2]}/{sha256}{extension}'
+    reference = update(StoredFile).where(StoredFile.key == key)\
+        .values(ref_count=StoredFile.ref_count + 1, released_at=None)
+    if db.session.execute(reference).rowcount:
+        os.remove(temp_path)
+        return PREFIX + key
+
+    backend.put(key, temp_path)
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(StoredFile.__table__), [
+                {'key': key, 'sha256': sha256, 'size': size, 'ref_count': 1, 'created_at': datetime.utcnow()}
+            ])
+    except IntegrityError:
+        # A concurrent upload of the same content created the row first
+        db.session.execute(reference)
+    return PREFIX + key
+
+
+def _token_serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt='upload-store')
+
+
+def upload_token(path, user_id):
+    """
+    Proof that `user_id` uploaded `path`, for uploads that a later request attaches to a
+    record, like files shared in chat. Such an upload is release()d at once and each
+    record takes its own reference with acquire(), so the path the client sends back
+    is never trusted.
+    """
+    return _token_serializer().dumps([path, user_id])
+
+
+def acquire(token, user_id):
+    """
+    Takes a reference to the path in one of `user_id`'s upload tokens and returns it, or
+    None when the token is forged, expired or another user's, or the blob was pruned.
+    The reference is part of the current transaction; the caller commits.
+    """
+    try:
+        path, token_user_id = _token_serializer().loads(token, max_age=TOKEN_TTL)
+    except (BadSignature, ValueError):
+        return None
+    key = _key(path)
+    if token_user_id != user_id or key is None:
+        return None
+    acquired = db.session.execute(
+        update(StoredFile).where(StoredFile.key == key)
+        .values(ref_count=StoredFile.ref_count + 1, released_at=None)
+    ).rowcount
+    return path if acquired else None
+
+
+def release(path):
+    """
+    Drops a reference to a stored path, e.g. when a record stops pointing at it. Paths
+    from before the store (and None) are ignored. Unreferenced blobs stay until prune()
+    so a transaction that rolls back never loses a file. Caller commits.
+    """
+    key = _key(path)
+    if key is None:
+        return
+    db.session.execute(
+        update(StoredFile).where(StoredFile.key == key, StoredFile.ref_count > 0)
+        .values(ref_count=StoredFile.ref_count - 1,
+                released_at=case((StoredFile.ref_count == 1, datetime.utcnow()), else_=StoredFile.released_at))
+    )
+
+
+def prune(grace=timedelta(hours=1)):
+    """
+    Deletes blobs that have had no references for longer than `grace`, rows first so
+    an upload of the same content meanwhile stores it afresh. Returns the number deleted.
+    """
+    backend = get_backend()
+    cutoff = datetime.utcnow() - grace
+    keys = [key for key, in db.session.query(StoredFile.key)
+            .filter(StoredFile.ref_count <= 0, StoredFile.released_at < cutoff)]
+    pruned = 0
+    for key in keys:
+        stored_file = StoredFile.query.filter(StoredFile.key == key, StoredFile.ref_count <= 0).first()
+        if stored_file is None:
+            continue
+        # An image's variants are blobs too; they become unreferenced and go on the next prune
+        for variant in stored_file.variants:
+            release(variant.path)
+        db.session.execute(delete(ImageVariant).where(ImageVariant.source_id == stored_file.id))
+        deleted = db.session.execute(
+            delete(StoredFile).where(StoredFile.id == stored_file.id, StoredFile.ref_count <= 0)
+        ).rowcount
+        if not deleted:
+            # Uploaded again since the query above
+            db.session.rollback()
+            continue
+        db.session.commit()
+        backend.delete(key)
+        pruned += 1
+    return pruned
+
+
+def url(path, legacy_folder=None):
+    """
+    The URL of a stored path, for templates as the `upload_url` filter. Paths saved
+    before the store may be bare filenames inside `legacy_folder` of the static folder.
+    """
+    if not path:
+        return None
+    key = _key(path)
+    if key is not None:
+        return get_backend().url(key)
+    if legacy_folder and '/' not in path:
+        path = f'{legacy_folder}/{path}'
+    return url_for('static', filename=path)